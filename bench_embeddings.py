@@ -0,0 +1,137 @@
+"""
+Recall / latency / memory comparison for reduced-dimension and quantized
+listing embeddings.
+
+    python bench_embeddings.py                 # synthetic corpus, no network
+    python bench_embeddings.py --openai        # real text-embedding-3 vectors for
+                                               # listings.json variants (cached on disk)
+
+Recall@k is measured against exact float32 search over full-size vectors, so it
+shows what each compact configuration loses relative to what we store today.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+
+from src.quantization import QuantizedIndex, to_wire, truncate_dimensions
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "embeddings")
+FULL_DIMS = 1536
+
+AREAS = ["Kilimani", "Kasarani", "Westlands", "Madaraka", "Juja", "Kahawa Wendani", "Ruaka", "South B",
+         "Parklands", "Rongai", "Lavington", "Githurai"]
+TYPES = ["Bedsitter", "Studio", "Single room", "One bedroom", "Two bedroom", "Hostel room"]
+PRICES = [5000, 7000, 8000, 10000, 12000, 15000, 20000]
+
+
+def synthetic_vectors(n: int, dims: int, seed: int) -> np.ndarray:
+    # Matryoshka-style embeddings carry most of their variance in the leading
+    # dimensions; mimic that so truncation behaves roughly like the real model
+    rng = np.random.default_rng(seed)
+    decay = 1.0 / np.sqrt(1.0 + np.arange(dims) / 64.0)
+    centers = rng.standard_normal((32, dims)) * decay
+    m = centers[rng.integers(0, 32, n)] + 0.6 * rng.standard_normal((n, dims)) * decay
+    return m.astype(np.float32)
+
+
+def listing_texts(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        base = [item["listing"] for item in json.load(f)]
+    texts = []
+    for (area, ptype, price), template in zip(itertools.product(AREAS, TYPES, PRICES), itertools.cycle(base)):
+        texts.append(f"{ptype} in {area}, Nairobi | {template.get('description', '')} | "
+                     f"{template.get('furnishing', '')} | Price: {price}")
+    queries = [f"{ptype.lower()} in {area} under {price // 1000}k"
+               for area, ptype, price in itertools.product(AREAS, TYPES, PRICES[::2])]
+    return texts, queries
+
+
+def embed_cached(texts, model: str) -> np.ndarray:
+    from src import clients
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"{model}.json")
+    cache = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    keys = [hashlib.sha1(t.encode("utf-8")).hexdigest() for t in texts]
+    missing = [(k, t) for k, t in zip(keys, texts) if k not in cache]
+    for start in range(0, len(missing), 256):
+        batch = missing[start:start + 256]
+        resp = clients.openai_client().embeddings.create(model=model, input=[t for _, t in batch])
+        for (k, _), item in zip(batch, resp.data):
+            cache[k] = item.embedding
+    if missing:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    return np.asarray([cache[k] for k in keys], dtype=np.float32)
+
+
+def exact_topk(corpus: np.ndarray, queries: np.ndarray, k: int):
+    c = truncate_dimensions(corpus, corpus.shape[1])
+    q = truncate_dimensions(queries, queries.shape[1])
+    scores = q @ c.T
+    return [set(np.argsort(-row)[:k].tolist()) for row in scores]
+
+
+def run(corpus: np.ndarray, queries: np.ndarray, k: int, configs):
+    truth = exact_topk(corpus, queries, k)
+    ids = list(range(len(corpus)))
+    print(f"corpus={len(corpus)} queries={len(queries)} k={k}\n")
+    print(f"{'config':<26}{'recall@k':>9}{'p50 ms':>9}{'p95 ms':>9}{'index MB':>10}{'B/vector':>10}{'wire B':>9}")
+    for name, dims, dtype, rescore in configs:
+        index = QuantizedIndex(corpus, ids, dtype=dtype, dims=dims, keep_float=rescore > 0)
+        latencies, hits = [], 0
+        for q, expected in zip(queries, truth):
+            started = time.perf_counter()
+            found = index.search(q, k=k, rescore=rescore)
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += len(expected & {i for i, _ in found})
+        recall = hits / (k * len(queries))
+        wire = len(json.dumps(to_wire(truncate_dimensions(corpus[0], index.dims)[0])))
+        print(f"{name:<26}{recall:>9.3f}{np.percentile(latencies, 50):>9.3f}{np.percentile(latencies, 95):>9.3f}"
+              f"{index.nbytes / 1e6:>10.2f}{index.nbytes // len(corpus):>10}{wire:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare compact embedding configurations")
+    parser.add_argument("--openai", action="store_true", help="embed listings.json variants with OpenAI (cached)")
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"))
+    parser.add_argument("--size", type=int, default=20000, help="synthetic corpus size")
+    parser.add_argument("--queries", type=int, default=200, help="synthetic query count")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.openai:
+        texts, query_texts = listing_texts("listings.json")
+        corpus = embed_cached(texts, args.model)
+        queries = embed_cached(query_texts, args.model)
+    else:
+        corpus = synthetic_vectors(args.size, FULL_DIMS, seed=1)
+        picks = np.random.default_rng(2).integers(0, args.size, args.queries)
+        queries = corpus[picks] + 0.3 * synthetic_vectors(args.queries, FULL_DIMS, seed=3)
+        print("synthetic vectors; use --openai for numbers on real embeddings\n")
+
+    k = min(args.k, len(corpus))
+    rescore = 4 * k
+    configs = [
+        ("float32 1536 (today)", None, "float32", 0),
+        ("float16 1536", None, "float16", 0),
+        ("int8 1536", None, "int8", 0),
+        ("int8 1536 + rescore", None, "int8", rescore),
+        ("float32 512", 512, "float32", 0),
+        ("float16 512", 512, "float16", 0),
+        ("int8 512", 512, "int8", 0),
+        ("int8 512 + rescore", 512, "int8", rescore),
+        ("int8 256 + rescore", 256, "int8", rescore),
+    ]
+    run(corpus, queries, k, configs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures what a gunicorn worker pays at boot: importing the app and running
+the warm-up hooks, each in a fresh interpreter.
+
+    python bench_startup.py                  # current tree
+    python bench_startup.py --baseline HEAD~1  # compare against another git revision
+
+With --preload the import + warm-up cost is paid once by the master and each
+forked worker starts at ~0; without it every worker pays the full cost.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+MODULE = "src.webhook_handler"
+
+PROBE = r"""
+import json, time
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+warm = 0.0
+try:
+    from src import clients
+    if hasattr(clients, "warm_up"):
+        clients.warm_up()
+        warm = time.perf_counter() - t1
+except ImportError:
+    pass
+print("RESULT " + json.dumps({{"import": t1 - t0, "warm_up": warm}}))
+"""
+
+
+def _run_once(cwd: str, module: str) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module)],
+        cwd=cwd, capture_output=True, text=True, env=os.environ.copy(),
+    )
+    for line in proc.stdout.splitlines():
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    raise RuntimeError(f"import of {module} failed in {cwd}:\n{proc.stderr[-2000:]}")
+
+
+def measure(cwd: str, module: str, runs: int) -> dict:
+    samples = [_run_once(cwd, module) for _ in range(runs)]
+    imports = [s["import"] * 1000 for s in samples]
+    warms = [s["warm_up"] * 1000 for s in samples]
+    return {
+        "import_ms_median": statistics.median(imports),
+        "import_ms_min": min(imports),
+        "warm_up_ms_median": statistics.median(warms),
+    }
+
+
+def _print(label: str, result: dict):
+    print(f"{label:>10}: import {result['import_ms_median']:8.1f} ms (min {result['import_ms_min']:.1f})"
+          f"  warm-up {result['warm_up_ms_median']:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark worker startup time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--module", default=MODULE)
+    parser.add_argument("--baseline", help="git revision to compare against (checked out in a temporary worktree)")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as tmp:
+            worktree = os.path.join(tmp, "baseline")
+            subprocess.run(["git", "worktree", "add", "--detach", worktree, args.baseline], cwd=here, check=True,
+                           capture_output=True)
+            try:
+                _print("before", measure(worktree, args.module, args.runs))
+            except RuntimeError as e:
+                print(e)
+            finally:
+                subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=here, capture_output=True)
+
+    _print("after" if args.baseline else "current", measure(here, args.module, args.runs))
+
+
+if __name__ == "__main__":
+    main()
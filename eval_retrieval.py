@@ -0,0 +1,298 @@
+"""
+Offline retrieval quality / latency evaluation.
+
+    python eval_retrieval.py                       # OpenAI embeddings, cached on disk
+    python eval_retrieval.py --embedder hashing    # no network at all (smoke runs)
+    python eval_retrieval.py --live                # also time the deployed match_listings RPC
+
+The corpus is listings.json expanded over areas, room types and prices (the
+same variants bench_embeddings.py uses). Queries are synthesized from
+(area, type, budget) plus the hand-labelled ones in eval_queries.json; a
+listing's relevance is graded from those criteria:
+
+    2  right area, right room type and within budget
+    1  right area and one of room type / budget
+    0  otherwise
+
+Every configuration is scored on recall@k (grade-2 listings found, out of
+min(k, grade-2 listings that exist)), nDCG@k over the graded relevance, and
+p50/p95/p99 search latency. Query embeddings are computed once and shared, so
+latency is the search step only. Hashed embeddings are not Matryoshka-shaped,
+so with --embedder hashing only the full-size rows are meaningful.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import re
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from bench_embeddings import AREAS, PRICES, TYPES, embed_cached
+from src.embeddings_ingest import listing_text_for_embedding
+from src.quantization import QuantizedIndex, normalize_rows
+from src.reranker import rerank_candidates
+
+HAND_LABELLED_PATH = "eval_queries.json"
+MATCH_THRESHOLD = 0.5  # same threshold retrieval.retrieve_listings passes to the RPC
+HASH_DIMS = 1536
+
+PHRASINGS = [
+    "{type} in {area} under {k}k",
+    "looking for a {type} around {area}, budget {price}",
+    "{area} {type} max {price}",
+]
+
+
+def build_corpus(path: str) -> List[Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        base = [item["listing"] for item in json.load(f)]
+    corpus = []
+    combos = itertools.product(AREAS, TYPES, PRICES)
+    for n, ((area, ptype, price), template) in enumerate(zip(combos, itertools.cycle(base))):
+        corpus.append({
+            **template,
+            "id": f"eval-{n:04d}",
+            "title": f"{ptype} in {area}",
+            "property_type": ptype,
+            "location": f"{area}, Nairobi",
+            "price": price,
+        })
+    return corpus
+
+
+def synthesized_queries(budgets: List[int]) -> List[Dict]:
+    queries = []
+    for (area, ptype, price), phrasing in zip(itertools.product(AREAS, TYPES, budgets), itertools.cycle(PHRASINGS)):
+        text = phrasing.format(type=ptype.lower(), area=area, k=price // 1000, price=price)
+        queries.append({"query": text, "location": [area], "property_type": ptype, "max_price": price, "source": "synthesized"})
+    return queries
+
+
+def hand_labelled_queries(path: str) -> List[Dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [{**q, "source": "hand"} for q in json.load(f)]
+
+
+def relevance(listing: Dict, criteria: Dict) -> int:
+    location = str(listing.get("location") or "").lower()
+    if not any(area.lower() in location for area in criteria["location"]):
+        return 0
+    type_ok = criteria["property_type"].lower() in str(listing.get("property_type") or "").lower()
+    price_ok = float(listing.get("price") or 0) <= criteria["max_price"]
+    return 2 if type_ok and price_ok else int(type_ok or price_ok)
+
+
+def recall_at_k(grades: List[int], total_relevant: int, k: int) -> float:
+    return sum(1 for g in grades[:k] if g == 2) / min(k, total_relevant)
+
+
+def ndcg_at_k(grades: List[int], ideal: List[int], k: int) -> float:
+    def dcg(gs):
+        return sum((2 ** g - 1) / math.log2(i + 2) for i, g in enumerate(gs[:k]))
+    best = dcg(sorted(ideal, reverse=True))
+    return dcg(grades) / best if best else 0.0
+
+
+# Query slots for the reranked and hybrid configurations, parsed from the text
+# the way a user would type it (not taken from the labels).
+def parse_slots(text: str) -> Dict:
+    lowered = text.lower()
+    slots = {"location": None, "property_type": None, "max_price": None}
+    for area in AREAS:
+        if area.lower() in lowered:
+            slots["location"] = area
+            break
+    for ptype in TYPES:
+        if ptype.lower() in lowered:
+            slots["property_type"] = ptype
+            break
+    m = re.search(r"(\d+(?:\.\d+)?)\s*k\b", lowered)
+    if m:
+        slots["max_price"] = int(float(m.group(1)) * 1000)
+    else:
+        m = re.search(r"\b(\d{4,6})\b", lowered)
+        if m:
+            slots["max_price"] = int(m.group(1))
+    return slots
+
+
+def hashing_embeddings(texts: List[str], dims: int = HASH_DIMS) -> np.ndarray:
+    """Deterministic bag-of-words vectors; lets the harness run with no API key."""
+    m = np.zeros((len(texts), dims), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for token in re.findall(r"[a-z0-9]+", text.lower()):
+            h = int.from_bytes(hashlib.md5(token.encode("utf-8")).digest()[:8], "little")
+            m[row, h % dims] += 1.0 if (h >> 7) & 1 else -1.0
+    return normalize_rows(m)
+
+
+class Backend:
+    """One retrieval configuration: search(query_vector, query_text, k) -> listing indexes."""
+
+    def __init__(self, name: str, search: Callable[[np.ndarray, str, int], List[int]]):
+        self.name = name
+        self.search = search
+
+
+def vector_backend(name: str, vectors: np.ndarray, dtype: str = "float32", dims: Optional[int] = None,
+                   rescore: int = 0, threshold: float = MATCH_THRESHOLD) -> Backend:
+    index = QuantizedIndex(vectors, range(len(vectors)), dtype=dtype, dims=dims, keep_float=rescore > 0)
+
+    def search(q, text, k):
+        return [i for i, sim in index.search(q, k=k, rescore=rescore) if sim >= threshold]
+
+    return Backend(name, search)
+
+
+def reranked_backend(name: str, vectors: np.ndarray, corpus: List[Dict], pool: int, threshold: float) -> Backend:
+    index = QuantizedIndex(vectors, range(len(vectors)), dtype="float32")
+
+    def search(q, text, k):
+        slots = parse_slots(text)
+        candidates = [{**corpus[i], "_idx": i, "similarity": sim}
+                      for i, sim in index.search(q, k=pool) if sim >= threshold]
+        ranked = rerank_candidates(candidates, property_type=slots["property_type"], max_price=slots["max_price"], top_k=k)
+        return [c["_idx"] for c in ranked]
+
+    return Backend(name, search)
+
+
+def hybrid_backend(name: str, vectors: np.ndarray, corpus: List[Dict]) -> Backend:
+    """Structured filters first (what search_listings does with ilike/lte),
+    vector similarity within the survivors, vector-only top-up if too few pass."""
+    m = normalize_rows(vectors)
+    locations = np.array([str(l.get("location") or "").lower() for l in corpus])
+    types = np.array([str(l.get("property_type") or "").lower() for l in corpus])
+    prices = np.array([float(l.get("price") or 0) for l in corpus])
+
+    def search(q, text, k):
+        slots = parse_slots(text)
+        mask = np.ones(len(corpus), dtype=bool)
+        if slots["location"]:
+            mask &= np.char.find(locations, slots["location"].lower()) >= 0
+        if slots["property_type"]:
+            mask &= np.char.find(types, slots["property_type"].lower()) >= 0
+        if slots["max_price"]:
+            mask &= prices <= slots["max_price"]
+        scores = m @ (q / (np.linalg.norm(q) or 1.0))
+        filtered = np.flatnonzero(mask)
+        found = filtered[np.argsort(-scores[filtered])][:k].tolist()
+        if len(found) < k:
+            seen = set(found)
+            found += [i for i in np.argsort(-scores).tolist() if i not in seen][: k - len(found)]
+        return found
+
+    return Backend(name, search)
+
+
+def _summary(name: str, recalls: List[float], ndcgs: List[float], latencies: List[float]) -> Dict:
+    if not recalls:
+        return {"config": name, "queries": 0, "recall": 0.0, "ndcg": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {"config": name, "queries": len(recalls), "recall": float(np.mean(recalls)), "ndcg": float(np.mean(ndcgs)),
+            "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def evaluate(backend: Backend, query_vectors: np.ndarray, queries: List[Dict], corpus: List[Dict], k: int) -> Dict:
+    recalls, ndcgs, latencies = [], [], []
+    for q, criteria in zip(query_vectors, queries):
+        ideal = [relevance(l, criteria) for l in corpus]
+        total_relevant = sum(1 for g in ideal if g == 2)
+        if not total_relevant:
+            continue
+        started = time.perf_counter()
+        found = backend.search(q, criteria["query"], k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        grades = [ideal[i] for i in found]
+        recalls.append(recall_at_k(grades, total_relevant, k))
+        ndcgs.append(ndcg_at_k(grades, ideal, k))
+    return _summary(backend.name, recalls, ndcgs, latencies)
+
+
+def evaluate_live(queries: List[Dict], k: int) -> Dict:
+    """Runs the deployed match_listings RPC (query embedding included in the
+    latency). Relevance is graded against the listings actually in Supabase."""
+    from src.embeddings_ingest import fetch_all_listings
+    from src.retrieval import retrieve_listings
+
+    listings = fetch_all_listings()
+    recalls, ndcgs, latencies = [], [], []
+    for criteria in queries:
+        ideal = [relevance(l, criteria) for l in listings]
+        total_relevant = sum(1 for g in ideal if g == 2)
+        if not total_relevant:
+            continue
+        started = time.perf_counter()
+        found = retrieve_listings(criteria["query"], top_k=k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        grades = [relevance(l, criteria) for l in found]
+        recalls.append(recall_at_k(grades, total_relevant, k))
+        ndcgs.append(ndcg_at_k(grades, ideal, k))
+    return _summary("match_listings RPC (live)", recalls, ndcgs, latencies)
+
+
+def print_table(results: List[Dict], k: int):
+    print(f"{'config':<30}{'queries':>8}{f'recall@{k}':>11}{f'nDCG@{k}':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for r in results:
+        print(f"{r['config']:<30}{r['queries']:>8}{r['recall']:>11.3f}{r['ndcg']:>9.3f}"
+              f"{r['p50']:>9.3f}{r['p95']:>9.3f}{r['p99']:>9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare retrieval configurations on recall, nDCG and latency")
+    parser.add_argument("--embedder", choices=["openai", "hashing"], default="openai")
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"))
+    parser.add_argument("--listings", default="listings.json")
+    parser.add_argument("--queries", default=HAND_LABELLED_PATH, help="hand-labelled queries (JSON)")
+    parser.add_argument("--only", choices=["all", "synthesized", "hand"], default="all")
+    parser.add_argument("--live", action="store_true", help="also evaluate the deployed match_listings RPC")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.listings)
+    queries = []
+    if args.only in ("all", "synthesized"):
+        queries += synthesized_queries(PRICES[::2])
+    if args.only in ("all", "hand"):
+        queries += hand_labelled_queries(args.queries)
+
+    texts = [listing_text_for_embedding(l) for l in corpus]
+    query_texts = [q["query"] for q in queries]
+    if args.embedder == "openai":
+        vectors, query_vectors = embed_cached(texts, args.model), embed_cached(query_texts, args.model)
+        threshold = MATCH_THRESHOLD
+    else:
+        vectors, query_vectors = hashing_embeddings(texts), hashing_embeddings(query_texts)
+        threshold = 0.0  # hashed similarities are not on the model's scale
+    print(f"corpus={len(corpus)} queries={len(queries)} embedder={args.embedder} k={args.k}\n")
+
+    k = args.k
+    backends = [
+        vector_backend("match_listings (float32)", vectors, threshold=threshold),
+        reranked_backend("match_listings + rerank", vectors, corpus, pool=4 * k, threshold=threshold),
+        hybrid_backend("filtered hybrid", vectors, corpus),
+        vector_backend("reduced 512 (float32)", vectors, dims=512, threshold=threshold),
+        vector_backend("int8 1536 + rescore", vectors, dtype="int8", rescore=4 * k, threshold=threshold),
+        vector_backend("int8 512 + rescore", vectors, dtype="int8", dims=512, rescore=4 * k, threshold=threshold),
+        vector_backend("int8 256", vectors, dtype="int8", dims=256, threshold=threshold),
+    ]
+    results = [evaluate(b, query_vectors, queries, corpus, k) for b in backends]
+    if args.live:
+        results.append(evaluate_live(queries, k))
+    print_table(results, k)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"k": k, "embedder": args.embedder, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
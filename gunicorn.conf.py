@@ -0,0 +1,29 @@
+import os
+
+# Gunicorn picks this file up automatically from the working directory.
+# The app is imported and warmed once in the master (preload) and then forked,
+# so workers start instantly and share the loaded language profiles / models.
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    # runs in the master after the app was imported, before any fork;
+    # cfg reflects --preload / --no-preload given on the command line too
+    if server.cfg.preload_app:
+        from src import clients
+        clients.warm_up()
+
+
+def post_fork(server, worker):
+    # never reuse sockets opened by the master
+    from src import clients
+    clients.reset()
+
+
+def post_worker_init(worker):
+    if not worker.cfg.preload_app:
+        from src import clients
+        clients.warm_up()
@@ -202,4 +202,540 @@ BEGIN
   LIMIT
     match_count;
 END;
-$$;
\ No newline at end of file
+$$;
+
+-- Step 5: Reduced-dimension embeddings
+-- text-embedding-3 models accept a `dimensions` parameter; shorter vectors are
+-- smaller on disk, on the wire and in every cache. The column is declared without
+-- a fixed size so EMBEDDING_DIMENSIONS can be chosen per deployment (all rows must
+-- use the same size). Migration path for existing rows:
+--   1. run this file (adds the column and RPC, existing data untouched)
+--   2. python -m src.embeddings_ingest --dimensions 512 --from-full
+--      (truncates + re-normalizes the stored 1536-dim vectors, no OpenAI calls)
+--   3. set EMBEDDING_DIMENSIONS=512 so queries use match_listings_reduced
+--   4. optionally, once nothing reads it any more:
+--      ALTER TABLE public.listings_embeddings DROP COLUMN embedding;
+ALTER TABLE public.listings_embeddings ADD COLUMN IF NOT EXISTS embedding_reduced VECTOR;
+
+DROP FUNCTION IF EXISTS match_listings_reduced(vector, float, int);
+CREATE OR REPLACE FUNCTION match_listings_reduced (
+  query_embedding vector,
+  match_threshold float,
+  match_count int
+)
+RETURNS TABLE (
+  id uuid,
+  title text,
+  description text,
+  property_type text,
+  location text,
+  price float,
+  is_bargainable boolean,
+  size_sqm float,
+  floor_number int,
+  year_built int,
+  furnishing text,
+  amenities text[],
+  utilities text,
+  internet_speed text,
+  minimum_lease_duration text,
+  availability_date date,
+  photos text[],
+  video_tour_url text,
+  floor_plan_url text,
+  neighborhood_rating float,
+  renovations text,
+  landlord_id uuid,
+  complex_id uuid,
+  created_at timestamptz,
+  similarity float
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  RETURN QUERY
+  SELECT
+    l.id,
+    l.title,
+    l.description,
+    l.property_type,
+    l.location,
+    l.price,
+    l.is_bargainable,
+    l.size_sqm,
+    l.floor_number,
+    l.year_built,
+    l.furnishing,
+    l.amenities,
+    l.utilities,
+    l.internet_speed,
+    l.minimum_lease_duration,
+    l.availability_date,
+    l.photos,
+    l.video_tour_url,
+    l.floor_plan_url,
+    l.neighborhood_rating,
+    l.renovations,
+    l.landlord_id,
+    l.complex_id,
+    l.created_at,
+    1 - (le.embedding_reduced <=> query_embedding) as similarity
+  FROM
+    listings_embeddings le
+  JOIN
+    listings l ON le.listing_id = l.id
+  WHERE
+    le.embedding_reduced IS NOT NULL
+    AND 1 - (le.embedding_reduced <=> query_embedding) > match_threshold
+  ORDER BY
+    similarity DESC
+  LIMIT
+    match_count;
+END;
+$$;
+
+-- Step 6: Partitioned chat history
+-- chats is range-partitioned by month on created_at, with a composite index on
+-- (user_id, created_at DESC, id DESC) so a user's history is read as a short
+-- index range per partition (see supabase_client.get_chat_page, which pages by
+-- keyset instead of offset). Old months are moved to chats_archive by
+-- archive_chat_partitions(); run it daily with pg_cron (scheduled below when the
+-- extension is enabled) or `python -m src.chat_retention`.
+--
+-- The first run converts an existing unpartitioned chats table in place: it is
+-- renamed to chats_unpartitioned, its rows are copied into the new table, and
+-- it is dropped. Do it in a quiet window; the copy holds a lock on the old table.
+CREATE TABLE IF NOT EXISTS public.chats_archive (
+    id UUID NOT NULL,
+    user_id UUID,
+    user_message TEXT NOT NULL,
+    bot_response TEXT,
+    created_at TIMESTAMPTZ NOT NULL,
+    archived_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS chats_archive_user_created_idx ON public.chats_archive (user_id, created_at DESC);
+
+-- Rows in chats_default: normally 0; anything else means a month's partition
+-- was missing when they were written (see src/chat_retention.py).
+CREATE OR REPLACE FUNCTION chats_default_rows()
+RETURNS bigint
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  n bigint := 0;
+BEGIN
+  IF to_regclass('public.chats_default') IS NOT NULL THEN
+    SELECT count(*) INTO n FROM public.chats_default;
+  END IF;
+  RETURN n;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION ensure_chat_partitions(months_ahead int DEFAULT 2, start_month date DEFAULT NULL)
+RETURNS int
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  m date := date_trunc('month', COALESCE(start_month, NOW()))::date;
+  stop date := (date_trunc('month', NOW()) + make_interval(months => months_ahead + 1))::date;
+  created int := 0;
+  part text;
+  leftover bigint;
+BEGIN
+  WHILE m < stop LOOP
+    part := format('chats_y%sm%s', to_char(m, 'YYYY'), to_char(m, 'MM'));
+    IF to_regclass('public.' || part) IS NULL THEN
+      -- rows for this month may already sit in chats_default (a missed run);
+      -- CREATE ... PARTITION OF would fail on them, so build the table on its
+      -- own, move them in and attach it
+      EXECUTE format('CREATE TABLE public.%I (LIKE public.chats INCLUDING DEFAULTS)', part);
+      IF to_regclass('public.chats_default') IS NOT NULL THEN
+        EXECUTE format(
+          'WITH moved AS (DELETE FROM public.chats_default WHERE created_at >= %L AND created_at < %L
+                          RETURNING id, user_id, user_message, bot_response, created_at)
+           INSERT INTO public.%I (id, user_id, user_message, bot_response, created_at)
+           SELECT id, user_id, user_message, bot_response, created_at FROM moved',
+          m, (m + interval '1 month')::date, part
+        );
+      END IF;
+      EXECUTE format(
+        'ALTER TABLE public.chats ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)',
+        part, m, (m + interval '1 month')::date
+      );
+      EXECUTE format('ALTER TABLE public.%I ENABLE ROW LEVEL SECURITY', part);
+      created := created + 1;
+    END IF;
+    m := (m + interval '1 month')::date;
+  END LOOP;
+  leftover := chats_default_rows();
+  IF leftover > 0 THEN
+    RAISE WARNING 'chats_default holds % rows outside the monthly partitions', leftover;
+  END IF;
+  RETURN created;
+END;
+$$;
+
+DO $$
+DECLARE
+  oldest date;
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+             WHERE c.relname = 'chats' AND c.relnamespace = 'public'::regnamespace) THEN
+    RETURN;
+  END IF;
+
+  IF to_regclass('public.chats') IS NOT NULL THEN
+    ALTER TABLE public.chats RENAME TO chats_unpartitioned;
+    -- free the index name for the new table's primary key
+    IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'chats_pkey'
+               AND conrelid = 'public.chats_unpartitioned'::regclass) THEN
+      ALTER TABLE public.chats_unpartitioned RENAME CONSTRAINT chats_pkey TO chats_unpartitioned_pkey;
+    END IF;
+  END IF;
+
+  CREATE TABLE public.chats (
+      id UUID NOT NULL DEFAULT uuid_generate_v4(),
+      user_id UUID REFERENCES public.users(id) ON DELETE CASCADE,
+      user_message TEXT NOT NULL,
+      bot_response TEXT,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+      PRIMARY KEY (created_at, id)
+  ) PARTITION BY RANGE (created_at);
+  -- rows outside every monthly partition (clock skew, backfills) land here
+  CREATE TABLE public.chats_default PARTITION OF public.chats DEFAULT;
+
+  IF to_regclass('public.chats_unpartitioned') IS NOT NULL THEN
+    SELECT date_trunc('month', MIN(created_at))::date INTO oldest FROM public.chats_unpartitioned;
+    PERFORM ensure_chat_partitions(2, oldest);
+    INSERT INTO public.chats (id, user_id, user_message, bot_response, created_at)
+      SELECT id, user_id, user_message, bot_response, COALESCE(created_at, NOW()) FROM public.chats_unpartitioned;
+    DROP TABLE public.chats_unpartitioned;
+  ELSE
+    PERFORM ensure_chat_partitions(2);
+  END IF;
+END;
+$$;
+
+-- created on the parent, so every current and future partition gets it
+CREATE INDEX IF NOT EXISTS chats_user_created_idx ON public.chats (user_id, created_at DESC, id DESC);
+
+ALTER TABLE public.chats ENABLE ROW LEVEL SECURITY;
+ALTER TABLE public.chats_default ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Enable all access for service_role on chats" ON public.chats;
+CREATE POLICY "Enable all access for service_role on chats" ON public.chats FOR ALL USING (true);
+
+ALTER TABLE public.chats_archive ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Deny all access to chats archive." ON public.chats_archive;
+CREATE POLICY "Deny all access to chats archive." ON public.chats_archive FOR ALL USING (false);
+
+-- Moves monthly partitions that ended more than retain_months ago into
+-- chats_archive (or drops them when archive is false) and makes sure the next
+-- months exist. Returns the number of partitions retired.
+CREATE OR REPLACE FUNCTION archive_chat_partitions(retain_months int DEFAULT 12, archive boolean DEFAULT true)
+RETURNS int
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  cutoff date := (date_trunc('month', NOW()) - make_interval(months => retain_months))::date;
+  part record;
+  retired int := 0;
+BEGIN
+  FOR part IN
+    SELECT c.relname AS name,
+           make_date(substring(c.relname FROM 'chats_y(\d{4})m')::int,
+                     substring(c.relname FROM 'chats_y\d{4}m(\d{2})')::int, 1) AS month
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'public.chats'::regclass AND c.relname ~ '^chats_y\d{4}m\d{2}$'
+  LOOP
+    IF (part.month + interval '1 month')::date <= cutoff THEN
+      EXECUTE format('ALTER TABLE public.chats DETACH PARTITION public.%I', part.name);
+      IF archive THEN
+        EXECUTE format(
+          'INSERT INTO public.chats_archive (id, user_id, user_message, bot_response, created_at)
+           SELECT id, user_id, user_message, bot_response, created_at FROM public.%I', part.name);
+      END IF;
+      EXECUTE format('DROP TABLE public.%I', part.name);
+      retired := retired + 1;
+    END IF;
+  END LOOP;
+  PERFORM ensure_chat_partitions(2);
+  RETURN retired;
+END;
+$$;
+
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_cron') THEN
+    PERFORM cron.schedule('rina-chat-retention', '15 3 * * *', 'SELECT archive_chat_partitions(12, true)');
+  END IF;
+END;
+$$;
+
+-- Step 7: Landlord portfolio
+-- Units inside a complex (optionally advertised as a listing). get_units in
+-- supabase_client has always queried this table; it was never created here.
+CREATE TABLE IF NOT EXISTS public.units (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    complex_id UUID NOT NULL REFERENCES public.complexes(id) ON DELETE CASCADE,
+    listing_id UUID REFERENCES public.listings(id) ON DELETE SET NULL,
+    label TEXT NOT NULL,
+    unit_type TEXT,
+    rent FLOAT,
+    status TEXT DEFAULT 'vacant',
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+ALTER TABLE public.units ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Enable all access for service_role on units" ON public.units;
+CREATE POLICY "Enable all access for service_role on units" ON public.units FOR ALL USING (true);
+
+CREATE INDEX IF NOT EXISTS complexes_landlord_idx ON public.complexes (landlord_id);
+CREATE INDEX IF NOT EXISTS units_complex_idx ON public.units (complex_id);
+CREATE INDEX IF NOT EXISTS listings_complex_idx ON public.listings (complex_id);
+CREATE INDEX IF NOT EXISTS listings_landlord_idx ON public.listings (landlord_id);
+CREATE INDEX IF NOT EXISTS landlords_contact_digits_idx ON public.landlords ((regexp_replace(contact_number, '\D', '', 'g')));
+
+-- Everything a landlord sees about their properties in one round trip:
+-- complexes with nested units and listing counts, plus listings not in any
+-- complex. The landlord is found from a phone number (WhatsApp user key or
+-- +254... form) through users.phone_number or landlords.contact_number.
+-- Returns {"landlord_id": null, ...} for numbers that are not landlords.
+CREATE OR REPLACE FUNCTION landlord_portfolio(p_phone text)
+RETURNS jsonb
+LANGUAGE sql
+STABLE
+AS $$
+  WITH digits AS (
+    SELECT regexp_replace(p_phone, '\D', '', 'g') AS d
+  ),
+  landlord AS (
+    SELECT l.id
+    FROM public.landlords l
+    LEFT JOIN public.users u ON u.id = l.user_id
+    WHERE u.phone_number = p_phone
+       OR regexp_replace(l.contact_number, '\D', '', 'g') = (SELECT d FROM digits)
+    ORDER BY (u.phone_number = p_phone) DESC NULLS LAST
+    LIMIT 1
+  )
+  SELECT jsonb_build_object(
+    'landlord_id', (SELECT id FROM landlord),
+    'complexes', COALESCE((
+      SELECT jsonb_agg(jsonb_build_object(
+               'id', c.id,
+               'name', c.name,
+               'location', c.location,
+               'listing_count', (SELECT count(*) FROM public.listings li WHERE li.complex_id = c.id),
+               'units', COALESCE((
+                 SELECT jsonb_agg(jsonb_build_object(
+                          'id', un.id, 'label', un.label, 'unit_type', un.unit_type,
+                          'rent', un.rent, 'status', un.status, 'listing_id', un.listing_id
+                        ) ORDER BY un.label)
+                 FROM public.units un WHERE un.complex_id = c.id
+               ), '[]'::jsonb)
+             ) ORDER BY c.name)
+      FROM public.complexes c
+      WHERE c.landlord_id = (SELECT id FROM landlord)
+    ), '[]'::jsonb),
+    'unassigned_listing_count', (
+      SELECT count(*) FROM public.listings li
+      WHERE li.landlord_id = (SELECT id FROM landlord) AND li.complex_id IS NULL
+    )
+  );
+$$;
+
+-- Step 8: Saved-search alerts
+-- "notify me" stores the user's query with its slots and embedding; new
+-- listings are matched against active searches in the app (saved_searches.py)
+-- and each (search, listing) pair is recorded once so alerts never repeat.
+CREATE TABLE IF NOT EXISTS public.saved_searches (
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  user_id UUID REFERENCES public.users(id) ON DELETE CASCADE,
+  phone TEXT NOT NULL,
+  query TEXT NOT NULL,
+  location TEXT,
+  property_type TEXT,
+  max_price NUMERIC,
+  embedding VECTOR,  -- any size: EMBEDDING_DIMENSIONS may reduce it
+  active BOOLEAN NOT NULL DEFAULT true,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS saved_searches_active_idx
+  ON public.saved_searches (created_at, id) WHERE active;
+CREATE INDEX IF NOT EXISTS saved_searches_phone_idx
+  ON public.saved_searches (phone) WHERE active;
+
+CREATE TABLE IF NOT EXISTS public.saved_search_matches (
+  saved_search_id UUID NOT NULL REFERENCES public.saved_searches(id) ON DELETE CASCADE,
+  listing_id UUID NOT NULL REFERENCES public.listings(id) ON DELETE CASCADE,
+  notified_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (saved_search_id, listing_id)
+);
+
+ALTER TABLE public.saved_searches ENABLE ROW LEVEL SECURITY;
+ALTER TABLE public.saved_search_matches ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Enable all access for service_role on saved_searches" ON public.saved_searches;
+CREATE POLICY "Enable all access for service_role on saved_searches" ON public.saved_searches FOR ALL USING (true);
+DROP POLICY IF EXISTS "Enable all access for service_role on saved_search_matches" ON public.saved_search_matches;
+CREATE POLICY "Enable all access for service_role on saved_search_matches" ON public.saved_search_matches FOR ALL USING (true);
+
+-- Step 9: Listing coordinates
+-- Listings are geocoded at ingest against the bundled gazetteer (src/gazetteer.json)
+-- and kept in an in-memory grid index (src/geo_index.py). "near <campus>" searches
+-- take the listing IDs within the radius from that index and only score those
+-- with match_listings_in, instead of ranking the whole table by similarity.
+-- Existing rows: python -m src.geo_index --backfill
+ALTER TABLE public.listings ADD COLUMN IF NOT EXISTS latitude FLOAT;
+ALTER TABLE public.listings ADD COLUMN IF NOT EXISTS longitude FLOAT;
+ALTER TABLE public.listings ADD COLUMN IF NOT EXISTS geo_place TEXT;
+
+DROP FUNCTION IF EXISTS match_listings_in(vector, uuid[], float, int, boolean);
+CREATE OR REPLACE FUNCTION match_listings_in (
+  query_embedding vector,
+  candidate_ids uuid[],
+  match_threshold float,
+  match_count int,
+  reduced boolean DEFAULT false
+)
+RETURNS TABLE (
+  id uuid,
+  title text,
+  description text,
+  property_type text,
+  location text,
+  price float,
+  is_bargainable boolean,
+  size_sqm float,
+  floor_number int,
+  year_built int,
+  furnishing text,
+  amenities text[],
+  utilities text,
+  internet_speed text,
+  minimum_lease_duration text,
+  availability_date date,
+  photos text[],
+  video_tour_url text,
+  floor_plan_url text,
+  neighborhood_rating float,
+  renovations text,
+  landlord_id uuid,
+  complex_id uuid,
+  created_at timestamptz,
+  similarity float
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  RETURN QUERY
+  SELECT * FROM (
+    SELECT
+      l.id,
+      l.title,
+      l.description,
+      l.property_type,
+      l.location,
+      l.price,
+      l.is_bargainable,
+      l.size_sqm,
+      l.floor_number,
+      l.year_built,
+      l.furnishing,
+      l.amenities,
+      l.utilities,
+      l.internet_speed,
+      l.minimum_lease_duration,
+      l.availability_date,
+      l.photos,
+      l.video_tour_url,
+      l.floor_plan_url,
+      l.neighborhood_rating,
+      l.renovations,
+      l.landlord_id,
+      l.complex_id,
+      l.created_at,
+      1 - ((CASE WHEN reduced THEN le.embedding_reduced ELSE le.embedding END) <=> query_embedding) AS similarity
+    FROM
+      listings_embeddings le
+    JOIN
+      listings l ON le.listing_id = l.id
+    WHERE
+      le.listing_id = ANY(candidate_ids)
+  ) scored
+  WHERE
+    scored.similarity > match_threshold
+  ORDER BY
+    scored.similarity DESC
+  LIMIT
+    match_count;
+END;
+$$;
+
+-- Step 10: Listing photos from WhatsApp
+-- Photos a landlord sends are stored in the public listing-photos bucket under
+-- their sha256 (thumbnails under thumbs/) by the media workers (src/media.py),
+-- which then append the URLs to listings.photos in batches.
+INSERT INTO storage.buckets (id, name, public)
+VALUES ('listing-photos', 'listing-photos', true)
+ON CONFLICT (id) DO NOTHING;
+
+-- the sender's listing to attach photos to: the given one if they own it,
+-- else their most recent listing. The landlord is matched like in
+-- landlord_portfolio: users.phone_number or the digits of contact_number
+-- (landlords created by the admin endpoint or the seed script have no user).
+CREATE OR REPLACE FUNCTION media_target_listing(p_phone text, p_listing_id uuid DEFAULT NULL)
+RETURNS uuid
+LANGUAGE sql
+STABLE
+AS $$
+  WITH digits AS (
+    SELECT regexp_replace(p_phone, '\D', '', 'g') AS d
+  ),
+  landlord AS (
+    SELECT ld.id
+    FROM public.landlords ld
+    LEFT JOIN public.users u ON u.id = ld.user_id
+    WHERE u.phone_number = p_phone
+       OR regexp_replace(ld.contact_number, '\D', '', 'g') = (SELECT d FROM digits)
+  )
+  SELECT l.id
+  FROM public.listings l
+  WHERE l.landlord_id IN (SELECT id FROM landlord)
+    AND (p_listing_id IS NULL OR l.id = p_listing_id)
+  ORDER BY l.created_at DESC
+  LIMIT 1;
+$$;
+
+-- p_items: [{"listing_id", "url"}, ...]; URLs a listing already has are
+-- skipped, so retried batches and resent photos don't duplicate. Returns the
+-- number of listings updated.
+CREATE OR REPLACE FUNCTION append_listing_photos(p_items jsonb)
+RETURNS int
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  updated int;
+BEGIN
+  WITH items AS (
+    SELECT (item->>'listing_id')::uuid AS listing_id, item->>'url' AS url, ord
+    FROM jsonb_array_elements(p_items) WITH ORDINALITY AS t(item, ord)
+  ),
+  fresh AS (
+    SELECT i.listing_id, i.url, min(i.ord) AS ord
+    FROM items i
+    JOIN public.listings l ON l.id = i.listing_id
+    WHERE NOT (i.url = ANY(coalesce(l.photos, '{}')))
+    GROUP BY i.listing_id, i.url
+  ),
+  grouped AS (
+    SELECT listing_id, array_agg(url ORDER BY ord) AS urls
+    FROM fresh
+    GROUP BY listing_id
+  )
+  UPDATE public.listings l
+  SET photos = coalesce(l.photos, '{}') || g.urls
+  FROM grouped g
+  WHERE l.id = g.listing_id;
+  GET DIAGNOSTICS updated = ROW_COUNT;
+  RETURN updated;
+END;
+$$;
@@ -1,11 +1,30 @@
 
 
 _all_ = [
+    "admission",
+    "asgi",
+    "async_supabase_client",
+    "auth",
+    "chat_retention",
     "chat_service",
+    "clients",
+    "coalescer",
+    "gazetteer",
+    "geo_index",
+    "idempotency",
     "intent_classifier",
+    "listing_ids",
+    "media",
+    "profiling",
+    "quantization",
     "ratelimiter",
     "reranker",
+    "resilience",
+    "saved_searches",
     "seed_listings",
+    "semantic_cache",
+    "slots",
     "supabase_client",
+    "trace_analytics",
     "webhook_handler",
 ]
\ No newline at end of file
@@ -0,0 +1,217 @@
+import contextvars
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from . import clients
+from .resilience import BREAKERS, REQUEST_BUDGET_SECONDS, LatencyTracker
+
+# Load-aware admission control for get_bot_response. Every message is admitted
+# at a degradation tier picked from the current load, so a traffic spike makes
+# answers a little cheaper for everyone instead of timing everyone out:
+#
+#   0 FULL            normal pipeline
+#   1 NO_LLM_FALLBACK off-topic questions get a canned reply, no LLM answer
+#   2 LOCAL_INTENT    no understanding completion (local model / keywords)
+#   3 CACHED_SEARCH   searches are answered from recent results only
+#   4 SHED            "busy, retry shortly" without doing any work
+#
+# Load is the largest of: messages in flight / capacity, recent OpenAI p95 / OPENAI_TARGET_SECONDS
+# and recent request p95 / REQUEST_TARGET_SECONDS; an open OpenAI circuit
+# puts load at the LOCAL_INTENT threshold at least. The tier rises as soon as
+# load crosses a threshold and falls one step at a time once load has stayed
+# below it for STEP_DOWN_SECONDS, so it doesn't flap.
+#
+# Capacity depends on the serving mode. A sync gunicorn worker holds one
+# message at a time, so messages are counted across workers in Redis against
+# CAPACITY, which defaults to the worker count (WEB_CONCURRENCY). That count
+# can't exceed the workers, and messages waiting in gunicorn's backlog don't
+# show in it, so every worker busy only reaches the NO_LLM_FALLBACK threshold
+# and the higher tiers come from the latency signals. Without Redis a
+# sync worker can't see the others, and only the latency signals apply. An
+# ASGI worker holds many messages and counts them locally against
+# ASYNC_CAPACITY, where load past 1.0 is real overload.
+ENABLED = os.getenv("RINA_ADMISSION", "1") == "1"
+CAPACITY = int(os.getenv("RINA_ADMISSION_CAPACITY") or os.getenv("WEB_CONCURRENCY") or 2)
+ASYNC_CAPACITY = int(os.getenv("RINA_ADMISSION_ASYNC_CAPACITY", 16))
+THRESHOLDS = [float(x) for x in os.getenv("RINA_TIER_THRESHOLDS", "0.7,0.85,1.0,1.3").split(",")]
+OPENAI_TARGET_SECONDS = float(os.getenv("RINA_OPENAI_TARGET_SECONDS", 4.0))
+REQUEST_TARGET_SECONDS = float(os.getenv("RINA_REQUEST_TARGET_SECONDS", REQUEST_BUDGET_SECONDS / 2))
+LATENCY_WINDOW_SECONDS = 30.0
+STEP_DOWN_SECONDS = 10.0
+INFLIGHT_KEY = "admission:inflight"
+
+FULL, NO_LLM_FALLBACK, LOCAL_INTENT, CACHED_SEARCH, SHED = range(5)
+TIER_NAMES = ["full", "no_llm_fallback", "local_intent", "cached_search", "shed"]
+
+_tier: contextvars.ContextVar = contextvars.ContextVar("rina_tier", default=FULL)
+
+
+def current_tier() -> int:
+    """Tier the current message was admitted at (FULL outside admission)."""
+    return _tier.get()
+
+
+def tier_for(load: float) -> int:
+    return sum(1 for t in THRESHOLDS if load >= t)
+
+
+class AdmissionController:
+    def __init__(self, capacity: int = CAPACITY, async_capacity: int = ASYNC_CAPACITY):
+        self.capacity = capacity
+        self.async_capacity = async_capacity
+        self.latency = LatencyTracker(500)
+        self.tier = FULL
+        self._in_flight = 0
+        self._calm_since: Optional[float] = None
+        self._lock = threading.Lock()
+        self.admitted: List[int] = [0] * len(TIER_NAMES)
+        self.switches: Dict[str, int] = {}
+        self.last_load = 0.0
+
+    # in-flight messages: across sync workers in a Redis sorted set (entries
+    # older than the request budget are dropped, so a killed worker can't leak
+    # them); locally for the ASGI app
+    def _enter(self, shared: bool) -> Optional[str]:
+        with self._lock:
+            self._in_flight += 1
+        redis_client = clients.redis_client() if shared else None
+        if redis_client is None:
+            return None
+        member, now = uuid.uuid4().hex, time.time()
+        try:
+            with redis_client.pipeline() as pipe:
+                pipe.zremrangebyscore(INFLIGHT_KEY, 0, now - REQUEST_BUDGET_SECONDS * 2)
+                pipe.zadd(INFLIGHT_KEY, {member: now})
+                pipe.expire(INFLIGHT_KEY, int(REQUEST_BUDGET_SECONDS * 4))
+                pipe.execute()
+            return member
+        except Exception as e:
+            print(f"Admission in-flight tracking error: {e}")
+            return None
+
+    def _exit(self, member: Optional[str]):
+        with self._lock:
+            self._in_flight -= 1
+        if member is not None:
+            try:
+                clients.redis_client().zrem(INFLIGHT_KEY, member)
+            except Exception as e:
+                print(f"Admission in-flight tracking error: {e}")
+
+    def in_flight_load(self, shared: bool = True) -> Optional[float]:
+        """Messages in flight / capacity, at most the first threshold for sync
+        workers; None when it can't be known (sync without Redis)."""
+        if not shared:
+            return self._in_flight / max(self.async_capacity, 1)
+        redis_client = clients.redis_client()
+        if redis_client is None:
+            return None
+        try:
+            busy = min(int(redis_client.zcard(INFLIGHT_KEY)) / max(self.capacity, 1), 1.0)
+            return busy * THRESHOLDS[NO_LLM_FALLBACK - 1]
+        except Exception:
+            return None
+
+    def load(self, in_flight_load: Optional[float]) -> float:
+        signals = [in_flight_load or 0.0]
+        if BREAKERS["openai"].state == "open":
+            signals.append(THRESHOLDS[LOCAL_INTENT - 1])
+        openai_p95 = BREAKERS["openai"].latency.percentile(95, max_age=LATENCY_WINDOW_SECONDS)
+        if openai_p95 is not None:
+            signals.append(openai_p95 / OPENAI_TARGET_SECONDS)
+        request_p95 = self.latency.percentile(95, max_age=LATENCY_WINDOW_SECONDS)
+        if request_p95 is not None:
+            signals.append(request_p95 / REQUEST_TARGET_SECONDS)
+        return max(signals)
+
+    def _update_tier(self, load: float) -> int:
+        target = tier_for(load)
+        with self._lock:
+            self.last_load = load
+            previous = self.tier
+            if target >= self.tier:
+                self._calm_since = None
+                self.tier = target
+            elif self._calm_since is None:
+                self._calm_since = time.monotonic()
+            elif time.monotonic() - self._calm_since >= STEP_DOWN_SECONDS:
+                self.tier -= 1
+                self._calm_since = time.monotonic()
+            tier = self.tier
+            if tier != previous:
+                name = f"{TIER_NAMES[previous]}->{TIER_NAMES[tier]}"
+                self.switches[name] = self.switches.get(name, 0) + 1
+        if tier != previous:
+            print(f"Admission tier {TIER_NAMES[previous]} -> {TIER_NAMES[tier]} (load {load:.2f})")
+        return tier
+
+    @contextmanager
+    def admit(self, shared: bool = True):
+        """Counts the message as in flight and yields the tier it runs at."""
+        member = self._enter(shared)
+        tier = self._update_tier(self.load(self.in_flight_load(shared)))
+        with self._lock:
+            self.admitted[tier] += 1
+        token = _tier.set(tier)
+        started = time.monotonic()
+        try:
+            yield tier
+        finally:
+            _tier.reset(token)
+            if tier < SHED:
+                # shed replies take no time and would make load look lower
+                self.latency.record(time.monotonic() - started)
+            self._exit(member)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                "tier": TIER_NAMES[self.tier],
+                "tier_level": self.tier,
+                "load": round(self.last_load, 3),
+                "in_flight_local": self._in_flight,
+                "capacity": self.capacity,
+                "async_capacity": self.async_capacity,
+                "admitted": dict(zip(TIER_NAMES, self.admitted)),
+                "tier_switches": dict(self.switches),
+            }
+
+
+CONTROLLER = AdmissionController()
+
+
+@contextmanager
+def admitted(shared: bool = True):
+    """`with admitted() as tier:` around a message; FULL when disabled.
+    shared=False (ASGI) keeps Redis calls off the event loop."""
+    if not ENABLED:
+        yield FULL
+        return
+    with CONTROLLER.admit(shared) as tier:
+        yield tier
+
+
+def prometheus_metrics() -> str:
+    """Admission and circuit-breaker state in the Prometheus text format."""
+    m = CONTROLLER.metrics()
+    lines = [
+        "# TYPE rina_admission_tier gauge",
+        f"rina_admission_tier {m['tier_level']}",
+        "# TYPE rina_admission_load gauge",
+        f"rina_admission_load {m['load']}",
+        "# TYPE rina_admission_in_flight gauge",
+        f"rina_admission_in_flight {m['in_flight_local']}",
+        "# TYPE rina_admission_admitted_total counter",
+    ]
+    lines += [f'rina_admission_admitted_total{{tier="{name}"}} {count}' for name, count in m["admitted"].items()]
+    lines.append("# TYPE rina_admission_tier_switches_total counter")
+    for switch, count in sorted(m["tier_switches"].items()):
+        src, dst = switch.split("->")
+        lines.append(f'rina_admission_tier_switches_total{{from="{src}",to="{dst}"}} {count}')
+    lines.append("# TYPE rina_circuit_open gauge")
+    lines += [f'rina_circuit_open{{dependency="{name}"}} {int(b.state != "closed")}' for name, b in BREAKERS.items()]
+    return "\n".join(lines) + "\n"
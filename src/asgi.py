@@ -0,0 +1,183 @@
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from twilio.twiml.messaging_response import MessagingResponse
+
+from . import clients
+from . import async_supabase_client as asb
+from . import idempotency, media
+from .auth import averify_token
+from .chat_service import get_bot_response_async
+from .coalescer import acoalesce
+from .resilience import REQUEST_BUDGET_SECONDS, deadline
+from .tracing import finish_trace
+from .webhook_handler import (
+    app as flask_app,
+    ALLOWED_ORIGINS,
+    PRODUCTION,
+    validator,
+    _start_chat_trace,
+    _critique_chat_trace,
+)
+
+# ASGI serving mode:
+#
+#     gunicorn -k uvicorn.workers.UvicornWorker src.asgi:app
+#
+# /webhook and /api/chat run the async pipeline (get_bot_response_async) so a
+# worker holds many conversations while they wait on OpenAI/Supabase. Every
+# other route (and CORS preflight) is served by the existing Flask app through
+# a WSGI adapter, so the sync API keeps working unchanged.
+logger = logging.getLogger("rina.asgi")
+
+_flask = WsgiToAsgi(flask_app)
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    more = True
+    while more:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+def _headers(scope) -> Dict[str, str]:
+    return {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+
+
+def _request_url(scope, headers: Dict[str, str]) -> str:
+    # same URL Flask's request.url would give Twilio's validator
+    scheme = headers.get("x-forwarded-proto", scope.get("scheme", "http"))
+    host = headers.get("host", "")
+    url = f"{scheme}://{host}{scope.get('root_path', '')}{scope['path']}"
+    query = scope.get("query_string", b"").decode("latin-1")
+    return f"{url}?{query}" if query else url
+
+
+def _cors_headers(headers: Dict[str, str]) -> List[Tuple[bytes, bytes]]:
+    origin = headers.get("origin")
+    if not origin or origin not in ALLOWED_ORIGINS:
+        return []
+    return [
+        (b"access-control-allow-origin", origin.encode("latin-1")),
+        (b"access-control-allow-credentials", b"true"),
+        (b"vary", b"Origin"),
+    ]
+
+
+async def _respond(send, status: int, body: bytes, content_type: str, extra_headers: Optional[List[Tuple[bytes, bytes]]] = None):
+    headers = [(b"content-type", content_type.encode("latin-1")), (b"content-length", str(len(body)).encode())]
+    headers.extend(extra_headers or [])
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _respond_json(send, status: int, payload, request_headers: Dict[str, str]):
+    await _respond(send, status, json.dumps(payload).encode("utf-8"), "application/json", _cors_headers(request_headers))
+
+
+def _twiml(reply: str) -> bytes:
+    twiml = MessagingResponse()
+    twiml.message(reply)
+    return str(twiml).encode("utf-8")
+
+
+async def twilio_webhook(scope, receive, send):
+    """Async twin of webhook_handler.twilio_webhook."""
+    headers = _headers(scope)
+    form = dict(parse_qsl((await _read_body(receive)).decode("utf-8"), keep_blank_values=True))
+    if PRODUCTION and validator:
+        sig = headers.get("x-twilio-signature", "")
+        if not validator.validate(_request_url(scope, headers), form, sig):
+            return await _respond(send, 403, b"Invalid signature", "text/plain")
+
+    values = {**dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"))), **form}
+    try:
+        sender = values.get("From", "").strip().replace("whatsapp:", "")
+        body = values.get("Body", "").strip()
+        user_key = f"whatsapp:{sender.lstrip('+')}" or "anon"
+
+        async def handle() -> str:
+            media_reply = media.webhook_reply(values, user_key)  # only queues, never blocks
+            if media_reply is not None:
+                return _twiml(media_reply).decode("utf-8")
+            text = await acoalesce(user_key, body)
+            if text is None:
+                return str(MessagingResponse())
+            reply = await get_bot_response_async(text, user_id=user_key)
+            return _twiml(reply).decode("utf-8")
+
+        twiml = await idempotency.aonce(values.get("MessageSid", ""), handle)
+        await _respond(send, 200, twiml.encode("utf-8"), "text/xml")
+    except idempotency.StillProcessing:
+        await _respond(send, 503, b"Still processing this message", "text/plain", [(b"retry-after", b"5")])
+    except Exception:
+        logger.exception("Error in webhook")
+        await _respond(send, 200, _twiml("Sorry, something went wrong. Try again later."), "text/xml")
+
+
+async def chat_api(scope, receive, send):
+    """Async twin of webhook_handler.chat_api."""
+    headers = _headers(scope)
+    auth_header = headers.get("authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        return await _respond_json(send, 401, {"error": "Unauthorized"}, headers)
+
+    jwt = auth_header.split(" ")[1]
+    try:
+        user_id = await averify_token(jwt)
+    except Exception as e:
+        return await _respond_json(send, 401, {"error": f"Unauthorized: {e}"}, headers)
+
+    try:
+        data = json.loads(await _read_body(receive) or b"null")
+    except ValueError:
+        data = None
+    if not data or "message" not in data:
+        return await _respond_json(send, 400, {"error": "Invalid data"}, headers)
+
+    user_message = data["message"]
+    try:
+        trace = _start_chat_trace(user_id, user_message)
+        bot_response = await get_bot_response_async(user_message, user_id=user_id)
+        _critique_chat_trace(trace, bot_response)
+
+        snapshot = finish_trace(trace, {"reply_preview": bot_response[:200]})
+        await asb.save_trace_snapshot(snapshot)
+        await _respond_json(send, 200, {"reply": bot_response}, headers)
+    except Exception:
+        logger.exception("Error in chat API")
+        await _respond_json(send, 500, {"error": "Sorry, something went wrong."}, headers)
+
+
+ROUTES = {
+    "/webhook": twilio_webhook,
+    "/api/chat": chat_api,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await clients.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    handler = ROUTES.get(scope.get("path")) if scope["type"] == "http" and scope.get("method") == "POST" else None
+    if handler is None:
+        return await _flask(scope, receive, send)
+    # the budget starts when the request arrives, so coalescing waits count too
+    with deadline(REQUEST_BUDGET_SECONDS):
+        await handler(scope, receive, send)
@@ -0,0 +1,126 @@
+import time
+from typing import Optional, List, Dict, Any
+
+from . import clients
+from .resilience import breaker, stage_timeout
+from .supabase_client import REST_URL, SUPABASE_URL, SERVICE_KEY, HEADERS, POST_HEADERS, REQUEST_TIMEOUT, USER_ID_CACHE
+
+# Async twins of the supabase_client helpers used on the request path. All
+# calls go through the shared, pooled httpx.AsyncClient from clients.py.
+
+
+async def _send(method: str, url: str, **kwargs):
+    """Async twin of supabase_client._send (request budget + circuit breaker)."""
+    kwargs["timeout"] = stage_timeout(kwargs.get("timeout", REQUEST_TIMEOUT))
+    b = breaker("supabase")
+    b.check()
+    started = time.monotonic()
+    try:
+        resp = await clients.async_http_client().request(method, url, **kwargs)
+    except Exception:
+        b.record_failure()
+        raise
+    if resp.status_code >= 500:
+        b.record_failure()
+    else:
+        b.record_success(time.monotonic() - started)
+    return resp
+
+
+async def _get(url: str, **kwargs):
+    return await _send("GET", url, **kwargs)
+
+
+async def _post(url: str, **kwargs):
+    return await _send("POST", url, **kwargs)
+
+
+def _raise_for_resp(resp):
+    if resp.status_code >= 400:
+        # include snippet of body for debugging
+        text = resp.text.strip()
+        raise RuntimeError(f"Supabase REST error {resp.status_code}: {text[:2000]}")
+
+
+async def _get_or_create_user(phone_number: str) -> str:
+    """Map a WhatsApp phone number to a Supabase users table id. Create if missing."""
+    cached = USER_ID_CACHE.get(phone_number)
+    if cached:
+        return cached
+    upsert_headers = POST_HEADERS.copy()
+    upsert_headers["Prefer"] = "return=representation,resolution=merge-duplicates"
+    resp = await _post(
+        f"{REST_URL}/users",
+        json={"phone_number": phone_number},
+        params={"on_conflict": "phone_number", "select": "id"},
+        headers=upsert_headers,
+    )
+    _raise_for_resp(resp)
+    data = resp.json()
+    if isinstance(data, list) and data:
+        USER_ID_CACHE.put(phone_number, data[0]["id"])
+        return data[0]["id"]
+    raise RuntimeError("Failed to get or create user")
+
+
+async def save_chat(user_phone: str, user_message: str, bot_response: str) -> Optional[List[Dict[str, Any]]]:
+    if user_phone == "anon":
+        return None
+    user_id = await _get_or_create_user(user_phone)
+    body = {
+        "user_id": user_id,
+        "user_message": user_message,
+        "bot_response": bot_response,
+    }
+    resp = await _post(f"{REST_URL}/chats", json=body, headers=POST_HEADERS)
+    _raise_for_resp(resp)
+    try:
+        return resp.json()
+    except Exception:
+        return None
+
+
+async def save_listing_to_favorites(user_phone: str, listing_id: str):
+    user_app_id = await _get_or_create_user(user_phone)
+    body = {"user_id": user_app_id, "listing_id": listing_id}
+    resp = await _post(f"{REST_URL}/favorites", json=body, headers=POST_HEADERS)
+    _raise_for_resp(resp)
+    return resp.json()
+
+
+async def create_inquiry(user_phone: str, listing_id: str, message: str):
+    user_app_id = await _get_or_create_user(user_phone)
+    body = {
+        "listing_id": listing_id,
+        "user_id": user_app_id,
+        "message": message
+    }
+    resp = await _post(f"{REST_URL}/inquiries", json=body, headers=POST_HEADERS)
+    _raise_for_resp(resp)
+    return resp.json()
+
+
+async def get_auth_user_id(jwt: str) -> Optional[str]:
+    """Resolve a Supabase access token to the auth user id via GoTrue (/auth/v1/user)."""
+    resp = await _get(
+        f"{SUPABASE_URL.rstrip('/')}/auth/v1/user",
+        headers={"apikey": SERVICE_KEY, "Authorization": f"Bearer {jwt}"},
+    )
+    if resp.status_code in (401, 403):
+        return None
+    _raise_for_resp(resp)
+    return (resp.json() or {}).get("id")
+
+
+async def save_trace_snapshot(snapshot: Dict[str, Any]):
+    """Async variant of supabase_client.save_trace_snapshot; never raises."""
+    try:
+        resp = await _post(f"{REST_URL}/agent_traces", json={"payload": snapshot}, headers=POST_HEADERS)
+        # allow 404 if table doesn't exist
+        if resp.status_code == 404:
+            return None
+        _raise_for_resp(resp)
+        return resp.json()
+    except Exception:
+        # swallow errors so chat flow never breaks
+        return None
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import jwt
+import requests
+
+from . import clients
+
+# Local verification of Supabase access tokens for /api/chat. Tokens are
+# checked in-process (signature, expiry, audience) against the project's JWT
+# secret (HS256) or its JWKS (asymmetric signing keys), and verified tokens are
+# cached until they expire. The remote GoTrue lookup is only used when local
+# verification is not possible (no secret, JWKS unreachable, unknown key) and
+# AUTH_REMOTE_FALLBACK is enabled.
+SUPABASE_URL = (os.getenv("SUPABASE_URL") or "").rstrip("/")
+JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET", "")
+JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+JWKS_URL = os.getenv("SUPABASE_JWKS_URL") or (f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json" if SUPABASE_URL else "")
+JWKS_REFRESH_SECONDS = float(os.getenv("SUPABASE_JWKS_REFRESH_SECONDS", 600))
+JWKS_MIN_REFRESH_SECONDS = 30.0  # floor between refreshes triggered by unknown key ids
+REMOTE_FALLBACK = os.getenv("AUTH_REMOTE_FALLBACK", "1") == "1"
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", 10000))
+LEEWAY_SECONDS = 5
+ASYMMETRIC_ALGORITHMS = ["RS256", "ES256", "EdDSA"]
+
+
+class AuthError(Exception):
+    """The token was checked and rejected (bad signature, expired, wrong audience...)."""
+
+
+class _LocalUnavailable(Exception):
+    """The token could not be checked locally; the remote fallback may decide."""
+
+
+class _TokenCache:
+    """token hash -> (user_id, exp); entries never outlive the token itself."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> Optional[str]:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user_id, exp = entry
+            if exp <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user_id
+
+    def put(self, token: str, user_id: str, exp: float):
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (user_id, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+TOKEN_CACHE = _TokenCache(TOKEN_CACHE_SIZE)
+
+_jwks_lock = threading.Lock()
+_jwks_keys: Dict[str, object] = {}
+_jwks_fetched_at = 0.0
+
+
+def _jwks_stale() -> bool:
+    return bool(JWKS_URL) and time.time() - _jwks_fetched_at > JWKS_REFRESH_SECONDS
+
+
+def _refresh_jwks(force: bool = False):
+    """Fetch the signing keys. Failures keep the previous key set."""
+    global _jwks_keys, _jwks_fetched_at
+    if not JWKS_URL:
+        return
+    with _jwks_lock:
+        if not force and not _jwks_stale():
+            return
+        # even on failure, wait a full period before retrying
+        _jwks_fetched_at = time.time()
+        try:
+            resp = requests.get(JWKS_URL, timeout=5.0)
+            resp.raise_for_status()
+            keys = {}
+            for jwk in resp.json().get("keys", []):
+                try:
+                    keys[jwk.get("kid")] = jwt.PyJWK(jwk).key
+                except Exception as e:
+                    print(f"Warning: skipping JWKS key {jwk.get('kid')}: {e}")
+            _jwks_keys = keys
+        except Exception as e:
+            print(f"Warning: failed to refresh JWKS: {e}")
+
+
+def _signing_key(token: str):
+    try:
+        header = jwt.get_unverified_header(token)
+    except jwt.PyJWTError as e:
+        raise AuthError(f"Malformed token: {e}") from e
+    alg = header.get("alg")
+    if alg == "HS256":
+        if not JWT_SECRET:
+            raise _LocalUnavailable("SUPABASE_JWT_SECRET not set")
+        return JWT_SECRET, ["HS256"]
+    if alg in ASYMMETRIC_ALGORITHMS:
+        kid = header.get("kid")
+        if _jwks_stale():
+            _refresh_jwks()
+        elif kid not in _jwks_keys and time.time() - _jwks_fetched_at > JWKS_MIN_REFRESH_SECONDS:
+            # probably a rotated key
+            _refresh_jwks(force=True)
+        key = _jwks_keys.get(kid)
+        if key is None:
+            raise _LocalUnavailable(f"Unknown signing key {kid}")
+        return key, [alg]
+    raise AuthError(f"Unsupported token algorithm {alg}")
+
+
+def _verify_local(token: str) -> str:
+    key, algorithms = _signing_key(token)
+    try:
+        claims = jwt.decode(
+            token,
+            key,
+            algorithms=algorithms,
+            audience=JWT_AUDIENCE,
+            leeway=LEEWAY_SECONDS,
+            options={"require": ["exp", "sub"]},
+        )
+    except jwt.PyJWTError as e:
+        raise AuthError(str(e)) from e
+    user_id = claims["sub"]
+    TOKEN_CACHE.put(token, user_id, float(claims["exp"]))
+    return user_id
+
+
+def _unverified_exp(token: str) -> float:
+    try:
+        return float(jwt.decode(token, options={"verify_signature": False}).get("exp", 0))
+    except Exception:
+        return 0.0
+
+
+def _verify_remote(token: str) -> str:
+    supabase = clients.supabase()
+    if not supabase:
+        raise AuthError("Supabase client not initialized")
+    user = supabase.auth.get_user(token).user
+    if not user:
+        raise AuthError("Invalid token")
+    # GoTrue accepted it; cache until the token's own expiry
+    TOKEN_CACHE.put(token, user.id, _unverified_exp(token))
+    return user.id
+
+
+def verify_token(token: str) -> str:
+    """
+    Returns the Supabase auth user id for a bearer token or raises AuthError.
+    """
+    user_id = TOKEN_CACHE.get(token)
+    if user_id:
+        return user_id
+    try:
+        return _verify_local(token)
+    except _LocalUnavailable as e:
+        if not REMOTE_FALLBACK:
+            raise AuthError(f"Cannot verify token locally: {e}") from e
+    return _verify_remote(token)
+
+
+async def averify_token(token: str) -> str:
+    """
+    Async variant for the ASGI app; periodic JWKS refreshes run in a worker
+    thread and the remote fallback uses the pooled async HTTP client.
+    """
+    user_id = TOKEN_CACHE.get(token)
+    if user_id:
+        return user_id
+    if _jwks_stale():
+        await asyncio.to_thread(_refresh_jwks)
+    try:
+        return _verify_local(token)
+    except _LocalUnavailable as e:
+        if not REMOTE_FALLBACK:
+            raise AuthError(f"Cannot verify token locally: {e}") from e
+    from . import async_supabase_client as asb
+    user_id = await asb.get_auth_user_id(token)
+    if not user_id:
+        raise AuthError("Invalid token")
+    TOKEN_CACHE.put(token, user_id, _unverified_exp(token))
+    return user_id
+
+
+# fetch the signing keys before the first request rather than during it
+clients.register_warmup("jwks", _refresh_jwks)
@@ -0,0 +1,51 @@
+import argparse
+import sys
+
+from . import supabase_client as sb
+
+# Chat history retention for deployments without pg_cron (see Step 6 of
+# migrations.sql). Run daily, e.g. from a scheduler:
+#
+#     python -m src.chat_retention --retain-months 12
+#
+# Monthly chats partitions that ended more than --retain-months ago are moved
+# to chats_archive (or dropped with --no-archive), and partitions for the next
+# months are created ahead of time so inserts never hit chats_default. Rows
+# that landed there anyway (a missed run) are moved into their month's
+# partition when it is created; any left after that are reported and the
+# command exits non-zero so the scheduler flags it.
+
+
+def _rpc(name: str, body: dict):
+    resp = sb._post(f"{sb.REST_URL}/rpc/{name}", json=body, headers=sb.HEADERS, timeout=120.0)
+    sb._raise_for_resp(resp)
+    return resp.json()
+
+
+def run_retention(retain_months: int = 12, archive: bool = True, months_ahead: int = 2) -> int:
+    created = _rpc("ensure_chat_partitions", {"months_ahead": months_ahead})
+    retired = _rpc("archive_chat_partitions", {"retain_months": retain_months, "archive": archive})
+    print(f"Chat partitions: {created} created, {retired} {'archived' if archive else 'dropped'}")
+    return retired
+
+
+def default_rows() -> int:
+    """Rows in chats_default, i.e. outside every monthly partition."""
+    return int(_rpc("chats_default_rows", {}) or 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old chat partitions and pre-create upcoming ones")
+    parser.add_argument("--retain-months", type=int, default=12)
+    parser.add_argument("--months-ahead", type=int, default=2)
+    parser.add_argument("--no-archive", action="store_true", help="drop old partitions instead of archiving them")
+    args = parser.parse_args()
+    run_retention(args.retain_months, not args.no_archive, args.months_ahead)
+    leftover = default_rows()
+    if leftover:
+        print(f"Warning: chats_default holds {leftover} rows outside the monthly partitions")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,48 @@
+import asyncio
 import os
 import json
 import re
-from dotenv import load_dotenv
-from typing import List, Dict
-
-load_dotenv()
-
-from openai import OpenAI
+from typing import Dict, List, Optional
 
+from . import clients
 from .intent_classifier import IntentClassifier
 from .lang_detect import detect_language
-from .retrieval import retrieve_listings
+from .retrieval import retrieve_listings, aretrieve_listings, embed_text, aembed_text
+from .semantic_cache import SemanticCache
 from . import supabase_client as sb
-
-# set OpenAI key
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-if not OPENAI_API_KEY:
-    raise RuntimeError("OPENAI_API_KEY is required")
+from . import async_supabase_client as asb
+from . import admission, listing_ids, saved_searches
+from .slots import extract_slots
+from .resilience import CircuitOpenError, DeadlineExceeded, guarded, stage_timeout
 
 OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini")
+FALLBACK_TIMEOUT = 15.0
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=OPENAI_API_KEY, timeout=15.0)
-
-# instantiate classifier (loads model if present)
+# instantiate classifier (local model, if enabled, is loaded during warm-up)
 INTENT = IntentClassifier()
+clients.register_warmup("intent_model", INTENT.load_local_model)
+
+# semantic cache for LLM fallback answers (FAQ-style questions repeat a lot)
+FALLBACK_CACHE_ENABLED = os.getenv("FALLBACK_CACHE_ENABLED", "1") == "1"
+FALLBACK_CACHE = SemanticCache(
+    capacity_per_language=int(os.getenv("FALLBACK_CACHE_SIZE", 512)),
+    ttl_seconds=float(os.getenv("FALLBACK_CACHE_TTL", 24 * 3600)),
+    threshold=float(os.getenv("FALLBACK_CACHE_THRESHOLD", 0.92)),
+    dtype=os.getenv("FALLBACK_CACHE_DTYPE", "int8"),
+)
+
+# recent search results by normalized query; filled on every search and the
+# only source of results once admission control reaches the CACHED_SEARCH tier
+SEARCH_CACHE = sb._TTLCache(int(os.getenv("SEARCH_CACHE_SIZE", 2048)), float(os.getenv("SEARCH_CACHE_TTL", 900)))
 
 # small helper to format listing nicely for WhatsApp/Chat
 def format_listing_msg(listing: Dict) -> str:
     lines = []
     lines.append(f"🏠 {listing.get('title','(no title)')}")
     loc = listing.get('location')
-    if loc:
+    if loc and listing.get('distance_km') is not None:
+        lines.append(f"📍 {loc} ({listing['distance_km']} km from {listing.get('landmark')})")
+    elif loc:
         lines.append(f"📍 {loc}")
     price = listing.get('price')
     if price:
@@ -41,8 +52,9 @@ def format_listing_msg(listing: Dict) -> str:
         lines.append(f"🛏 {rt}")
     contact = listing.get('landlord_contact') or listing.get('contact_number') or "No contact"
     lines.append(f"📞 {contact}")
-    # add id so users can save it
-    lines.append(f"🔖 ID: {listing.get('id')}")
+    # add a short id so users can save it
+    listing_id = listing.get('id')
+    lines.append(f"🔖 ID: {listing_ids.short_id(listing_id) if listing_id else listing_id}")
     return "\n".join(lines)
 
 
@@ -54,23 +66,20 @@ def save_chat(user_phone: str, user_message: str, bot_response: str):
         return None
 
 
-def _handle_search(user_input: str, user_id: str, lang: str) -> str:
-    # Use retrieval pipeline
-    try:
-        results = retrieve_listings(user_input, top_k=5)
-    except Exception as e:
-        print("Retrieval error:", e)
-        results = []
+def _is_swahili(lang: str) -> bool:
+    return lang == 'sw' or lang == 'sheng'
 
+
+def _search_reply(results: List[Dict], lang: str) -> str:
     if not results:
-        if lang == 'sw' or lang == 'sheng':
-            return "😔 Samahani, sina matoleo yanayolingana kwa sasa. Je, nitafute eneo pana zaidi au nikujulishe kitu kikitokea?"
+        if _is_swahili(lang):
+            return "😔 Samahani, sina matoleo yanayolingana kwa sasa. Je, nitafute eneo pana zaidi? Au jibu 'nijulishe' nikutumie ujumbe kitu kikitokea."
         else:
-            return "😔 Sorry, I couldn't find any matching listings right now. Can I broaden the search or notify you when something appears?"
+            return "😔 Sorry, I couldn't find any matching listings right now. Can I broaden the search? Or reply 'notify me' and I'll message you when something appears."
 
     # Build response listing top 3
     pieces = []
-    if lang == 'sw' or lang == 'sheng':
+    if _is_swahili(lang):
         pieces.append("Hapa kuna baadhi ya matoleo niliyopata:")
     else:
         pieces.append("Here are some of the listings I found:")
@@ -78,7 +87,7 @@ def _handle_search(user_input: str, user_id: str, lang: str) -> str:
     for r in results[:3]:
         pieces.append(format_listing_msg(r))
     
-    if lang == 'sw' or lang == 'sheng':
+    if _is_swahili(lang):
         pieces.append("\nJibu 'save <ID>' kuhifadhi listing, au 'zaidi' kuona zaidi.")
     else:
         pieces.append("\nReply with 'save <ID>' to save a listing, or 'more' to see more options.")
@@ -86,85 +95,304 @@ def _handle_search(user_input: str, user_id: str, lang: str) -> str:
     return "\n\n".join(pieces)
 
 
-def _handle_save_listing(user_input: str, user_phone: str) -> str:
+def _search_unavailable_reply(lang: str) -> str:
+    # a dependency is down or the request ran out of time; say so rather than "no matches"
+    return SEARCH_UNAVAILABLE_REPLY_SW if _is_swahili(lang) else SEARCH_UNAVAILABLE_REPLY
+
+
+def _search_cache_key(user_input: str) -> str:
+    return " ".join(user_input.lower().split())
+
+
+def _cached_search_reply(user_input: str, lang: str) -> str:
+    results = SEARCH_CACHE.get(_search_cache_key(user_input))
+    if results is None:
+        return _search_unavailable_reply(lang)
+    return _search_reply(results, lang)
+
+
+def _handle_search(user_input: str, user_id: str, lang: str, slots: Optional[Dict] = None) -> str:
+    if admission.current_tier() >= admission.CACHED_SEARCH:
+        return _cached_search_reply(user_input, lang)
+    # Use retrieval pipeline
+    try:
+        results = retrieve_listings(user_input, top_k=5, slots=slots)
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        print("Retrieval unavailable:", e)
+        return _search_unavailable_reply(lang)
+    except Exception as e:
+        print("Retrieval error:", e)
+        results = []
+    if results:
+        SEARCH_CACHE.put(_search_cache_key(user_input), results)
+    return _search_reply(results, lang)
+
+
+def _extract_listing_id(user_input: str, slots: Optional[Dict] = None):
+    # the understanding stage only returns IDs that appear in the message
+    return (slots or {}).get("listing_id") or listing_ids.extract_token(user_input)
+
+
+def _resolve_listing_id(token: str):
+    """(full listing id, None) or (None, reply explaining why the token didn't resolve)."""
+    try:
+        listing_id = listing_ids.resolve(token)
+    except listing_ids.AmbiguousListingId:
+        return None, f"More than one listing starts with {token}. Please send a few more characters of the ID."
+    if not listing_id:
+        return None, f"I couldn't find a listing with ID {token}. Please check the ID on the listing."
+    return listing_id, None
+
+
+async def _resolve_listing_id_async(token: str):
+    if listing_ids.needs_load():
+        return await asyncio.to_thread(_resolve_listing_id, token)
+    return _resolve_listing_id(token)
+
+
+def _inquiry_message(user_input: str, listing_id: str) -> str:
+    # optional message is everything after the id
+    parts = user_input.split(listing_id, 1)
+    return parts[1].strip() if len(parts) > 1 else "Hi, I am interested in this listing. Please contact me."
+
+
+def _handle_save_listing(user_input: str, user_phone: str, slots: Optional[Dict] = None) -> str:
     # expect user to write: "save <id>" or "save listing <id>"
-    m = re.search(r"([0-9a-fA-F\-]{8,})", user_input)
-    if not m:
+    token = _extract_listing_id(user_input, slots)
+    if not token:
         return "I couldn't find a listing ID in your message. Reply with 'save <LISTING_ID>'."
-    listing_id = m.group(1)
+    listing_id, problem = _resolve_listing_id(token)
+    if problem:
+        return problem
     try:
         sb.save_listing_to_favorites(user_phone, listing_id)
-        return f"✅ Saved listing {listing_id} to your favorites."
+        return f"✅ Saved listing {token} to your favorites."
     except Exception as e:
         print("Save listing error:", e)
         return "Sorry, I couldn't save that listing right now. Please try later."
 
-def _handle_inquiry(user_input: str, user_phone: str) -> str:
+def _handle_inquiry(user_input: str, user_phone: str, slots: Optional[Dict] = None) -> str:
     # simplistic extraction of listing id + a short message
-    m = re.search(r"([0-9a-fA-F\-]{8,})", user_input)
-    if not m:
+    token = _extract_listing_id(user_input, slots)
+    if not token:
         return "Please include the listing ID you want to inquire about (reply with the ID)."
-    listing_id = m.group(1)
-    # optional message is everything after the id
-    parts = user_input.split(listing_id, 1)
-    message = parts[1].strip() if len(parts) > 1 else "Hi, I am interested in this listing. Please contact me."
+    listing_id, problem = _resolve_listing_id(token)
+    if problem:
+        return problem
+    message = _inquiry_message(user_input, token)
     try:
         sb.create_inquiry(user_phone, listing_id, message)
-        return f"✅ Your inquiry for listing {listing_id} has been submitted. The landlord will get back to you."
+        return f"✅ Your inquiry for listing {token} has been submitted. The landlord will get back to you."
     except Exception as e:
         print("Inquiry error:", e)
         return "Sorry, I couldn't create the inquiry right now. Try again later."
 
+
+def _detect_language(user_input: str) -> str:
+    try:
+        return detect_language(user_input)
+    except Exception as e:
+        print(f"Warning: Language detection failed: {e}")
+        return "en"  # fallback to English
+
+
+PORTFOLIO_RE = re.compile(r"\bmy (listings|properties|property|units|complexes|portfolio)\b|\b(mali|nyumba) zangu\b")
+
+
+def _format_portfolio(portfolio: Dict, lang: str) -> str:
+    if not portfolio.get("landlord_id"):
+        if _is_swahili(lang):
+            return "Sikupata nyumba zilizosajiliwa kwa nambari hii."
+        return "I couldn't find any properties registered to this number."
+    lines = []
+    for c in portfolio.get("complexes", []):
+        units = c.get("units", [])
+        vacant = sum(1 for u in units if (u.get("status") or "").lower() == "vacant")
+        lines.append(f"🏢 {c.get('name')} ({c.get('location') or '-'}): {c.get('listing_count', 0)} listings, "
+                     f"{len(units)} units, {vacant} vacant")
+    if portfolio.get("unassigned_listing_count"):
+        lines.append(f"📄 {portfolio['unassigned_listing_count']} listings not in a complex")
+    if not lines:
+        return "You have no complexes or listings yet."
+    header = "Mali zako:" if _is_swahili(lang) else "Your properties:"
+    return "\n".join([header] + lines)
+
+
+def _handle_portfolio(user_phone: str, lang: str) -> str:
+    try:
+        return _format_portfolio(sb.get_landlord_portfolio(user_phone), lang)
+    except Exception as e:
+        print("Portfolio error:", e)
+        return "Sorry, I couldn't load your properties right now. Try again later."
+
+
+ALERT_RE = re.compile(r"\b(notify me|alert me|nijulishe|niarifu)\b")
+STOP_ALERTS_RE = re.compile(r"\b(stop|cancel) (alerts?|notifications?)\b|\bacha kunijulisha\b")
+
+
+def _last_unmatched_search(user_phone: str) -> str:
+    # "notify me" usually answers the no-results reply, so reuse that query
+    rows, _ = sb.get_chat_page(user_phone, limit=10)
+    for row in rows:
+        if (row.get("bot_response") or "").startswith("😔"):
+            return row.get("user_message") or ""
+    return ""
+
+
+def _handle_save_search(user_input: str, user_phone: str, lang: str) -> str:
+    # alerts are WhatsApp messages; web chat users are keyed by their auth user id
+    if not user_phone.startswith("whatsapp:"):
+        return "Alerts are only available on WhatsApp."
+    query = ALERT_RE.sub(" ", user_input.lower()).strip()
+    try:
+        if not any(extract_slots(query).values()):
+            query = _last_unmatched_search(user_phone)
+        if not query:
+            if _is_swahili(lang):
+                return "Niambie unatafuta nini, k.m. 'nijulishe bedsitter Kilimani chini ya 8k'."
+            return "Tell me what you're looking for, e.g. 'notify me bedsitter in Kilimani under 8k'."
+        saved_searches.save_search(user_phone, query)
+    except Exception as e:
+        print("Save search error:", e)
+        return "Sorry, I couldn't set up the alert right now. Try again later."
+    if _is_swahili(lang):
+        return f"🔔 Sawa! Nitakujulisha nyumba ikipatikana kwa: \"{query}\". Jibu 'stop alerts' kusitisha."
+    return f"🔔 Done! I'll message you when a new listing matches \"{query}\". Reply 'stop alerts' to cancel."
+
+
+def _handle_stop_alerts(user_phone: str) -> str:
+    try:
+        count = saved_searches.deactivate_searches(user_phone)
+    except Exception as e:
+        print("Stop alerts error:", e)
+        return "Sorry, I couldn't update your alerts right now. Try again later."
+    return f"🔕 Stopped {count} alert(s)." if count else "You have no active alerts."
+
+
+def _choose_route(intent: str, user_input: str) -> str:
+    low = user_input.lower()
+    if PORTFOLIO_RE.search(low):
+        return "portfolio"
+    if STOP_ALERTS_RE.search(low):
+        return "stop_alerts"
+    if ALERT_RE.search(low):
+        return "alert"
+    if intent == "search_listings" or (intent == "fallback" and ("rent" in low or "bedsitter" in low or "room" in low)):
+        return "search"
+    if intent == "save_listing" or low.startswith("save "):
+        return "save"
+    if intent == "create_inquiry" or low.startswith("inquire") or "book viewing" in low:
+        return "inquiry"
+    if intent == "greeting":
+        return "greeting"
+    return "fallback"
+
+
+def _greeting_reply(lang: str) -> str:
+    if _is_swahili(lang):
+        return "Habari! Ninaweza kukusaidia kutafuta nyumba au kupeleka ujumbe kwa mwenye nyumba. Unaambiwa nini?"
+    return "Hi! I can help you find student housing — tell me the area, budget, and room type."
+
+
+def _fallback_request(user_input: str, lang: str, timeout: float = FALLBACK_TIMEOUT) -> Dict:
+    prompt = f"You are RINA, a Kenyan student housing assistant. The user said: '{user_input}'. Give a concise helpful reply in the user's language ({lang})."
+    return dict(
+        model=OPENAI_MODEL_NAME,
+        messages=[{"role":"system","content":"You are RINA, a helpful assistant for student housing in Nairobi."},
+                  {"role":"user","content":prompt}],
+        max_tokens=250,
+        temperature=0.7,
+        timeout=timeout,
+    )
+
+
+SEARCH_UNAVAILABLE_REPLY = "Search is a bit slow right now — please try again in a minute."
+SEARCH_UNAVAILABLE_REPLY_SW = "Utafutaji unachelewa kwa sasa — tafadhali jaribu tena baada ya dakika moja."
+FALLBACK_ERROR_REPLY = "Sorry, I'm having trouble right now. Can I help you find a room or save a listing?"
+# canned answer for off-topic messages while admission control skips the LLM fallback
+FALLBACK_BUSY_REPLY = "I can help you find a room, save a listing or ask a landlord — tell me the area, budget and room type."
+FALLBACK_BUSY_REPLY_SW = "Ninaweza kukusaidia kutafuta chumba, kuhifadhi nyumba au kuuliza mwenye nyumba — niambie eneo, bajeti na aina ya chumba."
+BUSY_REPLY = "RINA is very busy right now — please send your message again in a minute. / Tuna shughuli nyingi sasa hivi, tafadhali tuma tena baada ya dakika moja."
+EMPTY_MESSAGE_REPLY = "Hi — how can I help you find housing today?"
+
+
+def _fallback_reply(user_input: str, lang: str) -> str:
+    # fallback LLM answer (short), served from the semantic cache when a
+    # near-identical question was already answered in this language
+    embedding = None
+    if FALLBACK_CACHE_ENABLED:
+        cached = FALLBACK_CACHE.get_exact(user_input, lang)
+        if cached:
+            return cached
+    if admission.current_tier() >= admission.NO_LLM_FALLBACK:
+        return FALLBACK_BUSY_REPLY_SW if _is_swahili(lang) else FALLBACK_BUSY_REPLY
+    if FALLBACK_CACHE_ENABLED:
+        try:
+            embedding = embed_text(user_input)
+            cached = FALLBACK_CACHE.get(embedding, lang)
+            if cached:
+                return cached
+        except Exception as e:
+            print("Fallback cache lookup error:", e)
+    try:
+        request = _fallback_request(user_input, lang, timeout=stage_timeout(FALLBACK_TIMEOUT))
+        with guarded("openai"):
+            resp = clients.openai_client().chat.completions.create(**request)
+        reply = resp.choices[0].message.content.strip()
+    except Exception as e:
+        print("LLM fallback error:", e)
+        return FALLBACK_ERROR_REPLY
+    if embedding is not None and reply:
+        FALLBACK_CACHE.put(user_input, embedding, lang, reply)
+    return reply
+
+
 def get_bot_response(user_input: str, user_id: str = "anon") -> str:
     """
     Primary interface used by webhook handler.
     user_id here is a phone number string (Twilio format) e.g. 'whatsapp:+2547...'
     """
     if not user_input or not user_input.strip():
-        return "Hi — how can I help you find housing today?"
+        return EMPTY_MESSAGE_REPLY
+    with admission.admitted() as tier:
+        if tier >= admission.SHED:
+            return BUSY_REPLY
+        return _bot_response(user_input, user_id, tier)
 
-    # language detection
-    try:
-        lang = detect_language(user_input)
-    except Exception as e:
-        print(f"Warning: Language detection failed: {e}")
-        lang = "en"  # fallback to English
-    # obtain intent
+
+def _bot_response(user_input: str, user_id: str, tier: int) -> str:
+    # one completion gives intent, language and search slots
     try:
-        intent, conf = INTENT.predict(user_input)
+        if tier >= admission.LOCAL_INTENT:
+            understood = INTENT.understand_local(user_input)
+        else:
+            understood = INTENT.understand(user_input)
     except Exception as e:
         print("Intent classifier error:", e)
-        intent, conf = "fallback", 0.0
+        understood = {"intent": "fallback", "confidence": 0.0, "language": None, "slots": {}}
+    intent, conf, slots = understood["intent"], understood["confidence"], understood["slots"]
+    lang = understood["language"] or _detect_language(user_input)
 
     print(f"Detected intent={intent} conf={conf} lang={lang}")
 
     # handle core intents
-    if intent == "search_listings" or (intent == "fallback" and ("rent" in user_input.lower() or "bedsitter" in user_input.lower() or "room" in user_input.lower())):
-        reply = _handle_search(user_input, user_id, lang)
-    elif intent == "save_listing" or user_input.lower().startswith("save "):
-        reply = _handle_save_listing(user_input, user_id)
-    elif intent == "create_inquiry" or user_input.lower().startswith("inquire") or "book viewing" in user_input.lower():
-        reply = _handle_inquiry(user_input, user_id)
-    elif intent == "greeting":
-        if lang == "sw" or lang == "sheng":
-            reply = "Habari! Ninaweza kukusaidia kutafuta nyumba au kupeleka ujumbe kwa mwenye nyumba. Unaambiwa nini?"
-        else:
-            reply = "Hi! I can help you find student housing — tell me the area, budget, and room type."
+    route = _choose_route(intent, user_input)
+    if route == "search":
+        reply = _handle_search(user_input, user_id, lang, slots)
+    elif route == "save":
+        reply = _handle_save_listing(user_input, user_id, slots)
+    elif route == "inquiry":
+        reply = _handle_inquiry(user_input, user_id, slots)
+    elif route == "portfolio":
+        reply = _handle_portfolio(user_id, lang)
+    elif route == "alert":
+        reply = _handle_save_search(user_input, user_id, lang)
+    elif route == "stop_alerts":
+        reply = _handle_stop_alerts(user_id)
+    elif route == "greeting":
+        reply = _greeting_reply(lang)
     else:
-        # fallback LLM answer (short)
-        prompt = f"You are RINA, a Kenyan student housing assistant. The user said: '{user_input}'. Give a concise helpful reply in the user's language ({lang})."
-        try:
-            resp = openai_client.chat.completions.create(
-                model=OPENAI_MODEL_NAME,
-                messages=[{"role":"system","content":"You are RINA, a helpful assistant for student housing in Nairobi."},
-                          {"role":"user","content":prompt}],
-                max_tokens=250,
-                temperature=0.7
-            )
-            reply = resp.choices[0].message.content.strip()
-        except Exception as e:
-            print("LLM fallback error:", e)
-            reply = "Sorry, I'm having trouble right now. Can I help you find a room or save a listing?"
+        reply = _fallback_reply(user_input, lang)
 
     # save final bot response to DB (update previous saved chat)
     try:
@@ -173,4 +401,138 @@ def get_bot_response(user_input: str, user_id: str = "anon") -> str:
         print(f"Warning: Failed to save chat for user {user_id}: {e}")
         # Continue functioning even if chat saving fails
 
-    return reply
\ No newline at end of file
+    return reply
+
+
+# Async pipeline (ASGI serving mode, see asgi.py). Same routing and replies as
+# get_bot_response, but every OpenAI/Supabase call is awaited on shared pooled
+# clients so one worker can hold many conversations in flight.
+async def _handle_search_async(user_input: str, user_id: str, lang: str, slots: Optional[Dict] = None) -> str:
+    if admission.current_tier() >= admission.CACHED_SEARCH:
+        return _cached_search_reply(user_input, lang)
+    try:
+        results = await aretrieve_listings(user_input, top_k=5, slots=slots)
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        print("Retrieval unavailable:", e)
+        return _search_unavailable_reply(lang)
+    except Exception as e:
+        print("Retrieval error:", e)
+        results = []
+    if results:
+        SEARCH_CACHE.put(_search_cache_key(user_input), results)
+    if results and listing_ids.needs_load():
+        # cards show short IDs; don't load the ID index on the event loop
+        await asyncio.to_thread(listing_ids.ensure_loaded)
+    return _search_reply(results, lang)
+
+
+async def _handle_save_listing_async(user_input: str, user_phone: str, slots: Optional[Dict] = None) -> str:
+    token = _extract_listing_id(user_input, slots)
+    if not token:
+        return "I couldn't find a listing ID in your message. Reply with 'save <LISTING_ID>'."
+    listing_id, problem = await _resolve_listing_id_async(token)
+    if problem:
+        return problem
+    try:
+        await asb.save_listing_to_favorites(user_phone, listing_id)
+        return f"✅ Saved listing {token} to your favorites."
+    except Exception as e:
+        print("Save listing error:", e)
+        return "Sorry, I couldn't save that listing right now. Please try later."
+
+
+async def _handle_inquiry_async(user_input: str, user_phone: str, slots: Optional[Dict] = None) -> str:
+    token = _extract_listing_id(user_input, slots)
+    if not token:
+        return "Please include the listing ID you want to inquire about (reply with the ID)."
+    listing_id, problem = await _resolve_listing_id_async(token)
+    if problem:
+        return problem
+    message = _inquiry_message(user_input, token)
+    try:
+        await asb.create_inquiry(user_phone, listing_id, message)
+        return f"✅ Your inquiry for listing {token} has been submitted. The landlord will get back to you."
+    except Exception as e:
+        print("Inquiry error:", e)
+        return "Sorry, I couldn't create the inquiry right now. Try again later."
+
+
+async def _fallback_reply_async(user_input: str, lang: str) -> str:
+    embedding = None
+    if FALLBACK_CACHE_ENABLED:
+        cached = FALLBACK_CACHE.get_exact(user_input, lang)
+        if cached:
+            return cached
+    if admission.current_tier() >= admission.NO_LLM_FALLBACK:
+        return FALLBACK_BUSY_REPLY_SW if _is_swahili(lang) else FALLBACK_BUSY_REPLY
+    if FALLBACK_CACHE_ENABLED:
+        try:
+            embedding = await aembed_text(user_input)
+            cached = FALLBACK_CACHE.get(embedding, lang)
+            if cached:
+                return cached
+        except Exception as e:
+            print("Fallback cache lookup error:", e)
+    try:
+        request = _fallback_request(user_input, lang, timeout=stage_timeout(FALLBACK_TIMEOUT))
+        with guarded("openai"):
+            resp = await clients.async_openai_client().chat.completions.create(**request)
+        reply = resp.choices[0].message.content.strip()
+    except Exception as e:
+        print("LLM fallback error:", e)
+        return FALLBACK_ERROR_REPLY
+    if embedding is not None and reply:
+        FALLBACK_CACHE.put(user_input, embedding, lang, reply)
+    return reply
+
+
+async def get_bot_response_async(user_input: str, user_id: str = "anon") -> str:
+    """
+    Async twin of get_bot_response, used by the ASGI app.
+    """
+    if not user_input or not user_input.strip():
+        return EMPTY_MESSAGE_REPLY
+    with admission.admitted(shared=False) as tier:
+        if tier >= admission.SHED:
+            return BUSY_REPLY
+        return await _bot_response_async(user_input, user_id, tier)
+
+
+async def _bot_response_async(user_input: str, user_id: str, tier: int) -> str:
+    try:
+        if tier >= admission.LOCAL_INTENT:
+            understood = await asyncio.to_thread(INTENT.understand_local, user_input)
+        else:
+            understood = await INTENT.aunderstand(user_input)
+    except Exception as e:
+        print("Intent classifier error:", e)
+        understood = {"intent": "fallback", "confidence": 0.0, "language": None, "slots": {}}
+    intent, conf, slots = understood["intent"], understood["confidence"], understood["slots"]
+    lang = understood["language"] or _detect_language(user_input)
+
+    print(f"Detected intent={intent} conf={conf} lang={lang}")
+
+    route = _choose_route(intent, user_input)
+    if route == "search":
+        reply = await _handle_search_async(user_input, user_id, lang, slots)
+    elif route == "save":
+        reply = await _handle_save_listing_async(user_input, user_id, slots)
+    elif route == "inquiry":
+        reply = await _handle_inquiry_async(user_input, user_id, slots)
+    elif route == "portfolio":
+        reply = await asyncio.to_thread(_handle_portfolio, user_id, lang)
+    elif route == "alert":
+        reply = await asyncio.to_thread(_handle_save_search, user_input, user_id, lang)
+    elif route == "stop_alerts":
+        reply = await asyncio.to_thread(_handle_stop_alerts, user_id)
+    elif route == "greeting":
+        reply = _greeting_reply(lang)
+    else:
+        reply = await _fallback_reply_async(user_input, lang)
+
+    try:
+        await asb.save_chat(user_id, user_input, reply)
+    except Exception as e:
+        print(f"Warning: Failed to save chat for user {user_id}: {e}")
+
+    return reply
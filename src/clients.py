@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+# Single place where the environment is loaded and external clients are built.
+# Everything is created lazily on first use so importing the app is cheap and
+# a missing key only breaks the feature that needs it. Under gunicorn
+# --preload the master imports and warms the app once, and each worker drops
+# the inherited clients after fork (see gunicorn.conf.py) so no socket is
+# shared between processes.
+load_dotenv()
+
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "15.0"))
+# connection pool for the async serving path (asgi.py); one pool per worker
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", 200))
+ASYNC_HTTP_TIMEOUT = float(os.getenv("ASYNC_HTTP_TIMEOUT", "10.0"))
+REDIS_RETRY_SECONDS = 30.0
+
+_lock = threading.Lock()
+_clients: Dict[str, object] = {}
+_redis_failed_at: Optional[float] = None
+_warmups: List[Tuple[str, Callable[[], None]]] = []
+
+
+def _get_or_build(name: str, factory: Callable[[], object]):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+
+def _build_openai():
+    api_key = os.getenv("OPENAI_API_KEY", "")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY is required")
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT)
+
+
+def openai_client():
+    """Shared OpenAI client. Callers pass a per-call `timeout=` when they
+    need something tighter than OPENAI_TIMEOUT."""
+    return _get_or_build("openai", _build_openai)
+
+
+def _build_async_openai():
+    api_key = os.getenv("OPENAI_API_KEY", "")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY is required")
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT)
+
+
+def async_openai_client():
+    """Shared AsyncOpenAI client for the ASGI serving path."""
+    return _get_or_build("async_openai", _build_async_openai)
+
+
+def _build_async_http():
+    import httpx
+    limits = httpx.Limits(
+        max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=ASYNC_HTTP_MAX_CONNECTIONS // 4 or 1,
+    )
+    return httpx.AsyncClient(limits=limits, timeout=ASYNC_HTTP_TIMEOUT)
+
+
+def async_http_client():
+    """Pooled httpx.AsyncClient used for PostgREST / Auth calls on the async path."""
+    return _get_or_build("async_http", _build_async_http)
+
+
+async def aclose():
+    """Close the async clients (ASGI lifespan shutdown)."""
+    for name in ("async_http", "async_openai", "async_redis"):
+        client = _clients.pop(name, None)
+        if client is None:
+            continue
+        if name == "async_http":
+            await client.aclose()
+        else:
+            await client.close()
+
+
+def _build_supabase():
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY in environment")
+    from supabase import create_client
+    return create_client(url, key)
+
+
+def supabase():
+    """Shared supabase-py client (used for auth). Returns None when not configured."""
+    try:
+        return _get_or_build("supabase", _build_supabase)
+    except Exception as e:
+        print(f"Warning: Supabase client unavailable: {e}")
+        return None
+
+
+def _build_twilio():
+    sid = os.getenv("TWILIO_ACCOUNT_SID")
+    token = os.getenv("TWILIO_AUTH_TOKEN")
+    if not sid or not token:
+        raise RuntimeError("Missing TWILIO_ACCOUNT_SID or TWILIO_AUTH_TOKEN in environment")
+    from twilio.rest import Client
+    return Client(sid, token)
+
+
+def twilio_client():
+    """Shared Twilio REST client for outbound WhatsApp messages. None when not configured."""
+    try:
+        return _get_or_build("twilio", _build_twilio)
+    except Exception as e:
+        print(f"Warning: Twilio client unavailable: {e}")
+        return None
+
+
+def redis_client():
+    """Shared Redis client, or None if Redis is unreachable. A failed connection
+    is retried at most every REDIS_RETRY_SECONDS so callers can fail open cheaply."""
+    global _redis_failed_at
+    client = _clients.get("redis")
+    if client is not None:
+        return client
+    if _redis_failed_at is not None and time.time() - _redis_failed_at < REDIS_RETRY_SECONDS:
+        return None
+
+    import redis
+    with _lock:
+        client = _clients.get("redis")
+        if client is not None:
+            return client
+        try:
+            client = redis.Redis(
+                host=os.getenv("REDIS_HOST", "localhost"),
+                port=int(os.getenv("REDIS_PORT", 6379)),
+                db=0,
+                decode_responses=True,
+                socket_connect_timeout=1.0,
+            )
+            client.ping()
+            print("Connected to Redis.")
+        except redis.exceptions.RedisError as e:
+            print(f"Could not connect to Redis: {e}. Rate limiting will not work.")
+            _redis_failed_at = time.time()
+            return None
+        _redis_failed_at = None
+        _clients["redis"] = client
+        return client
+
+
+def _build_async_redis():
+    import redis.asyncio
+    return redis.asyncio.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        db=0,
+        decode_responses=True,
+        socket_connect_timeout=1.0,
+    )
+
+
+def async_redis_client():
+    """redis.asyncio client for the ASGI path. Availability follows the sync
+    client's health check, so this is None whenever Redis is down."""
+    if redis_client() is None:
+        return None
+    return _get_or_build("async_redis", _build_async_redis)
+
+
+def reset():
+    """Forget every client built so far. Called in each gunicorn worker after
+    fork so connections opened by the master are never reused."""
+    global _redis_failed_at
+    with _lock:
+        _clients.clear()
+        _redis_failed_at = None
+
+
+# Warm-up hooks
+def register_warmup(name: str, fn: Callable[[], None]):
+    """Register an expensive, fork-safe initialisation step (loading data or
+    models; nothing that keeps a connection open) to run before workers are forked."""
+    _warmups.append((name, fn))
+
+
+def warm_up() -> Dict[str, float]:
+    """Run all registered warm-up hooks; returns seconds spent per hook."""
+    timings = {}
+    for name, fn in _warmups:
+        started = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            print(f"Warning: warm-up step {name} failed: {e}")
+        timings[name] = time.perf_counter() - started
+        print(f"Warm-up {name}: {timings[name] * 1000:.1f} ms")
+    return timings
@@ -0,0 +1,126 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import List, Optional
+
+from . import clients
+
+# Per-user message coalescing for WhatsApp. People type in bursts ("hi" /
+# "looking for bedsitter" / "near KU" / "under 7k") and each line is a separate
+# webhook call. The first message of a burst makes its request the leader: it
+# waits until the user has been quiet for COALESCE_WINDOW_MS (never longer than
+# COALESCE_MAX_WAIT_MS in total), then drains every buffered line and answers
+# them with one get_bot_response call. Requests for the other lines return no
+# reply. State lives in Redis so bursts spread over several gunicorn workers
+# are still merged; without Redis every message is answered on its own.
+#
+# The leader sleeps for the whole window. That is cheap on the ASGI app, but
+# on the sync app it ties up one of the few gunicorn workers for 1-3s per
+# message, so there it is off unless COALESCE_ENABLED=1.
+ENABLED = os.getenv("COALESCE_ENABLED", "0") == "1"
+ASYNC_ENABLED = os.getenv("COALESCE_ASYNC_ENABLED", "1") == "1"
+WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", 1200))
+MAX_WAIT_MS = int(os.getenv("COALESCE_MAX_WAIT_MS", 3000))
+POLL_MS = 100
+SEPARATOR = "\n"
+
+
+def _keys(user_key: str):
+    base = f"coalesce:{user_key}"
+    return f"{base}:msgs", f"{base}:last", f"{base}:leader"
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _ttl_ms() -> int:
+    # buffered lines outlive a crashed leader just long enough for the next message to pick them up
+    return MAX_WAIT_MS * 2 + 1000
+
+
+def _next_sleep_ms(started: float, last_ms: int) -> int:
+    """0 when the leader should drain now, otherwise how long to wait."""
+    elapsed = (time.monotonic() - started) * 1000
+    quiet = _now_ms() - last_ms
+    if elapsed >= MAX_WAIT_MS or quiet >= WINDOW_MS:
+        return 0
+    return max(1, int(min(WINDOW_MS - quiet, MAX_WAIT_MS - elapsed, POLL_MS)))
+
+
+def _join(messages: List[str]) -> Optional[str]:
+    messages = [m for m in messages if m]
+    return SEPARATOR.join(messages) if messages else None
+
+
+def coalesce(user_key: str, body: str) -> Optional[str]:
+    """
+    Buffers `body` for this user. Returns the merged text of the burst when this
+    request is the one that should answer, or None when another request will.
+    """
+    redis_client = clients.redis_client()
+    if not ENABLED or not redis_client or not body:
+        return body
+
+    msgs_key, last_key, leader_key = _keys(user_key)
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.rpush(msgs_key, body)
+            pipe.pexpire(msgs_key, _ttl_ms())
+            pipe.set(last_key, _now_ms(), px=_ttl_ms())
+            pipe.set(leader_key, uuid.uuid4().hex, nx=True, px=MAX_WAIT_MS + 2000)
+            is_leader = pipe.execute()[3]
+        if not is_leader:
+            return None
+
+        started = time.monotonic()
+        while True:
+            wait_ms = _next_sleep_ms(started, int(redis_client.get(last_key) or 0))
+            if not wait_ms:
+                break
+            time.sleep(wait_ms / 1000.0)
+
+        # drain and release in one transaction: a line pushed afterwards starts a new burst
+        with redis_client.pipeline() as pipe:
+            pipe.lrange(msgs_key, 0, -1)
+            pipe.delete(msgs_key, leader_key)
+            messages = pipe.execute()[0]
+        return _join(messages)
+    except Exception as e:
+        print(f"Coalescing error, answering message on its own: {e}")
+        return body
+
+
+async def acoalesce(user_key: str, body: str) -> Optional[str]:
+    """Async variant of coalesce() for the ASGI app."""
+    redis_client = clients.async_redis_client()
+    if not ASYNC_ENABLED or not redis_client or not body:
+        return body
+
+    msgs_key, last_key, leader_key = _keys(user_key)
+    try:
+        async with redis_client.pipeline() as pipe:
+            pipe.rpush(msgs_key, body)
+            pipe.pexpire(msgs_key, _ttl_ms())
+            pipe.set(last_key, _now_ms(), px=_ttl_ms())
+            pipe.set(leader_key, uuid.uuid4().hex, nx=True, px=MAX_WAIT_MS + 2000)
+            is_leader = (await pipe.execute())[3]
+        if not is_leader:
+            return None
+
+        started = time.monotonic()
+        while True:
+            wait_ms = _next_sleep_ms(started, int(await redis_client.get(last_key) or 0))
+            if not wait_ms:
+                break
+            await asyncio.sleep(wait_ms / 1000.0)
+
+        async with redis_client.pipeline() as pipe:
+            pipe.lrange(msgs_key, 0, -1)
+            pipe.delete(msgs_key, leader_key)
+            messages = (await pipe.execute())[0]
+        return _join(messages)
+    except Exception as e:
+        print(f"Coalescing error, answering message on its own: {e}")
+        return body
@@ -1,26 +1,19 @@
 
+import argparse
 import os
 import time
 import json
-from typing import List
-from dotenv import load_dotenv
+from typing import List, Optional
 import requests
-import openai
 
+from . import clients
 # local import of supabase_client module in repo
 from . import supabase_client as sb
-
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError("OPENAI_API_KEY not set in environment")
+from .quantization import to_wire, truncate_dimensions
+from .retrieval import EMBEDDING_DIMENSIONS, embedding_kwargs
 
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 
-from openai import OpenAI
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
 REST_URL = sb.REST_URL
 HEADERS = sb.HEADERS
 POST_HEADERS = sb.POST_HEADERS
@@ -50,10 +43,10 @@ def listing_text_for_embedding(listing: dict) -> str:
     return " | ".join(parts)[:16000]  # cap length
 
 
-def compute_embedding(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+def compute_embedding(text: str, model: str = EMBEDDING_MODEL, dimensions: int = EMBEDDING_DIMENSIONS) -> List[float]:
     # Use OpenAI embeddings
     # model can be changed in env or param
-    resp = openai_client.embeddings.create(model=model, input=text)
+    resp = clients.openai_client().embeddings.create(model=model, input=text, **embedding_kwargs(dimensions))
     return resp.data[0].embedding
 
 
@@ -66,22 +59,29 @@ def fetch_all_listings() -> list:
     return r.json()
 
 
-def upsert_embedding(listing_id: str, embedding: List[float]):
+def _embedding_column(dimensions: int) -> str:
+    # full-size vectors live in `embedding`, reduced ones in `embedding_reduced`
+    return "embedding_reduced" if dimensions else "embedding"
+
+
+def upsert_embedding(listing_id: str, embedding: List[float], dimensions: int = EMBEDDING_DIMENSIONS):
     url = f"{REST_URL}/listings_embeddings"
     body = {
         "listing_id": listing_id,
         # Supabase/postgREST accepts arrays for pgvector when JSON-encoded
-        "embedding": embedding,
+        _embedding_column(dimensions): to_wire(embedding),
         "updated_at": "now()"
     }
-    # Use on_conflict param to upsert by listing_id
+    # Use on_conflict param to upsert by listing_id; merge keeps the other embedding column
     params = {"on_conflict": "listing_id"}
-    r = requests.post(url, headers=POST_HEADERS, params=params, json=body, timeout=REQUEST_TIMEOUT)
+    headers = POST_HEADERS.copy()
+    headers["Prefer"] = "return=representation,resolution=merge-duplicates"
+    r = requests.post(url, headers=headers, params=params, json=body, timeout=REQUEST_TIMEOUT)
     sb._raise_for_resp(r)
     return r.json()
 
 
-def run_ingest(batch_wait: float = 0.35):
+def run_ingest(batch_wait: float = 0.35, dimensions: int = EMBEDDING_DIMENSIONS):
     print("Fetching listings...")
     listings = fetch_all_listings()
     print(f"Found {len(listings)} listings")
@@ -92,17 +92,64 @@ def run_ingest(batch_wait: float = 0.35):
             continue
         text = listing_text_for_embedding(listing)
         try:
-            emb = compute_embedding(text)
+            emb = compute_embedding(text, dimensions=dimensions)
         except Exception as e:
             print("Embedding error for listing", lid, e)
             continue
         try:
-            upsert_embedding(lid, emb)
+            upsert_embedding(lid, emb, dimensions=dimensions)
             print(f"[{i}/{len(listings)}] Upserted embedding for {lid}")
         except Exception as e:
             print("Upsert error:", e)
         time.sleep(batch_wait)  # throttle to avoid token limits / rate limits
 
 
+def backfill_reduced_from_full(dimensions: int, page_size: int = 200):
+    """
+    Migration path for existing rows: text-embedding-3 vectors can be shortened
+    by truncating and re-normalizing, so embedding_reduced is filled from the
+    stored full-size `embedding` without calling OpenAI again.
+    """
+    done = 0
+    while True:
+        params = {
+            "select": "listing_id,embedding",
+            "embedding_reduced": "is.null",
+            "embedding": "not.is.null",
+            "order": "listing_id.asc",
+            "limit": str(page_size),
+        }
+        r = requests.get(f"{REST_URL}/listings_embeddings", headers=HEADERS, params=params, timeout=REQUEST_TIMEOUT)
+        sb._raise_for_resp(r)
+        rows = r.json() or []
+        if not rows:
+            break
+        for row in rows:
+            full = row["embedding"]
+            # PostgREST returns pgvector values as their text form "[0.1,0.2,...]"
+            if isinstance(full, str):
+                full = json.loads(full)
+            reduced = truncate_dimensions(full, dimensions)[0].tolist()
+            upsert_embedding(row["listing_id"], reduced, dimensions=dimensions)
+            done += 1
+        print(f"Backfilled {done} reduced embeddings")
+    return done
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Compute and upsert listing embeddings")
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS,
+                        help="reduced embedding size (0 = model default, stored in `embedding`)")
+    parser.add_argument("--from-full", action="store_true",
+                        help="fill embedding_reduced by truncating the stored full-size vectors (no OpenAI calls)")
+    args = parser.parse_args(argv)
+    if args.from_full:
+        if not args.dimensions:
+            parser.error("--from-full needs --dimensions")
+        backfill_reduced_from_full(args.dimensions)
+    else:
+        run_ingest(dimensions=args.dimensions)
+
+
 if __name__ == "__main__":
-    run_ingest()
\ No newline at end of file
+    main()
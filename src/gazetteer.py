@@ -0,0 +1,76 @@
+import json
+import math
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Bundled gazetteer of Nairobi neighbourhoods and campuses (gazetteer.json).
+# Listings are geocoded against it at ingest and "near <place>" queries are
+# resolved against it, so both sides land on the same coordinates.
+GAZETTEER_PATH = os.path.join(os.path.dirname(__file__), "gazetteer.json")
+EARTH_RADIUS_KM = 6371.0
+NEAR_RADIUS_KM = float(os.getenv("GEO_NEAR_RADIUS_KM", 3.0))
+AREA_RADIUS_KM = float(os.getenv("GEO_AREA_RADIUS_KM", 1.5))
+
+_NEAR_RE = re.compile(r"\b(near|nearby|close to|next to|around|walking distance (?:to|from)|karibu na|karibu)\s+(?:the\s+)?$")
+
+
+@lru_cache(maxsize=1)
+def places() -> List[Dict]:
+    with open(GAZETTEER_PATH, encoding="utf-8") as f:
+        return json.load(f)["places"]
+
+
+@lru_cache(maxsize=1)
+def _matcher() -> Tuple[re.Pattern, Dict[str, Dict]]:
+    lookup = {}
+    for place in places():
+        for name in [place["name"]] + place.get("aliases", []):
+            lookup.setdefault(name.lower(), place)
+    names = sorted(lookup, key=len, reverse=True)
+    return re.compile(r"\b(" + "|".join(re.escape(n) for n in names) + r")\b"), lookup
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance; the second point may be numpy arrays."""
+    lat1, lon1 = math.radians(lat1), math.radians(lon1)
+    lat2, lon2 = np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def geocode(text: Optional[str]) -> Optional[Dict]:
+    """Most specific (longest-named) gazetteer place mentioned in the text."""
+    if not text:
+        return None
+    pattern, lookup = _matcher()
+    found = pattern.findall(text.lower())
+    return lookup[max(found, key=len)] if found else None
+
+
+def geocode_fields(location: Optional[str]) -> Dict:
+    """latitude/longitude/geo_place columns for a listing location, or {}."""
+    place = geocode(location)
+    if not place:
+        return {}
+    return {"latitude": place["lat"], "longitude": place["lon"], "geo_place": place["name"]}
+
+
+def find_landmark(query: str) -> Optional[Tuple[Dict, float]]:
+    """(place, radius_km) for a location-constrained query: "near KU" searches
+    NEAR_RADIUS_KM around the place, as does any campus mention ("hostel at
+    JKUAT"); naming an area ("bedsitter in Ruaka") searches AREA_RADIUS_KM
+    around its centre. A place right after "near" wins over earlier mentions."""
+    pattern, lookup = _matcher()
+    low = (query or "").lower()
+    best = None
+    for m in pattern.finditer(low):
+        place = lookup[m.group(1)]
+        if _NEAR_RE.search(low[: m.start()]):
+            return place, NEAR_RADIUS_KM
+        if best is None:
+            best = (place, NEAR_RADIUS_KM if place["kind"] == "campus" else AREA_RADIUS_KM)
+    return best
@@ -0,0 +1,172 @@
+import argparse
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import supabase_client as sb
+from .gazetteer import geocode_fields, haversine_km
+
+# In-memory spatial index of geocoded listings (latitude/longitude are filled
+# from the gazetteer at ingest, see Step 9 of migrations.sql). Points are
+# bucketed into a CELL_DEG grid (~1.1 km at Nairobi's latitude); a radius
+# query reads only the cells overlapping the circle's bounding box, then
+# computes exact distances for those points in one numpy call. The index is
+# loaded lazily, extended by create_listing and reloaded every RELOAD_SECONDS.
+CELL_DEG = 0.01
+RELOAD_SECONDS = float(os.getenv("GEO_INDEX_RELOAD_SECONDS", 600))
+RETRY_SECONDS = 30
+PAGE_SIZE = 1000
+KM_PER_DEG_LAT = 110.574
+
+
+class GridIndex:
+    def __init__(self, points=()):
+        self._lock = threading.Lock()
+        self.ids: List[str] = []
+        self.lat: List[float] = []
+        self.lon: List[float] = []
+        self.cells: Dict[Tuple[int, int], List[int]] = {}
+        self.positions: Dict[str, int] = {}
+        for listing_id, lat, lon in points:
+            self.add(listing_id, lat, lon)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    @staticmethod
+    def _cell(lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / CELL_DEG), math.floor(lon / CELL_DEG)
+
+    def add(self, listing_id: str, lat: float, lon: float):
+        with self._lock:
+            if listing_id in self.positions:
+                return
+            pos = len(self.ids)
+            self.ids.append(listing_id)
+            self.lat.append(float(lat))
+            self.lon.append(float(lon))
+            self.positions[listing_id] = pos
+            self.cells.setdefault(self._cell(lat, lon), []).append(pos)
+
+    def within(self, lat: float, lon: float, radius_km: float, limit: Optional[int] = None) -> List[Tuple[str, float]]:
+        """(listing_id, km) within radius_km of the point, nearest first."""
+        dlat = radius_km / KM_PER_DEG_LAT
+        dlon = radius_km / (KM_PER_DEG_LAT * max(math.cos(math.radians(lat)), 0.01))
+        (r0, c0), (r1, c1) = self._cell(lat - dlat, lon - dlon), self._cell(lat + dlat, lon + dlon)
+        with self._lock:
+            found = [p for r in range(r0, r1 + 1) for c in range(c0, c1 + 1) for p in self.cells.get((r, c), ())]
+            if not found:
+                return []
+            dists = haversine_km(lat, lon, np.array([self.lat[p] for p in found]), np.array([self.lon[p] for p in found]))
+            order = np.argsort(dists, kind="stable")
+            hits = [(self.ids[found[i]], float(dists[i])) for i in order if dists[i] <= radius_km]
+        return hits[:limit] if limit else hits
+
+    def nearest(self, lat: float, lon: float, k: int = 10, max_radius_km: float = 50.0) -> List[Tuple[str, float]]:
+        radius = CELL_DEG * KM_PER_DEG_LAT
+        while True:
+            hits = self.within(lat, lon, radius, limit=k)
+            if len(hits) >= k or radius >= max_radius_km:
+                return hits
+            radius = min(radius * 2, max_radius_km)
+
+
+INDEX = GridIndex()
+_load_lock = threading.Lock()
+_loaded_at: Optional[float] = None
+_attempted_at: Optional[float] = None
+
+
+def _fetch_points() -> List[Tuple[str, float, float]]:
+    points = []
+    last = None
+    while True:
+        params = {"select": "id,latitude,longitude", "latitude": "not.is.null", "order": "id.asc", "limit": str(PAGE_SIZE)}
+        if last:
+            params["id"] = f"gt.{last}"
+        resp = sb._get(f"{sb.REST_URL}/listings", params=params, headers=sb.HEADERS)
+        sb._raise_for_resp(resp)
+        page = resp.json() or []
+        points.extend((r["id"], r["latitude"], r["longitude"]) for r in page)
+        if len(page) < PAGE_SIZE:
+            return points
+        last = page[-1]["id"]
+
+
+def needs_load() -> bool:
+    now = time.monotonic()
+    if _attempted_at is not None and now - _attempted_at < RETRY_SECONDS:
+        return False
+    return _loaded_at is None or now - _loaded_at > RELOAD_SECONDS
+
+
+def ensure_loaded() -> bool:
+    """(Re)loads the index when stale; False if it has never loaded."""
+    global INDEX, _loaded_at, _attempted_at
+    if not needs_load():
+        return _loaded_at is not None
+    with _load_lock:
+        if not needs_load():
+            return _loaded_at is not None
+        _attempted_at = time.monotonic()
+        try:
+            INDEX = GridIndex(_fetch_points())
+        except Exception as e:
+            print(f"Geo index load failed: {e}")
+            return _loaded_at is not None
+        _loaded_at = _attempted_at
+        print(f"Geo index loaded: {len(INDEX)} listings")
+        return True
+
+
+def _on_listing_created(rows):
+    if _loaded_at is None:
+        return
+    for row in rows:
+        if isinstance(row, dict) and row.get("id") and row.get("latitude") is not None:
+            INDEX.add(row["id"], row["latitude"], row["longitude"])
+
+
+sb.on_listing_created(_on_listing_created)
+
+
+def backfill(page_size: int = 200) -> int:
+    """Geocodes listings that predate Step 9 (or were inserted without coordinates)."""
+    updated, last = 0, None
+    while True:
+        params = {"select": "id,location", "latitude": "is.null", "order": "id.asc", "limit": str(page_size)}
+        if last:
+            params["id"] = f"gt.{last}"
+        resp = sb._get(f"{sb.REST_URL}/listings", params=params, headers=sb.HEADERS)
+        sb._raise_for_resp(resp)
+        page = resp.json() or []
+        for row in page:
+            fields = geocode_fields(row.get("location"))
+            if not fields:
+                print(f"No gazetteer match for listing {row['id']}: {row.get('location')!r}")
+                continue
+            r = sb._patch(f"{sb.REST_URL}/listings", params={"id": f"eq.{row['id']}"}, json=fields, headers=sb.HEADERS)
+            sb._raise_for_resp(r)
+            updated += 1
+        if len(page) < page_size:
+            print(f"Geocoded {updated} listings")
+            return updated
+        last = page[-1]["id"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Geocode listings against the bundled gazetteer")
+    parser.add_argument("--backfill", action="store_true", help="fill latitude/longitude for listings without them")
+    args = parser.parse_args()
+    if args.backfill:
+        backfill()
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+
+from . import clients
+
+# Idempotent webhook handling keyed on Twilio's MessageSid. When a reply is
+# slow Twilio retries the webhook; without this every retry ran the whole
+# pipeline again (LLM calls, embeddings, duplicate chats/favorites/inquiries
+# rows) exactly when we were already overloaded. The first request for a SID
+# claims it with SET NX (an in-flight marker that expires if the worker dies),
+# computes the reply and stores the final TwiML in its place. A retry finds
+# the marker and waits up to WAIT_SECONDS for the TwiML instead of computing
+# it again. Without Redis the same happens per process.
+ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "1") == "1"
+INFLIGHT_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_INFLIGHT_TTL", 30))
+RESULT_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_RESULT_TTL", 24 * 3600))
+WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", 10))
+POLL_SECONDS = 0.1
+LOCAL_MAX_ENTRIES = 10000
+
+INFLIGHT = "inflight:"
+DONE = "done:"
+# delete the marker only if it is still ours (it may have expired and been re-claimed)
+_RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+
+class StillProcessing(Exception):
+    """The original request for this MessageSid hasn't finished within WAIT_SECONDS."""
+
+
+def _key(message_sid: str) -> str:
+    return f"idem:twilio:{message_sid}"
+
+
+# In-process fallback: sid -> {"event", "result", "expires"}
+_local: "OrderedDict[str, Dict]" = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def _local_claim(message_sid: str):
+    """(entry, True) if this request owns the sid, else (entry, False)."""
+    now = time.monotonic()
+    with _local_lock:
+        while _local and (len(_local) > LOCAL_MAX_ENTRIES or next(iter(_local.values()))["expires"] <= now):
+            _local.popitem(last=False)
+        entry = _local.get(message_sid)
+        if entry is not None:
+            return entry, False
+        entry = {"event": threading.Event(), "result": None, "expires": now + RESULT_TTL_SECONDS}
+        _local[message_sid] = entry
+        return entry, True
+
+
+def _local_finish(message_sid: str, entry: Dict, result):
+    with _local_lock:
+        if result is None:
+            _local.pop(message_sid, None)  # failed: let a retry compute it
+        entry["result"] = result
+        entry["event"].set()
+
+
+def _local_once(message_sid: str, compute: Callable[[], str]) -> str:
+    give_up = time.monotonic() + WAIT_SECONDS
+    while True:
+        entry, owner = _local_claim(message_sid)
+        if owner:
+            break
+        entry["event"].wait(max(0.0, give_up - time.monotonic()))
+        if entry["result"] is not None:
+            return entry["result"]
+        if not entry["event"].is_set():
+            raise StillProcessing(message_sid)
+    try:
+        result = compute()
+    except Exception:
+        _local_finish(message_sid, entry, None)
+        raise
+    _local_finish(message_sid, entry, result)
+    return result
+
+
+def once(message_sid: str, compute: Callable[[], str]) -> str:
+    """
+    Returns compute()'s result for this MessageSid, computing it at most once
+    (successful results are kept RESULT_TTL_SECONDS). Raises StillProcessing if
+    another request is still computing it after WAIT_SECONDS.
+    """
+    if not ENABLED or not message_sid:
+        return compute()
+    redis_client = clients.redis_client()
+    if redis_client is None:
+        return _local_once(message_sid, compute)
+
+    key, marker = _key(message_sid), INFLIGHT + uuid.uuid4().hex
+    give_up = time.monotonic() + WAIT_SECONDS
+    while True:
+        try:
+            claimed = redis_client.set(key, marker, nx=True, ex=INFLIGHT_TTL_SECONDS)
+            value = None if claimed else redis_client.get(key)
+        except Exception as e:
+            print(f"Idempotency check failed, processing message anyway: {e}")
+            return compute()
+        if claimed:
+            break
+        if value is not None and value.startswith(DONE):
+            return value[len(DONE):]
+        if value is not None and time.monotonic() >= give_up:
+            raise StillProcessing(message_sid)
+        if value is not None:
+            time.sleep(POLL_SECONDS)
+        # value is None: the owner failed or its marker expired; claim it again
+
+    try:
+        result = compute()
+    except Exception:
+        try:
+            redis_client.eval(_RELEASE_SCRIPT, 1, key, marker)
+        except Exception as e:
+            print(f"Idempotency release failed: {e}")
+        raise
+    try:
+        redis_client.set(key, DONE + result, ex=RESULT_TTL_SECONDS)
+    except Exception as e:
+        print(f"Idempotency result not stored: {e}")
+    return result
+
+
+async def _alocal_once(message_sid: str, compute: Callable[[], Awaitable[str]]) -> str:
+    give_up = time.monotonic() + WAIT_SECONDS
+    while True:
+        entry, owner = _local_claim(message_sid)
+        if owner:
+            break
+        while not entry["event"].is_set() and time.monotonic() < give_up:
+            await asyncio.sleep(POLL_SECONDS)
+        if entry["result"] is not None:
+            return entry["result"]
+        if not entry["event"].is_set():
+            raise StillProcessing(message_sid)
+    try:
+        result = await compute()
+    except Exception:
+        _local_finish(message_sid, entry, None)
+        raise
+    _local_finish(message_sid, entry, result)
+    return result
+
+
+async def aonce(message_sid: str, compute: Callable[[], Awaitable[str]]) -> str:
+    """Async variant of once() for the ASGI app."""
+    if not ENABLED or not message_sid:
+        return await compute()
+    redis_client = clients.async_redis_client()
+    if redis_client is None:
+        return await _alocal_once(message_sid, compute)
+
+    key, marker = _key(message_sid), INFLIGHT + uuid.uuid4().hex
+    give_up = time.monotonic() + WAIT_SECONDS
+    while True:
+        try:
+            claimed = await redis_client.set(key, marker, nx=True, ex=INFLIGHT_TTL_SECONDS)
+            value = None if claimed else await redis_client.get(key)
+        except Exception as e:
+            print(f"Idempotency check failed, processing message anyway: {e}")
+            return await compute()
+        if claimed:
+            break
+        if value is not None and value.startswith(DONE):
+            return value[len(DONE):]
+        if value is not None and time.monotonic() >= give_up:
+            raise StillProcessing(message_sid)
+        if value is not None:
+            await asyncio.sleep(POLL_SECONDS)
+
+    try:
+        result = await compute()
+    except Exception:
+        try:
+            await redis_client.eval(_RELEASE_SCRIPT, 1, key, marker)
+        except Exception as e:
+            print(f"Idempotency release failed: {e}")
+        raise
+    try:
+        await redis_client.set(key, DONE + result, ex=RESULT_TTL_SECONDS)
+    except Exception as e:
+        print(f"Idempotency result not stored: {e}")
+    return result
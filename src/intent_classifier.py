@@ -1,65 +1,226 @@
+import json
 import os
-from typing import Tuple
-from dotenv import load_dotenv
+import threading
+from typing import Dict, Optional, Tuple
 
-load_dotenv()
+from . import clients
+from .listing_ids import ID_TOKEN_RE, extract_token
+from .resilience import guarded, stage_timeout
+from .slots import MAX_RENT, PROPERTY_TYPES, extract_slots, normalize_location
+from .supabase_client import _TTLCache
 
-from openai import OpenAI
+LOCAL_MODEL_PATH = os.path.join(os.path.dirname(__file__), "..", "models", "intent_clf.pkl")
+# encoder the pickled LogisticRegression was trained on (384-dim features)
+LOCAL_ENCODER_NAME = os.getenv("LOCAL_INTENT_ENCODER", "sentence-transformers/all-MiniLM-L6-v2")
+USE_LOCAL_MODEL = os.getenv("RINA_LOCAL_INTENT_MODEL", "0") == "1"
+INTENT_TIMEOUT = 10.0
 
-# Initialize OpenAI client with a timeout
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", ""), timeout=10.0)
+INTENTS = ["search_listings", "save_listing", "create_inquiry", "greeting", "fallback"]
+LANGUAGES = ["en", "sw", "sheng", "other"]
+# strict structured-output schema: every field required, nulls for absent slots
+UNDERSTANDING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {"type": "string", "enum": INTENTS},
+        "language": {"type": "string", "enum": LANGUAGES},
+        "location": {"type": ["string", "null"]},
+        "property_type": {"type": ["string", "null"], "enum": list(PROPERTY_TYPES) + [None]},
+        "max_price": {"type": ["integer", "null"]},
+        "listing_id": {"type": ["string", "null"]},
+    },
+    "required": ["intent", "language", "location", "property_type", "max_price", "listing_id"],
+    "additionalProperties": False,
+}
+# repeated messages ("hi", "more", the same search retyped) skip the completion
+UNDERSTANDING_CACHE = _TTLCache(int(os.getenv("UNDERSTANDING_CACHE_SIZE", 2048)),
+                                float(os.getenv("UNDERSTANDING_CACHE_TTL", 3600)))
 
 
 class IntentClassifier:
     def __init__(self):
         """
         This classifier now uses OpenAI's API for intent detection.
-        The local model training and prediction logic has been removed for faster deployment.
-        The code is structured to allow re-integration of a local model in the future.
+        The local model (models/intent_clf.pkl + sentence encoder) is optional and
+        only loaded when RINA_LOCAL_INTENT_MODEL=1 and the optional dependencies
+        are installed; see load_local_model().
         """
-        pass
+        self._local = None  # (encoder, clf) once loaded
+        self._local_lock = threading.Lock()
+
+    def load_local_model(self) -> bool:
+        """
+        Loads the local encoder + classifier. Safe to call before forking
+        (gunicorn --preload) so workers share the loaded weights.
+        Returns True if the local model is available.
+        """
+        if self._local is not None:
+            return True
+        if not USE_LOCAL_MODEL or not os.path.exists(LOCAL_MODEL_PATH):
+            return False
+        with self._local_lock:
+            if self._local is None:
+                try:
+                    import joblib
+                    from sentence_transformers import SentenceTransformer
+                except ImportError as e:
+                    print(f"Local intent model disabled, missing dependency: {e}")
+                    return False
+                self._local = (SentenceTransformer(LOCAL_ENCODER_NAME), joblib.load(LOCAL_MODEL_PATH))
+        return True
+
+    def predict_local(self, text: str) -> Optional[Tuple[str, float]]:
+        """
+        Predicts intent with the local model. Returns None if it is not loaded.
+        """
+        if not self.load_local_model():
+            return None
+        encoder, clf = self._local
+        probs = clf.predict_proba(encoder.encode([text]))[0]
+        best = int(probs.argmax())
+        return str(clf.classes_[best]), float(probs[best])
 
     def predict(self, text: str) -> Tuple[str, float]:
         """
-        Predicts intent using a few-shot prompt to the OpenAI API.
+        Predicts intent (from the combined understanding call).
         Returns (intent, confidence).
         """
-        return self._few_shot_openai(text)
+        understood = self.understand(text)
+        return understood["intent"], understood["confidence"]
 
-    def _few_shot_openai(self, text: str) -> Tuple[str, float]:
+    async def apredict(self, text: str) -> Tuple[str, float]:
         """
-        Performs few-shot classification using the OpenAI API.
+        Async variant of predict() for the ASGI serving path.
+        """
+        understood = await self.aunderstand(text)
+        return understood["intent"], understood["confidence"]
+
+    def understand(self, text: str) -> Dict:
         """
+        Intent, language and search slots from one structured completion:
+        {"intent", "confidence", "language", "slots": {"location", "property_type",
+        "max_price", "listing_id"}}. language is None when the model couldn't be
+        asked (callers fall back to langdetect); slots fall back to regex extraction.
+        """
+        key = _cache_key(text)
+        cached = UNDERSTANDING_CACHE.get(key)
+        if cached is not None:
+            return cached
+        try:
+            request = self._understand_request(text, timeout=stage_timeout(INTENT_TIMEOUT))
+            with guarded("openai"):
+                resp = clients.openai_client().chat.completions.create(**request)
+            understood = parse_understanding(resp.choices[0].message.content, text)
+        except Exception as e:
+            print(f"Error in OpenAI message understanding: {e}")
+            return _fallback_understanding(text)
+        UNDERSTANDING_CACHE.put(key, understood)
+        return understood
+
+    def understand_local(self, text: str) -> Dict:
+        """
+        understand() without the completion, for when OpenAI is overloaded:
+        a cached understanding if there is one, else the local model's intent
+        (only if already loaded) with regex slots. Without the local model a
+        message naming an area, room type or budget is taken as a search.
+        """
+        cached = UNDERSTANDING_CACHE.get(_cache_key(text))
+        if cached is not None:
+            return cached
+        understood = _fallback_understanding(text)
+        slots = understood["slots"]
+        slots["listing_id"] = extract_token(text)
+        if self._local is not None:
+            understood["intent"], understood["confidence"] = self.predict_local(text)
+        elif not slots["listing_id"] and (slots["location"] or slots["property_type"] or slots["max_price"]):
+            understood["intent"], understood["confidence"] = "search_listings", 0.5
+        return understood
+
+    async def aunderstand(self, text: str) -> Dict:
+        """
+        Async variant of understand() for the ASGI serving path.
+        """
+        key = _cache_key(text)
+        cached = UNDERSTANDING_CACHE.get(key)
+        if cached is not None:
+            return cached
+        try:
+            request = self._understand_request(text, timeout=stage_timeout(INTENT_TIMEOUT))
+            with guarded("openai"):
+                resp = await clients.async_openai_client().chat.completions.create(**request)
+            understood = parse_understanding(resp.choices[0].message.content, text)
+        except Exception as e:
+            print(f"Error in OpenAI message understanding: {e}")
+            return _fallback_understanding(text)
+        UNDERSTANDING_CACHE.put(key, understood)
+        return understood
+
+    def _understand_request(self, text: str, timeout: float = 10.0) -> dict:
         prompt = (
-            "You are a classifier that labels user intents into one of: "
-            "search_listings, save_listing, create_inquiry, greeting, fallback.\n\n"
+            "Label the message from a student looking for housing in Nairobi.\n"
+            "intent: search_listings, save_listing, create_inquiry, greeting or fallback.\n"
+            "language: en, sw, sheng or other.\n"
+            "location: the neighbourhood or campus mentioned, as written, else null.\n"
+            f"property_type: one of {', '.join(PROPERTY_TYPES)}, else null.\n"
+            "max_price: the monthly budget in KES as an integer ('8k' is 8000), else null.\n"
+            "listing_id: the listing ID or ID prefix the user typed, exactly as typed, else null.\n\n"
             "Examples:\n"
-            "User: 'Find me a bedsitter near Kenyatta University under 8k'\nIntent: search_listings\n"
-            "User: 'Save listing 5e3f...'\nIntent: save_listing\n"
-            "User: 'Hey, hi'\nIntent: greeting\n\n"
-            f"User: '{text}'\nIntent:"
+            "'Find me a bedsitter near Kenyatta University under 8k' -> search_listings, en, "
+            "Kenyatta University, Bedsitter, 8000, null\n"
+            "'Save listing 5e3f9a' -> save_listing, en, null, null, null, 5e3f9a\n"
+            "'Niko na budget ya 6k, keja Roysambu' -> search_listings, sheng, Roysambu, null, 6000, null\n\n"
+            f"Message: {json.dumps(text, ensure_ascii=False)}"
+        )
+        return dict(
+            model=os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini"),
+            messages=[{"role": "system", "content": "You extract structured fields from chat messages. Reply with JSON only."},
+                      {"role": "user", "content": prompt}],
+            response_format={"type": "json_schema", "json_schema": {"name": "message_understanding", "strict": True, "schema": UNDERSTANDING_SCHEMA}},
+            max_tokens=80,
+            temperature=0.0,
+            timeout=timeout,
         )
-        try:
-            resp = openai_client.chat.completions.create(
-                model=os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini"),
-                messages=[{"role": "system", "content": "You are a classifier. Reply with only one word from the list of intents."}, 
-                          {"role": "user", "content": prompt}],
-                max_tokens=8,
-                temperature=0.0,
-            )
-            raw = resp.choices[0].message.content.strip().split()[0]
-            # Remove potential punctuation from the model's response
-            intent = ''.join(filter(str.isalnum, raw))
-            
-            # List of valid intents
-            valid_intents = ["search_listings", "save_listing", "create_inquiry", "greeting", "fallback"]
-
-            if intent in valid_intents:
-                # no real confidence score from this simple approach; set a default
-                return intent, 0.9 # High confidence as it's from a powerful LLM
-            else:
-                return "fallback", 0.5
 
-        except Exception as e:
-            print(f"Error in OpenAI intent classification: {e}")
-            return "fallback", 0.0
\ No newline at end of file
+
+def _cache_key(text: str) -> str:
+    return " ".join((text or "").lower().split())
+
+
+def _fallback_understanding(text: str) -> Dict:
+    return {"intent": "fallback", "confidence": 0.0, "language": None,
+            "slots": {**extract_slots(text), "listing_id": None}}
+
+
+def parse_understanding(content: str, text: str) -> Dict:
+    """
+    Strict parser for the structured completion. Raises ValueError on anything
+    outside the schema; slot values are normalized to the canonical forms the
+    search path uses, and values the message doesn't support are dropped.
+    """
+    data = json.loads(content)
+    if not isinstance(data, dict) or set(data) != set(UNDERSTANDING_SCHEMA["properties"]):
+        raise ValueError(f"unexpected understanding fields: {content[:200]}")
+    if data["intent"] not in INTENTS:
+        raise ValueError(f"unknown intent {data['intent']!r}")
+    if data["language"] not in LANGUAGES:
+        raise ValueError(f"unknown language {data['language']!r}")
+
+    regex_slots = extract_slots(text)
+    location = data["location"] if isinstance(data["location"], str) else None
+    property_type = data["property_type"] if data["property_type"] in PROPERTY_TYPES else None
+    max_price = data["max_price"]
+    if isinstance(max_price, bool) or not isinstance(max_price, (int, float)) or not 1000 <= max_price <= MAX_RENT:
+        max_price = None
+    listing_id = data["listing_id"] if isinstance(data["listing_id"], str) else None
+    if listing_id and (listing_id.lower() not in text.lower() or not ID_TOKEN_RE.fullmatch(listing_id)):
+        listing_id = None  # only IDs the user actually typed
+    return {
+        "intent": data["intent"],
+        "confidence": 0.9,  # no calibrated score from the completion
+        "language": data["language"],
+        "slots": {
+            "location": normalize_location(location) or location or regex_slots["location"],
+            "property_type": property_type or regex_slots["property_type"],
+            "max_price": int(max_price) if max_price else regex_slots["max_price"],
+            "listing_id": listing_id,
+        },
+    }
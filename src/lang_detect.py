@@ -1,6 +1,12 @@
 
 from langdetect import detect, DetectorFactory
+from langdetect.detector_factory import init_factory
+
+from . import clients
+
 DetectorFactory.seed = 0
+# language profiles are loaded lazily on first detect(); load them during warm-up instead
+clients.register_warmup("langdetect", init_factory)
 
 SHENG_KEYWORDS = [
     "poa", "sasa", "msee", "hao", "niko", "rada", "mbona", "nani", "chill", "flani",
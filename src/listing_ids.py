@@ -0,0 +1,190 @@
+import bisect
+import os
+import re
+import threading
+import time
+from typing import List, Optional
+
+from . import supabase_client as sb
+
+# Short listing IDs. Cards show the shortest prefix of the listing UUID that no
+# other listing shares (at least SHORT_ID_MIN characters, and always with a
+# digit and a letter, so ordinary words, budgets and phone numbers are never
+# read as IDs); "save 3f9a1c" is resolved
+# against a sorted in-memory array of all listing IDs with two bisects, so a
+# save or inquiry is a single DB write. The array is loaded lazily (IDs only),
+# extended by create_listing, and reloaded every RELOAD_SECONDS or when a
+# prefix misses, to pick up listings added through other workers.
+SHORT_ID_MIN = int(os.getenv("SHORT_ID_MIN", 6))
+RELOAD_SECONDS = float(os.getenv("LISTING_ID_RELOAD_SECONDS", 600))
+MISS_RELOAD_SECONDS = 30
+PAGE_SIZE = 1000
+
+# an ID token: hex with optional hyphens, containing at least one digit and
+# one letter ("150000" is a budget, "0712345678" a phone number)
+ID_TOKEN_RE = re.compile(r"\b(?=[0-9a-f\-]*\d)(?=[0-9\-]*[a-f])[0-9a-f][0-9a-f\-]{%d,}\b" % (SHORT_ID_MIN - 1),
+                         re.IGNORECASE)
+FULL_ID_RE = re.compile(r"^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$")
+
+
+class AmbiguousListingId(ValueError):
+    def __init__(self, prefix: str, matches: List[str]):
+        super().__init__(f"listing ID prefix {prefix} matches {len(matches)}+ listings")
+        self.prefix = prefix
+        self.matches = matches
+
+
+def _common_prefix(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _typeable(prefix: str) -> bool:
+    # what ID_TOKEN_RE will pick out of a message
+    return any(c.isdigit() for c in prefix) and any(c.isalpha() for c in prefix)
+
+
+class ListingIdIndex:
+    """Sorted array of lowercase listing IDs supporting prefix lookups."""
+
+    def __init__(self, ids=()):
+        self.ids: List[str] = sorted({i.lower() for i in ids})
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, listing_id: str) -> bool:
+        key = listing_id.lower()
+        pos = bisect.bisect_left(self.ids, key)
+        return pos < len(self.ids) and self.ids[pos] == key
+
+    def add(self, listing_id: str):
+        key = listing_id.lower()
+        with self._lock:
+            pos = bisect.bisect_left(self.ids, key)
+            if pos == len(self.ids) or self.ids[pos] != key:
+                self.ids.insert(pos, key)
+
+    def lookup(self, prefix: str, limit: int = 2) -> List[str]:
+        prefix = prefix.lower()
+        ids = self.ids
+        pos = bisect.bisect_left(ids, prefix)
+        found = []
+        while pos < len(ids) and len(found) < limit and ids[pos].startswith(prefix):
+            found.append(ids[pos])
+            pos += 1
+        return found
+
+    def short_id(self, listing_id: str) -> str:
+        """Shortest prefix only this ID has: one past its common prefix with
+        either sorted neighbour."""
+        key = listing_id.lower()
+        ids = self.ids
+        pos = bisect.bisect_left(ids, key)
+        shared = 0
+        if pos > 0:
+            shared = _common_prefix(ids[pos - 1], key)
+        nxt = pos + 1 if pos < len(ids) and ids[pos] == key else pos
+        if nxt < len(ids):
+            shared = max(shared, _common_prefix(ids[nxt], key))
+        length = max(SHORT_ID_MIN, shared + 1)
+        while length < len(key) and (not _typeable(key[:length]) or key[length - 1] == "-"):
+            length += 1
+        return key[:length]
+
+
+INDEX = ListingIdIndex()
+_load_lock = threading.Lock()
+_loaded_at: Optional[float] = None
+_attempted_at: Optional[float] = None
+
+
+def _fetch_ids() -> List[str]:
+    ids: List[str] = []
+    last = None
+    while True:
+        params = {"select": "id", "order": "id.asc", "limit": str(PAGE_SIZE)}
+        if last:
+            params["id"] = f"gt.{last}"
+        resp = sb._get(f"{sb.REST_URL}/listings", params=params, headers=sb.HEADERS)
+        sb._raise_for_resp(resp)
+        page = [r["id"] for r in resp.json() or []]
+        ids.extend(page)
+        if len(page) < PAGE_SIZE:
+            return ids
+        last = page[-1]
+
+
+def is_loaded() -> bool:
+    return _loaded_at is not None
+
+
+def needs_load(max_age: float = RELOAD_SECONDS) -> bool:
+    now = time.monotonic()
+    if _attempted_at is not None and now - _attempted_at < MISS_RELOAD_SECONDS:
+        return False  # loaded (or failed) moments ago
+    return _loaded_at is None or now - _loaded_at > max_age
+
+
+def ensure_loaded(max_age: float = RELOAD_SECONDS) -> bool:
+    """(Re)loads the index if it is older than max_age; False if it couldn't."""
+    global INDEX, _loaded_at, _attempted_at
+    if not needs_load(max_age):
+        return is_loaded()
+    with _load_lock:
+        if not needs_load(max_age):
+            return is_loaded()
+        _attempted_at = time.monotonic()
+        try:
+            INDEX = ListingIdIndex(_fetch_ids())
+        except Exception as e:
+            print(f"Listing ID index load failed: {e}")
+            return is_loaded()
+        _loaded_at = _attempted_at
+        return True
+
+
+def short_id(listing_id) -> str:
+    """ID to show on a listing card; the full ID while the index is unavailable."""
+    listing_id = str(listing_id)
+    if not ensure_loaded():
+        return listing_id
+    if listing_id not in INDEX:
+        INDEX.add(listing_id)  # it was just returned by search, so it exists
+    return INDEX.short_id(listing_id)
+
+
+def extract_token(text: str) -> Optional[str]:
+    m = ID_TOKEN_RE.search(text or "")
+    return m.group(0) if m else None
+
+
+def resolve(token: str) -> Optional[str]:
+    """Full listing ID for a typed ID or prefix. Full UUIDs pass through;
+    None when nothing matches; AmbiguousListingId when several do. With no
+    index available the token is passed through unchanged."""
+    if FULL_ID_RE.match(token.lower()):
+        return token.lower()
+    if not ensure_loaded() or not len(INDEX):
+        return token
+    matches = INDEX.lookup(token)
+    if not matches and ensure_loaded(max_age=MISS_RELOAD_SECONDS):
+        matches = INDEX.lookup(token)
+    if len(matches) > 1:
+        raise AmbiguousListingId(token, matches)
+    return matches[0] if matches else None
+
+
+def _on_listing_created(rows):
+    if not is_loaded():
+        return
+    for row in rows:
+        if isinstance(row, dict) and row.get("id"):
+            INDEX.add(str(row["id"]))
+
+
+sb.on_listing_created(_on_listing_created)
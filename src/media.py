@@ -0,0 +1,298 @@
+import hashlib
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from . import clients, listing_ids
+from . import supabase_client as sb
+from .saved_searches import _whatsapp_address
+
+# Listing photos sent over WhatsApp. The webhook only queues the Twilio media
+# URLs and acknowledges; WORKERS background threads do the rest, so photo
+# uploads never hold up a chat reply:
+#
+# 1. check the sender owns the target listing: the ID typed in the caption,
+#    else their most recent listing (media_target_listing RPC)
+# 2. stream each file in CHUNK_BYTES pieces into a spooled temp file (memory
+#    stays under SPOOL_BYTES), hashing as it goes and giving up past MAX_BYTES
+# 3. store it in the Storage bucket under its sha256, so a photo sent twice
+#    is uploaded once, plus a THUMBNAIL_SIZE JPEG when Pillow is installed
+# 4. append the URLs to listings.photos in batches gathered over
+#    BATCH_SECONDS, one append_listing_photos RPC per batch
+#
+# See Step 10 of migrations.sql. The queue is in-process: media still queued
+# when a worker process exits is lost, and the landlord can resend it.
+ENABLED = os.getenv("MEDIA_ENABLED", "1") == "1"
+WORKERS = int(os.getenv("MEDIA_WORKERS", 2))
+QUEUE_SIZE = int(os.getenv("MEDIA_QUEUE_SIZE", 500))
+MAX_BYTES = int(float(os.getenv("MEDIA_MAX_MB", 10)) * 1024 * 1024)
+BUCKET = os.getenv("MEDIA_BUCKET", "listing-photos")
+BATCH_SECONDS = float(os.getenv("MEDIA_BATCH_SECONDS", 3))
+WHATSAPP_FROM = os.getenv("TWILIO_WHATSAPP_FROM", "")
+CHUNK_BYTES = 64 * 1024
+SPOOL_BYTES = 1024 * 1024
+THUMBNAIL_SIZE = (480, 480)
+DOWNLOAD_TIMEOUT = (5, 30)  # connect, per read
+UPLOAD_TIMEOUT = 60.0
+
+STORAGE_URL = sb.SUPABASE_URL.rstrip("/") + "/storage/v1"
+EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp"}
+
+
+class MediaTooLarge(ValueError):
+    pass
+
+
+def _twilio_auth() -> Optional[Tuple[str, str]]:
+    sid, token = os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN")
+    return (sid, token) if sid and token else None
+
+
+def download(url: str, max_bytes: Optional[int] = None):
+    """(spooled file at offset 0, sha256 hex, content type). Raises
+    MediaTooLarge as soon as the body passes max_bytes (MAX_BYTES)."""
+    max_bytes = max_bytes or MAX_BYTES
+    # Twilio media URLs need the account's basic auth and redirect to a signed
+    # URL on another host; requests drops the auth header on that redirect
+    with requests.get(url, stream=True, auth=_twilio_auth(), timeout=DOWNLOAD_TIMEOUT) as resp:
+        resp.raise_for_status()
+        if int(resp.headers.get("Content-Length") or 0) > max_bytes:
+            raise MediaTooLarge(f"{url} is {resp.headers['Content-Length']} bytes")
+        content_type = resp.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        digest, size = hashlib.sha256(), 0
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        try:
+            for chunk in resp.iter_content(CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise MediaTooLarge(f"{url} is over {max_bytes} bytes")
+                digest.update(chunk)
+                spool.write(chunk)
+        except Exception:
+            spool.close()
+            raise
+    spool.seek(0)
+    return spool, digest.hexdigest(), content_type
+
+
+_pil_missing_logged = False
+
+
+def make_thumbnail(fileobj) -> Optional[bytes]:
+    """JPEG thumbnail within THUMBNAIL_SIZE; None without Pillow."""
+    global _pil_missing_logged
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pil_missing_logged:
+            print("Thumbnails disabled: Pillow is not installed")
+            _pil_missing_logged = True
+        return None
+    fileobj.seek(0)
+    with Image.open(fileobj) as img:
+        img.draft("RGB", THUMBNAIL_SIZE)  # JPEGs decode straight at a reduced scale
+        thumb = img.convert("RGB")
+        thumb.thumbnail(THUMBNAIL_SIZE)
+        out = io.BytesIO()
+        thumb.save(out, "JPEG", quality=80, optimize=True)
+    return out.getvalue()
+
+
+def public_url(path: str) -> str:
+    return f"{STORAGE_URL}/object/public/{BUCKET}/{path}"
+
+
+def upload(path: str, data, content_type: str) -> str:
+    """Stores data at path in the bucket unless it is already there; returns its public URL."""
+    headers = {"apikey": sb.SERVICE_KEY, "Authorization": f"Bearer {sb.SERVICE_KEY}",
+               "Content-Type": content_type, "x-upsert": "false"}
+    resp = requests.post(f"{STORAGE_URL}/object/{BUCKET}/{path}", data=data, headers=headers, timeout=UPLOAD_TIMEOUT)
+    # content-addressed paths: an existing object is the same photo
+    if resp.status_code in (400, 409) and ("exists" in resp.text.lower() or "duplicate" in resp.text.lower()):
+        return public_url(path)
+    sb._raise_for_resp(resp)
+    return public_url(path)
+
+
+# sha256 -> public URL of photos this process has already stored
+_stored = sb._TTLCache(4096, ttl=24 * 3600)
+
+
+def store(url: str) -> Optional[str]:
+    """Downloads one media URL and stores it (and its thumbnail); the photo's
+    public URL, or None when it isn't a supported image."""
+    spool, sha, content_type = download(url)
+    with spool:
+        ext = EXTENSIONS.get(content_type)
+        if ext is None:
+            print(f"Skipping media {url}: unsupported type {content_type!r}")
+            return None
+        cached = _stored.get(sha)
+        if cached:
+            return cached
+        photo_url = upload(f"{sha}.{ext}", spool, content_type)
+        try:
+            thumb = make_thumbnail(spool)
+            if thumb:
+                upload(f"thumbs/{sha}.jpg", thumb, "image/jpeg")
+        except Exception as e:
+            print(f"Thumbnail for {sha} failed: {e}")
+    _stored.put(sha, photo_url)
+    return photo_url
+
+
+def target_listing(phone: str, token: Optional[str]) -> Optional[str]:
+    """Listing the photos go to, if the sender owns it."""
+    listing_id = None
+    if token:
+        listing_id = listing_ids.resolve(token)  # may raise AmbiguousListingId
+        if listing_id is None or not listing_ids.FULL_ID_RE.match(listing_id):
+            return None
+    resp = sb._post(f"{sb.REST_URL}/rpc/media_target_listing",
+                    json={"p_phone": phone, "p_listing_id": listing_id}, headers=sb.HEADERS)
+    sb._raise_for_resp(resp)
+    return resp.json() or None
+
+
+def _notify(phone: str, text: str):
+    client = clients.twilio_client()
+    if client is None or not WHATSAPP_FROM:
+        print(f"Media notice for {phone} not sent: {text}")
+        return
+    try:
+        client.messages.create(from_=_whatsapp_address(WHATSAPP_FROM), to=_whatsapp_address(phone), body=text)
+    except Exception as e:
+        print(f"Media notice for {phone} failed: {e}")
+
+
+# Appending to listings.photos, batched like saved-search alerts
+_pending: List[Dict] = []
+_pending_lock = threading.Lock()
+_flush_timer: Optional[threading.Timer] = None
+
+
+def _add_pending(items: List[Dict]):
+    global _flush_timer
+    with _pending_lock:
+        _pending.extend(items)
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(BATCH_SECONDS, flush)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+
+def flush() -> int:
+    """Appends the pending photo URLs in one RPC; returns the listings updated."""
+    global _flush_timer
+    with _pending_lock:
+        batch = list(_pending)
+        _pending.clear()
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+    if not batch:
+        return 0
+    try:
+        resp = sb._post(f"{sb.REST_URL}/rpc/append_listing_photos", json={"p_items": batch}, headers=sb.HEADERS)
+        sb._raise_for_resp(resp)
+    except Exception as e:
+        print(f"Appending {len(batch)} listing photos failed: {e}")
+        return 0
+    updated = resp.json() or 0
+    print(f"Listing photos: {len(batch)} appended to {updated} listings")
+    return updated
+
+
+def process(job: Dict):
+    """One WhatsApp message's media: {"phone", "token", "urls"}."""
+    phone = job["phone"]
+    try:
+        listing_id = target_listing(phone, job.get("token"))
+    except listing_ids.AmbiguousListingId as e:
+        _notify(phone, f"Listing ID {e.prefix} matches several listings; resend the photos with more of the ID.")
+        return
+    if not listing_id:
+        _notify(phone, "I couldn't find a listing of yours to add these photos to. "
+                       "Send them with the listing ID as the caption.")
+        return
+    stored = []
+    for url in job["urls"]:
+        try:
+            photo_url = store(url)
+        except Exception as e:
+            print(f"Media {url} not stored: {e}")
+            continue
+        if photo_url:
+            stored.append({"listing_id": listing_id, "url": photo_url})
+    if stored:
+        _add_pending(stored)
+
+
+_queue: "queue.Queue[Dict]" = queue.Queue(maxsize=QUEUE_SIZE)
+_workers: List[threading.Thread] = []
+_workers_lock = threading.Lock()
+
+
+def _work():
+    while True:
+        job = _queue.get()
+        try:
+            process(job)
+        except Exception as e:
+            print(f"Media job for {job.get('phone')} failed: {e}")
+        finally:
+            _queue.task_done()
+
+
+def _start_workers():
+    # started on first use, so each gunicorn worker (after fork) runs its own
+    with _workers_lock:
+        while len(_workers) < WORKERS:
+            t = threading.Thread(target=_work, name=f"rina-media-{len(_workers)}", daemon=True)
+            t.start()
+            _workers.append(t)
+
+
+def enqueue(phone: str, caption: str, urls: List[str]) -> bool:
+    """Queues a message's media for the workers; False when the queue is full."""
+    _start_workers()
+    try:
+        _queue.put_nowait({"phone": phone, "token": listing_ids.extract_token(caption), "urls": urls})
+        return True
+    except queue.Full:
+        print(f"Media queue full, dropping {len(urls)} items from {phone}")
+        return False
+
+
+def drain(timeout: float = 30.0) -> bool:
+    """Waits for queued media to be processed and flushes the pending batch."""
+    give_up = time.monotonic() + timeout
+    while _queue.unfinished_tasks and time.monotonic() < give_up:
+        time.sleep(0.05)
+    flush()
+    return not _queue.unfinished_tasks
+
+
+def webhook_reply(values: Dict, phone: str) -> Optional[str]:
+    """Queues a Twilio message's image attachments and returns the reply to
+    send instead of a chat answer; None when the message has no media."""
+    num_media = int(values.get("NumMedia") or 0)
+    if num_media <= 0:
+        return None
+    if not ENABLED:
+        return "Sorry, I can't receive photos right now."
+    urls = [values.get(f"MediaUrl{i}") for i in range(num_media)
+            if values.get(f"MediaContentType{i}", "").lower() in EXTENSIONS and values.get(f"MediaUrl{i}")]
+    if not urls:
+        return "I can only add photos (JPEG, PNG or WebP) to listings."
+    if not enqueue(phone, values.get("Body", ""), urls):
+        return "Sorry, I'm receiving a lot of photos right now. Please send them again in a few minutes."
+    token = listing_ids.extract_token(values.get("Body", ""))
+    target = f"listing {token}" if token else "your most recent listing"
+    return f"📷 Got {len(urls)} photo{'s' if len(urls) > 1 else ''} — adding them to {target}."
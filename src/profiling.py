@@ -0,0 +1,277 @@
+import argparse
+import contextvars
+import functools
+import glob
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .tracing import TRACE_DIR
+
+# Opt-in request profiling. A request is profiled when it carries the admin
+# header (value must equal ADMIN_API_KEY) or when it is picked by the sampling
+# rate. Profiles are written as collapsed stacks ("a;b;c <count>") so they can
+# be fed straight into flamegraph.pl / speedscope.
+PROFILE_DIR = os.path.abspath(os.path.join(TRACE_DIR, "profiles"))
+PROFILE_INDEX_PATH = os.path.join(PROFILE_DIR, "index.jsonl")
+PROFILE_HEADER = "X-Rina-Profile"
+
+PROFILE_SAMPLE_RATE = float(os.getenv("RINA_PROFILE_SAMPLE_RATE", "0") or 0)
+PROFILE_MODE = os.getenv("RINA_PROFILE_MODE", "sampling").lower()  # sampling | deterministic
+PROFILE_INTERVAL = float(os.getenv("RINA_PROFILE_INTERVAL_MS", "5") or 5) / 1000.0
+
+_current_profile: contextvars.ContextVar = contextvars.ContextVar("rina_profile", default=None)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{module}:{name}"
+
+
+def _cfunc_label(func) -> str:
+    module = getattr(func, "__module__", None) or "builtins"
+    name = getattr(func, "__qualname__", None) or getattr(func, "__name__", "?")
+    return f"{module}:{name}"
+
+
+class SamplingProfiler:
+    """Samples the target thread's stack every `interval` seconds.
+    Counts are number of samples per stack."""
+
+    unit = "samples"
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = max(interval, 0.0005)
+        self.counts: Counter = Counter()
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._sampler = threading.Thread(target=self._run, name="rina-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.reverse()
+            self.counts[";".join(stack)] += 1
+
+
+class DeterministicProfiler:
+    """Hooks every call/return on the current thread via sys.setprofile.
+    Counts are self-time in microseconds per stack. Much higher overhead
+    than sampling; use it for short, targeted captures only."""
+
+    unit = "us"
+
+    def __init__(self):
+        self._ns: Counter = Counter()
+        self._path: List[str] = []
+        self._last = 0
+
+    @property
+    def counts(self) -> Counter:
+        return Counter({k: v // 1000 for k, v in self._ns.items() if v >= 1000})
+
+    def _callback(self, frame, event, arg):
+        now = time.perf_counter_ns()
+        if self._path:
+            self._ns[";".join(self._path)] += now - self._last
+        if event == "call":
+            self._path.append(_frame_label(frame))
+        elif event == "c_call":
+            self._path.append(_cfunc_label(arg))
+        elif self._path and event in ("return", "c_return", "c_exception"):
+            self._path.pop()
+        self._last = time.perf_counter_ns()
+
+    def start(self):
+        self._last = time.perf_counter_ns()
+        sys.setprofile(self._callback)
+
+    def stop(self):
+        sys.setprofile(None)
+
+
+def should_profile(headers) -> bool:
+    """Admin header wins; otherwise fall back to the sampling rate."""
+    token = headers.get(PROFILE_HEADER) if headers else None
+    admin_key = os.getenv("ADMIN_API_KEY")
+    if token and admin_key and hmac.compare_digest(token, admin_key):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def current_profile_id() -> Optional[str]:
+    """Id of the profile being captured for the current request, if any."""
+    return _current_profile.get()
+
+
+def write_profile(profile_id: str, endpoint: str, counts: Dict[str, int], unit: str, duration_ms: float) -> Optional[str]:
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{profile_id}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(PROFILE_INDEX_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "profile_id": profile_id,
+                "endpoint": endpoint,
+                "ts": int(time.time() * 1000),
+                "mode": PROFILE_MODE,
+                "unit": unit,
+                "duration_ms": round(duration_ms, 2),
+                "total": sum(counts.values()),
+            }) + "\n")
+        return path
+    except Exception as e:
+        print("Warning: failed to write profile:", e)
+        return None
+
+
+def run_profiled(endpoint: str, fn: Callable, *args, **kwargs):
+    profiler = DeterministicProfiler() if PROFILE_MODE == "deterministic" else SamplingProfiler()
+    profile_id = f"{endpoint}-{uuid.uuid4()}"
+    token = _current_profile.set(profile_id)
+    started = time.perf_counter()
+    profiler.start()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.stop()
+        _current_profile.reset(token)
+        write_profile(profile_id, endpoint, profiler.counts, profiler.unit, (time.perf_counter() - started) * 1000)
+
+
+def profiled(endpoint: str):
+    """Decorator for Flask views: profiles the view when should_profile()
+    accepts the current request."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            from flask import request
+            if not should_profile(request.headers):
+                return view(*args, **kwargs)
+            return run_profiled(endpoint, view, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Aggregation CLI
+def iter_collapsed(paths: Iterable[str]) -> Iterable[Tuple[List[str], int]]:
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if not stack or not count.isdigit():
+                    continue
+                yield stack.split(";"), int(count)
+
+
+def _select_profiles(profile_dir: str, endpoint: Optional[str], unit: Optional[str]) -> List[str]:
+    if not endpoint and not unit:
+        return sorted(glob.glob(os.path.join(profile_dir, "*.folded")))
+    selected = []
+    index_path = os.path.join(profile_dir, "index.jsonl")
+    if not os.path.exists(index_path):
+        return selected
+    with open(index_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if endpoint and entry.get("endpoint") != endpoint:
+                continue
+            if unit and entry.get("unit") != unit:
+                continue
+            path = os.path.join(profile_dir, f"{entry['profile_id']}.folded")
+            if os.path.exists(path):
+                selected.append(path)
+    return selected
+
+
+def aggregate(paths: Iterable[str]) -> Tuple[Counter, Counter, int]:
+    """Returns (self counts, inclusive counts, grand total) per function."""
+    self_counts: Counter = Counter()
+    total_counts: Counter = Counter()
+    grand_total = 0
+    for frames, count in iter_collapsed(paths):
+        grand_total += count
+        self_counts[frames[-1]] += count
+        # recursion must not count a function twice for the same stack
+        for fn in set(frames):
+            total_counts[fn] += count
+    return self_counts, total_counts, grand_total
+
+
+def _cmd_top(args):
+    paths = _select_profiles(args.dir, args.endpoint, args.unit)
+    if not paths:
+        print("No profiles found in", args.dir)
+        return
+    self_counts, total_counts, grand_total = aggregate(paths)
+    ranking = total_counts if args.sort == "total" else self_counts
+    print(f"{len(paths)} profiles, {grand_total} total")
+    print(f"{'self%':>7} {'total%':>7}  function")
+    for fn, _ in ranking.most_common(args.n):
+        self_pct = 100.0 * self_counts[fn] / grand_total if grand_total else 0.0
+        total_pct = 100.0 * total_counts[fn] / grand_total if grand_total else 0.0
+        print(f"{self_pct:7.2f} {total_pct:7.2f}  {fn}")
+
+
+def _cmd_merge(args):
+    merged: Counter = Counter()
+    for frames, count in iter_collapsed(_select_profiles(args.dir, args.endpoint, args.unit)):
+        merged[";".join(frames)] += count
+    for stack, count in merged.most_common():
+        print(f"{stack} {count}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Aggregate RINA request profiles")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    top = sub.add_parser("top", help="print the top-N hot functions across profiles")
+    top.add_argument("-n", type=int, default=20)
+    top.add_argument("--sort", choices=["self", "total"], default="self")
+
+    merge = sub.add_parser("merge", help="print merged collapsed stacks (pipe into flamegraph.pl)")
+
+    for p in (top, merge):
+        p.add_argument("--dir", default=PROFILE_DIR)
+        p.add_argument("--endpoint", help="only profiles for this endpoint (webhook, chat_api)")
+        p.add_argument("--unit", choices=["samples", "us"], help="only sampling or deterministic profiles")
+
+    args = parser.parse_args(argv)
+    if args.command == "top":
+        _cmd_top(args)
+    else:
+        _cmd_merge(args)
+
+
+if __name__ == "__main__":
+    main()
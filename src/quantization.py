@@ -0,0 +1,126 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Compact storage for embedding matrices kept in process (caches, local
+# indexes). text-embedding-3 vectors are unit length, so int8 with one scale
+# per vector loses very little ranking quality at a quarter of the float32
+# size; float16 halves it with practically no loss.
+STORAGE_DTYPES = ("float32", "float16", "int8")
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    m = np.asarray(vectors, dtype=np.float32)
+    if m.ndim == 1:
+        m = m[None, :]
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+
+def truncate_dimensions(vectors, dims: int) -> np.ndarray:
+    """Shorten text-embedding-3 vectors to `dims` and re-normalize. Gives the same
+    vectors the API returns for `dimensions=dims`, so stored full-size embeddings
+    can be reduced without re-embedding."""
+    return normalize_rows(np.asarray(vectors, dtype=np.float32)[..., :dims])
+
+
+def to_wire(vector: Sequence[float], decimals: int = 6) -> List[float]:
+    """Round for JSON transport; pgvector stores float32 so extra digits are noise."""
+    return [round(float(x), decimals) for x in vector]
+
+
+def quantize_int8(vectors) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-vector int8 quantization. Returns (codes, scales) with
+    vectors ~= codes * scales[:, None]."""
+    m = np.asarray(vectors, dtype=np.float32)
+    if m.ndim == 1:
+        m = m[None, :]
+    scales = np.abs(m).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(m / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, None]
+
+
+class QuantizedIndex:
+    """
+    Brute-force cosine index over vectors stored as float32, float16 or int8.
+    With keep_float=True the original float32 vectors are kept as well and the
+    top `rescore` approximate candidates are re-ranked exactly.
+    """
+
+    def __init__(self, vectors, ids: Sequence, dtype: str = "int8", dims: Optional[int] = None, keep_float: bool = False):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"dtype must be one of {STORAGE_DTYPES}")
+        m = truncate_dimensions(vectors, dims) if dims else normalize_rows(vectors)
+        self.ids = list(ids)
+        self.dtype = dtype
+        self.dims = m.shape[1]
+        self.scales = None
+        if dtype == "int8":
+            self.data, self.scales = quantize_int8(m)
+        elif dtype == "float16":
+            self.data = m.astype(np.float16)
+        else:
+            self.data = m
+        self.full = m if keep_float and dtype != "float32" else None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the scoring matrix (excludes the optional float copy)."""
+        return int(self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    def _query(self, query) -> np.ndarray:
+        q = np.asarray(query, dtype=np.float32)[: self.dims]
+        norm = np.linalg.norm(q)
+        return q / norm if norm else q
+
+    def scores(self, query) -> np.ndarray:
+        q = self._query(query)
+        if self.dtype == "int8":
+            return (self.data @ q) * self.scales
+        return self.data.astype(np.float32, copy=False) @ q
+
+    def search(self, query, k: int = 10, rescore: int = 0) -> List[Tuple[object, float]]:
+        """Top-k (id, similarity). rescore > k re-ranks that many approximate
+        candidates with the exact float vectors when they were kept."""
+        if not self.ids:
+            return []
+        scores = self.scores(query)
+        n = len(scores)
+        pool = min(max(k, rescore if self.full is not None else k), n)
+        candidates = np.argpartition(-scores, pool - 1)[:pool]
+        if self.full is not None and rescore > k:
+            exact = self.full[candidates] @ self._query(query)
+            order = candidates[np.argsort(-exact)][:k]
+            exact_by_idx = dict(zip(candidates.tolist(), exact.tolist()))
+            return [(self.ids[i], float(exact_by_idx[i])) for i in order]
+        order = candidates[np.argsort(-scores[candidates])][:k]
+        return [(self.ids[i], float(scores[i])) for i in order]
+
+    def save(self, path: str):
+        arrays = {"data": self.data, "ids": np.asarray(self.ids, dtype=object)}
+        if self.scales is not None:
+            arrays["scales"] = self.scales
+        if self.full is not None:
+            arrays["full"] = self.full
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "QuantizedIndex":
+        stored = np.load(path, allow_pickle=True)
+        index = cls.__new__(cls)
+        index.data = stored["data"]
+        index.ids = stored["ids"].tolist()
+        index.scales = stored["scales"] if "scales" in stored.files else None
+        index.full = stored["full"] if "full" in stored.files else None
+        index.dtype = "int8" if index.data.dtype == np.int8 else str(index.data.dtype)
+        index.dims = index.data.shape[1]
+        return index
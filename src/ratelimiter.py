@@ -1,27 +1,15 @@
 import os
 import time
 import redis
-from dotenv import load_dotenv
 
-load_dotenv()
-
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
-
-# Connect to Redis
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
-    redis_client.ping()
-    print("Connected to Redis.")
-except redis.exceptions.ConnectionError as e:
-    print(f"Could not connect to Redis: {e}. Rate limiting will not work.")
-    redis_client = None
+from . import clients
 
 # allow N requests per window seconds
 DEFAULT_MAX = 6
 DEFAULT_WINDOW = 15  # seconds
 
 def allow_request(user_id: str, max_requests: int = DEFAULT_MAX, window_seconds: int = DEFAULT_WINDOW) -> bool:
+    redis_client = clients.redis_client()
     if not redis_client:
         return True # Fail open if Redis is not available
 
@@ -44,6 +32,7 @@ def allow_request(user_id: str, max_requests: int = DEFAULT_MAX, window_seconds:
     return False
 
 def time_until_reset(user_id: str) -> float:
+    redis_client = clients.redis_client()
     if not redis_client:
         return 0.0
 
@@ -5,7 +5,8 @@
 from typing import List, Dict
 
 
-def rerank_candidates(candidates: List[Dict], property_type: str = None, max_price: int = None, furnishing: str = None, top_k: int = 5) -> List[Dict]:
+def rerank_candidates(candidates: List[Dict], property_type: str = None, max_price: int = None, furnishing: str = None, top_k: int = 5,
+                      distance_scale_km: float = None) -> List[Dict]:
     def score_fn(item: Dict) -> float:
         base = float(item.get("similarity", 0.0))
         
@@ -24,6 +25,10 @@ def rerank_candidates(candidates: List[Dict], property_type: str = None, max_pri
             if furnishing.lower() in str(item.get("furnishing")).lower():
                 base += 0.1
 
+        # Distance-to-landmark boost ("near <campus>" searches set distance_km)
+        if distance_scale_km and item.get("distance_km") is not None:
+            base += 0.3 * max(0.0, 1 - float(item["distance_km"]) / distance_scale_km)
+
         # Neighborhood rating boost
         if item.get("neighborhood_rating"):
             base += float(item.get("neighborhood_rating")) / 10.0 # Normalize to 0-0.5 range
@@ -0,0 +1,283 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Optional
+
+# Request deadlines, circuit breakers and hedged calls for OpenAI / Supabase.
+#
+# A handler opens `with deadline(REQUEST_BUDGET_SECONDS):` and every stage below
+# it sizes its own timeout with stage_timeout(cap), so one message can never
+# take longer than the budget in total (Twilio gives up on the webhook at 15s).
+# Each dependency has a CircuitBreaker: after repeated failures calls fail
+# fast with CircuitOpenError and callers answer with their canned replies
+# until a trial call succeeds again.
+REQUEST_BUDGET_SECONDS = float(os.getenv("RINA_REQUEST_BUDGET", 12.0))
+MIN_STAGE_SECONDS = 0.05
+HEDGING_ENABLED = os.getenv("RINA_HEDGING", "0") == "1"
+HEDGE_MIN_SAMPLES = 20
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar("rina_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget is used up."""
+
+
+class CircuitOpenError(Exception):
+    """The dependency is failing; the call was not attempted."""
+
+
+@contextmanager
+def deadline(seconds: float = REQUEST_BUDGET_SECONDS):
+    """Sets the request deadline for everything called inside the block.
+    A nested deadline can only shorten the outer one."""
+    at = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(min(at, outer) if outer is not None else at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left in the current request, or None outside a deadline."""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def stage_timeout(cap: float) -> float:
+    """Timeout for the next stage: its own cap, shortened to what is left of
+    the request budget. Raises DeadlineExceeded when nothing useful is left."""
+    left = remaining()
+    if left is None:
+        return cap
+    if left < MIN_STAGE_SECONDS:
+        raise DeadlineExceeded("request budget exhausted")
+    return min(cap, left)
+
+
+class LatencyTracker:
+    """Recent latencies of one operation, for hedging delays and load signals."""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)  # (recorded_at, seconds)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append((time.monotonic(), seconds))
+
+    def percentile(self, pct: float, max_age: Optional[float] = None) -> Optional[float]:
+        """pct-th percentile of the kept samples, or of those from the last
+        max_age seconds; None when there are none."""
+        since = time.monotonic() - max_age if max_age is not None else None
+        with self._lock:
+            ordered = sorted(v for t, v in self._samples if since is None or t >= since)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failures; open -> half-open
+    after `reset_timeout` seconds, when a single trial call is let through; the
+    trial's outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency = LatencyTracker()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def record_success(self, seconds: Optional[float] = None):
+        if seconds is not None:
+            self.latency.record(seconds)
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """Ends a half-open trial without counting it either way (the call was
+        cancelled, or failed for a reason that says nothing about the dependency)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    print(f"Circuit {self.name} opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+BREAKERS: Dict[str, CircuitBreaker] = {
+    "openai": CircuitBreaker("openai"),
+    "supabase": CircuitBreaker("supabase"),
+}
+
+
+def breaker(name: str) -> CircuitBreaker:
+    return BREAKERS[name]
+
+
+@contextmanager
+def guarded(name: str):
+    """Runs the block through the named breaker: fails fast when open, and
+    records the outcome and latency otherwise."""
+    b = breaker(name)
+    b.check()
+    started = time.monotonic()
+    try:
+        yield b
+    except Exception as e:
+        if _is_client_error(e):
+            b.release_trial()
+        else:
+            b.record_failure()
+        raise
+    except BaseException:
+        # cancelled (e.g. the losing call of ahedged); don't leave a trial hanging
+        b.release_trial()
+        raise
+    b.record_success(time.monotonic() - started)
+
+
+def _is_client_error(e: Exception) -> bool:
+    # 4xx API errors (openai.APIStatusError and the like) are bugs in our
+    # request, not an outage; like supabase_client._send, only 5xx count
+    status = getattr(e, "status_code", None)
+    return isinstance(status, int) and status < 500
+
+
+# Hedged requests: for idempotent reads, start a duplicate call once the first
+# has taken longer than the operation's recent p95 and keep whichever answers
+# first. Only enabled with RINA_HEDGING=1.
+_hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv("RINA_HEDGE_THREADS", 16)), thread_name_prefix="rina-hedge")
+_hedge_trackers: Dict[str, LatencyTracker] = {}
+
+
+def _hedge_delay(operation: str) -> Optional[float]:
+    if not HEDGING_ENABLED:
+        return None
+    tracker = _hedge_trackers.setdefault(operation, LatencyTracker())
+    if len(tracker) < HEDGE_MIN_SAMPLES:
+        return None
+    return tracker.percentile(95)
+
+
+def hedged(operation: str, fn: Callable, *args, **kwargs):
+    delay = _hedge_delay(operation)
+    tracker = _hedge_trackers.setdefault(operation, LatencyTracker())
+    started = time.monotonic()
+    if delay is None:
+        result = fn(*args, **kwargs)
+        tracker.record(time.monotonic() - started)
+        return result
+
+    first = _hedge_pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    done, _ = wait([first], timeout=delay)
+    if not done:
+        second = _hedge_pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded(f"{operation} timed out")
+            for f in done:
+                if f.exception() is None:
+                    tracker.record(time.monotonic() - started)
+                    return f.result()
+                error = f.exception()
+        raise error
+    result = first.result()
+    tracker.record(time.monotonic() - started)
+    return result
+
+
+async def ahedged(operation: str, make_call: Callable[[], Awaitable]):
+    """Async variant of hedged(); make_call() must return a fresh awaitable."""
+    delay = _hedge_delay(operation)
+    tracker = _hedge_trackers.setdefault(operation, LatencyTracker())
+    started = time.monotonic()
+    if delay is None:
+        result = await make_call()
+        tracker.record(time.monotonic() - started)
+        return result
+
+    first = asyncio.ensure_future(make_call())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    pending = {first}
+    if not done:
+        pending.add(asyncio.ensure_future(make_call()))
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded(f"{operation} timed out")
+            for task in done:
+                if task.exception() is None:
+                    tracker.record(time.monotonic() - started)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def budgeted(fn):
+    """Flask view decorator: runs the view under a REQUEST_BUDGET_SECONDS deadline."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with deadline(REQUEST_BUDGET_SECONDS):
+            return fn(*args, **kwargs)
+
+    return wrapper
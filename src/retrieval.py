@@ -1,48 +1,192 @@
 
+import asyncio
 import os
 import math
 import numpy as np
-from typing import List, Dict
-from dotenv import load_dotenv
-import requests
-from openai import OpenAI
+from typing import Dict, List, Optional
 
+from . import clients
 from . import supabase_client as sb
-
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-if not OPENAI_API_KEY:
-    raise RuntimeError("OPENAI_API_KEY missing")
+from . import async_supabase_client as asb
+from . import geo_index
+from .gazetteer import AREA_RADIUS_KM, NEAR_RADIUS_KM, find_landmark, geocode
+from .quantization import to_wire
+from .reranker import rerank_candidates
+from .resilience import ahedged, guarded, hedged, stage_timeout
+from .slots import extract_slots, normalize_property_type
 
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
-
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# 0 keeps the model's full size (1536 for text-embedding-3-small). A smaller
+# value uses the `dimensions` parameter of text-embedding-3 models and searches
+# listings_embeddings.embedding_reduced instead (see migrations.sql).
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 0) or 0)
+MATCH_RPC = "match_listings_reduced" if EMBEDDING_DIMENSIONS else "match_listings"
 
 REST_URL = sb.REST_URL
 HEADERS = sb.HEADERS
 REQUEST_TIMEOUT = getattr(sb, "REQUEST_TIMEOUT", 10.0)
+EMBEDDING_TIMEOUT = 8.0
 
+# "near <campus/area>" searches score only the listings the geo index finds
+# within the radius (nearest GEO_CANDIDATE_LIMIT), then rank by similarity,
+# slots and distance. GEO_SEARCH=0 sends them through plain vector search.
+GEO_SEARCH_ENABLED = os.getenv("GEO_SEARCH", "1") == "1"
+GEO_CANDIDATE_LIMIT = int(os.getenv("GEO_CANDIDATE_LIMIT", 200))
+GEO_MATCH_THRESHOLD = 0.2
 
-def embed_text(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
-    resp = openai_client.embeddings.create(model=model, input=text)
+
+def embedding_kwargs(dimensions: int = EMBEDDING_DIMENSIONS) -> Dict:
+    return {"dimensions": dimensions} if dimensions else {}
+
+
+def _embed_once(text: str, model: str) -> List[float]:
+    timeout = stage_timeout(EMBEDDING_TIMEOUT)
+    with guarded("openai"):
+        resp = clients.openai_client().embeddings.create(model=model, input=text, timeout=timeout, **embedding_kwargs())
     return resp.data[0].embedding
 
 
-def retrieve_listings(query: str, top_k: int = 5) -> List[Dict]:
+def embed_text(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+    # embeddings and the match RPC are idempotent reads, so they may be hedged
+    return hedged("embedding", _embed_once, text, model)
+
+
+def _match(body: Dict) -> List[Dict]:
+    r = sb._post(f"{REST_URL}/rpc/{MATCH_RPC}", headers=HEADERS, json=body)
+    sb._raise_for_resp(r)
+    return r.json()
+
+
+def _geo_scope(query: str, slots: Optional[Dict] = None):
+    """(place, radius_km, {listing_id: km}) for a location-constrained query,
+    or None to use plain vector search. Widens the radius once if empty."""
+    if not GEO_SEARCH_ENABLED:
+        return None
+    landmark = find_landmark(query)
+    if not landmark and slots and slots.get("location"):
+        # the understanding stage may name a place the phrasing didn't match
+        place = geocode(slots["location"])
+        landmark = place and (place, NEAR_RADIUS_KM if place["kind"] == "campus" else AREA_RADIUS_KM)
+    if not landmark or not geo_index.ensure_loaded() or not len(geo_index.INDEX):
+        return None
+    place, radius = landmark
+    hits = geo_index.INDEX.within(place["lat"], place["lon"], radius, limit=GEO_CANDIDATE_LIMIT)
+    if not hits:
+        radius *= 2
+        hits = geo_index.INDEX.within(place["lat"], place["lon"], radius, limit=GEO_CANDIDATE_LIMIT)
+    return place, radius, dict(hits)
+
+
+def _geo_body(query_embedding: List[float], distances: Dict, top_k: int) -> Dict:
+    return {
+        "query_embedding": to_wire(query_embedding),
+        "candidate_ids": list(distances),
+        "match_threshold": GEO_MATCH_THRESHOLD,
+        "match_count": max(4 * top_k, 20),
+        "reduced": bool(EMBEDDING_DIMENSIONS),
+    }
+
+
+def _rank_nearby(rows: List[Dict], slots: Dict, place: Dict, radius: float, distances: Dict, top_k: int) -> List[Dict]:
+    for r in rows:
+        r["distance_km"] = round(distances.get(r.get("id"), radius), 1)
+        r["landmark"] = place["name"]
+    return rerank_candidates(rows, property_type=slots["property_type"], max_price=slots["max_price"],
+                             top_k=top_k, distance_scale_km=radius)
+
+
+def _match_in(body: Dict) -> List[Dict]:
+    r = sb._post(f"{REST_URL}/rpc/match_listings_in", headers=HEADERS, json=body)
+    sb._raise_for_resp(r)
+    return r.json()
+
+
+def _filter_by_slots(rows: List[Dict], slots: Dict, top_k: int) -> List[Dict]:
+    """Listings meeting the type/budget slots first (in similarity order), topped
+    up with the rest; the "filtered hybrid" configuration of eval_retrieval.py."""
+    def fits(r: Dict) -> bool:
+        if slots.get("property_type") and normalize_property_type(r.get("property_type") or r.get("title")) != slots["property_type"]:
+            return False
+        return not slots.get("max_price") or float(r.get("price") or 0) <= slots["max_price"]
+
+    passed = [r for r in rows if fits(r)]
+    return (passed + [r for r in rows if not fits(r)])[:top_k]
+
+
+def _has_filters(slots: Optional[Dict]) -> bool:
+    return bool(slots and (slots.get("property_type") or slots.get("max_price")))
+
+
+def retrieve_listings(query: str, top_k: int = 5, slots: Optional[Dict] = None) -> List[Dict]:
     """
     Returns top_k listing dicts sorted by similarity desc using pgvector.
+    `slots` (from the understanding stage) scope the search by place and
+    prefer listings matching the property type and budget.
     """
+    scope = _geo_scope(query, slots)
+    if scope is not None:
+        place, radius, distances = scope
+        if not distances:
+            return []
+        rows = hedged("match_listings", _match_in, _geo_body(embed_text(query), distances, top_k))
+        return _rank_nearby(rows, slots or extract_slots(query), place, radius, distances, top_k)
+
     print("Embedding query for retrieval...")
     query_embedding = embed_text(query)
 
     print("Calling Supabase vector search...")
-    url = f"{REST_URL}/rpc/match_listings"
     body = {
-        "query_embedding": query_embedding,
+        "query_embedding": to_wire(query_embedding),
         "match_threshold": 0.5,
-        "match_count": top_k,
+        "match_count": 4 * top_k if _has_filters(slots) else top_k,
     }
-    r = requests.post(url, headers=HEADERS, json=body, timeout=REQUEST_TIMEOUT)
-    sb._raise_for_resp(r)
-    return r.json()
\ No newline at end of file
+    rows = hedged("match_listings", _match, body)
+    return _filter_by_slots(rows, slots, top_k) if _has_filters(slots) else rows
+
+
+async def _aembed_once(text: str, model: str) -> List[float]:
+    timeout = stage_timeout(EMBEDDING_TIMEOUT)
+    with guarded("openai"):
+        resp = await clients.async_openai_client().embeddings.create(model=model, input=text, timeout=timeout, **embedding_kwargs())
+    return resp.data[0].embedding
+
+
+async def aembed_text(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+    return await ahedged("embedding", lambda: _aembed_once(text, model))
+
+
+async def _amatch(body: Dict) -> List[Dict]:
+    r = await asb._post(f"{REST_URL}/rpc/{MATCH_RPC}", headers=HEADERS, json=body)
+    asb._raise_for_resp(r)
+    return r.json()
+
+
+async def _amatch_in(body: Dict) -> List[Dict]:
+    r = await asb._post(f"{REST_URL}/rpc/match_listings_in", headers=HEADERS, json=body)
+    asb._raise_for_resp(r)
+    return r.json()
+
+
+async def aretrieve_listings(query: str, top_k: int = 5, slots: Optional[Dict] = None) -> List[Dict]:
+    """
+    Async variant of retrieve_listings using the pooled async HTTP client.
+    """
+    if GEO_SEARCH_ENABLED and geo_index.needs_load() and (find_landmark(query) or (slots or {}).get("location")):
+        await asyncio.to_thread(geo_index.ensure_loaded)
+    scope = _geo_scope(query, slots)
+    if scope is not None:
+        place, radius, distances = scope
+        if not distances:
+            return []
+        body = _geo_body(await aembed_text(query), distances, top_k)
+        rows = await ahedged("match_listings", lambda: _amatch_in(body))
+        return _rank_nearby(rows, slots or extract_slots(query), place, radius, distances, top_k)
+
+    query_embedding = await aembed_text(query)
+    body = {
+        "query_embedding": to_wire(query_embedding),
+        "match_threshold": 0.5,
+        "match_count": 4 * top_k if _has_filters(slots) else top_k,
+    }
+    rows = await ahedged("match_listings", lambda: _amatch(body))
+    return _filter_by_slots(rows, slots, top_k) if _has_filters(slots) else rows
@@ -0,0 +1,378 @@
+import bisect
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+import numpy as np
+
+from . import clients, listing_ids
+from . import supabase_client as sb
+from .quantization import normalize_rows, to_wire
+from .slots import extract_slots, normalize_location, normalize_property_type
+
+# Saved-search alerts. A user's search is stored with its slots (location,
+# property type, budget) and query embedding. When create_listing inserts a
+# listing, the in-process SavedSearchIndex picks candidate searches from posting
+# lists keyed by location, type and price bucket, walking only the smallest of
+# the three, then checks the candidates' embeddings against the listing in one
+# matrix product. Matches are recorded in saved_search_matches (duplicates are
+# ignored, so several workers can't double-notify) and sent as one WhatsApp
+# message per user for every batch of new listings.
+ENABLED = os.getenv("SAVED_SEARCH_ALERTS", "1") == "1"
+MATCH_THRESHOLD = float(os.getenv("SAVED_SEARCH_THRESHOLD", 0.35))
+BATCH_SECONDS = float(os.getenv("SAVED_SEARCH_BATCH_SECONDS", 5))
+FULL_RELOAD_SECONDS = 1800
+PAGE_SIZE = 1000
+MAX_LISTINGS_PER_MESSAGE = 3
+WHATSAPP_FROM = os.getenv("TWILIO_WHATSAPP_FROM", "")
+
+PRICE_BUCKETS = [3000, 5000, 7000, 10000, 15000, 20000, 30000, 50000, 100000]
+ANY = "*"
+NO_BUDGET = -1
+
+
+def price_bucket(price: float) -> int:
+    return bisect.bisect_left(PRICE_BUCKETS, price)
+
+
+def listing_slots(listing: Dict) -> Dict:
+    price = listing.get("price")
+    return {
+        "location": normalize_location(listing.get("location")),
+        "property_type": normalize_property_type(listing.get("property_type") or listing.get("title")),
+        "price": float(price) if price not in (None, "") else None,
+    }
+
+
+def _parse_vector(value) -> Optional[List[float]]:
+    # PostgREST returns pgvector values as their text form "[0.1,0.2,...]"
+    if value is None:
+        return None
+    return json.loads(value) if isinstance(value, str) else value
+
+
+class SavedSearchIndex:
+    """Inverted index over saved searches; see the module comment."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.searches: List[Optional[Dict]] = []  # slot -> search (None once removed)
+        self.slot_by_id: Dict[str, int] = {}
+        self.by_location: Dict[str, Set[int]] = {}
+        self.by_type: Dict[str, Set[int]] = {}
+        self.by_price: Dict[int, Set[int]] = {}
+        self.vectors: Optional[np.ndarray] = None
+        self.has_vector = np.zeros(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.slot_by_id)
+
+    def _grow(self, dims: int):
+        capacity = max(64, 2 * len(self.searches))
+        vectors = np.zeros((capacity, dims), dtype=np.float32)
+        has_vector = np.zeros(capacity, dtype=bool)
+        if self.vectors is not None:
+            vectors[: len(self.vectors)] = self.vectors
+            has_vector[: len(self.has_vector)] = self.has_vector
+        self.vectors, self.has_vector = vectors, has_vector
+
+    def add(self, search: Dict):
+        embedding = _parse_vector(search.get("embedding"))
+        with self._lock:
+            if search["id"] in self.slot_by_id:
+                return
+            slot = len(self.searches)
+            self.searches.append({k: v for k, v in search.items() if k != "embedding"})
+            self.slot_by_id[search["id"]] = slot
+            self.by_location.setdefault(search.get("location") or ANY, set()).add(slot)
+            self.by_type.setdefault(search.get("property_type") or ANY, set()).add(slot)
+            budget = search.get("max_price")
+            self.by_price.setdefault(NO_BUDGET if budget is None else price_bucket(budget), set()).add(slot)
+            if embedding is not None:
+                if self.vectors is not None and self.vectors.shape[1] != len(embedding):
+                    print(f"Saved search {search['id']} embedding has the wrong size, matching on slots only")
+                    return
+                if self.vectors is None or slot >= len(self.vectors):
+                    self._grow(len(embedding))
+                self.vectors[slot] = normalize_rows(embedding)[0]
+                self.has_vector[slot] = True
+
+    def remove(self, predicate: Callable[[Dict], bool]) -> int:
+        with self._lock:
+            removed = 0
+            for slot, search in enumerate(self.searches):
+                if search is None or not predicate(search):
+                    continue
+                for postings in (self.by_location, self.by_type, self.by_price):
+                    for members in postings.values():
+                        members.discard(slot)
+                del self.slot_by_id[search["id"]]
+                self.searches[slot] = None
+                if slot < len(self.has_vector):
+                    self.has_vector[slot] = False
+                removed += 1
+            return removed
+
+    def candidates(self, slots: Dict) -> List[int]:
+        """Searches whose location, type and budget all admit the listing.
+        Only the smallest posting union is walked; the rest are checked per item."""
+        with self._lock:
+            dims = [
+                [self.by_location.get(slots["location"], set()), self.by_location.get(ANY, set())],
+                [self.by_type.get(slots["property_type"], set()), self.by_type.get(ANY, set())],
+            ]
+            if slots["price"] is not None:
+                first = price_bucket(slots["price"])
+                dims.append([m for b, m in self.by_price.items() if b == NO_BUDGET or b >= first])
+            smallest = min(dims, key=lambda sets: sum(len(s) for s in sets))
+            found = []
+            for members in smallest:
+                for slot in members:
+                    if self._admits(self.searches[slot], slots):
+                        found.append(slot)
+            return found
+
+    @staticmethod
+    def _admits(search: Dict, slots: Dict) -> bool:
+        if search.get("location") and search["location"] != slots["location"]:
+            return False
+        if search.get("property_type") and search["property_type"] != slots["property_type"]:
+            return False
+        budget = search.get("max_price")
+        return budget is None or slots["price"] is None or slots["price"] <= budget
+
+    def match(self, listing: Dict, embed: Callable[[], Optional[List[float]]]) -> List[Dict]:
+        """Saved searches matching the listing. `embed` is only called when a
+        candidate has a query embedding to compare against."""
+        found = self.candidates(listing_slots(listing))
+        if not found:
+            return []
+        idx = np.asarray(found)
+        keep = np.ones(len(idx), dtype=bool)
+        with_vector = np.zeros(len(idx), dtype=bool)
+        stored = idx < len(self.has_vector)
+        with_vector[stored] = self.has_vector[idx[stored]]
+        if with_vector.any():
+            embedding = embed()
+            if embedding is not None and len(embedding) == self.vectors.shape[1]:
+                q = normalize_rows(embedding)[0]
+                sims = self.vectors[idx[with_vector]] @ q
+                keep[with_vector] = sims >= MATCH_THRESHOLD
+        return [self.searches[i] for i in idx[keep] if self.searches[i] is not None]
+
+
+INDEX = SavedSearchIndex()
+_index_lock = threading.Lock()
+_loaded_at: Optional[float] = None
+_newest_cursor: Optional[str] = None
+
+
+def _fetch_searches(after: Optional[str] = None) -> List[Dict]:
+    """Active saved searches created after the keyset cursor "created_at|id"."""
+    rows: List[Dict] = []
+    while True:
+        params = [
+            ("active", "eq.true"),
+            ("select", "id,phone,query,location,property_type,max_price,embedding,created_at"),
+            ("order", "created_at.asc,id.asc"),
+            ("limit", str(PAGE_SIZE)),
+        ]
+        if after:
+            created_at, _, row_id = after.partition("|")
+            params.append(("or", f'(created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt.{row_id}))'))
+        resp = sb._get(f"{sb.REST_URL}/saved_searches", params=params, headers=sb.HEADERS)
+        sb._raise_for_resp(resp)
+        page = resp.json() or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        after = f"{page[-1]['created_at']}|{page[-1]['id']}"
+
+
+def ensure_loaded():
+    """Full reload every FULL_RELOAD_SECONDS (picks up deactivations), otherwise
+    only searches saved since the last look (other workers' new searches)."""
+    global INDEX, _loaded_at, _newest_cursor
+    with _index_lock:
+        if _loaded_at is None or time.monotonic() - _loaded_at > FULL_RELOAD_SECONDS:
+            rows, index = _fetch_searches(), SavedSearchIndex()
+            _loaded_at = time.monotonic()
+        else:
+            rows, index = _fetch_searches(_newest_cursor), INDEX
+        for row in rows:
+            index.add(row)
+        if rows:
+            _newest_cursor = f"{rows[-1]['created_at']}|{rows[-1]['id']}"
+        INDEX = index
+
+
+def save_search(user_phone: str, query: str) -> Dict:
+    from .retrieval import embed_text
+
+    slots = extract_slots(query)
+    try:
+        embedding = embed_text(query)
+    except Exception as e:
+        print(f"Saved search embedding failed, matching on slots only: {e}")
+        embedding = None
+    body = {
+        "user_id": sb._get_or_create_user(user_phone),
+        "phone": user_phone,
+        "query": query,
+        **slots,
+        "embedding": to_wire(embedding) if embedding is not None else None,
+    }
+    resp = sb._post(f"{sb.REST_URL}/saved_searches", json=body, headers=sb.POST_HEADERS)
+    sb._raise_for_resp(resp)
+    row = (resp.json() or [body])[0]
+    INDEX.add({**row, "embedding": embedding})
+    return row
+
+
+def deactivate_searches(user_phone: str) -> int:
+    resp = sb._patch(
+        f"{sb.REST_URL}/saved_searches",
+        params={"phone": f"eq.{user_phone}", "active": "eq.true"},
+        json={"active": False},
+        headers=sb.POST_HEADERS,
+    )
+    sb._raise_for_resp(resp)
+    INDEX.remove(lambda s: s.get("phone") == user_phone)
+    return len(resp.json() or [])
+
+
+# Alerts
+def _listing_embedding(listing: Dict) -> Optional[List[float]]:
+    # the same vector ingest would store, so keep it and save that call later
+    from .embeddings_ingest import compute_embedding, listing_text_for_embedding, upsert_embedding
+
+    try:
+        embedding = compute_embedding(listing_text_for_embedding(listing))
+    except Exception as e:
+        print(f"Listing embedding failed, matching on slots only: {e}")
+        return None
+    try:
+        if listing.get("id"):
+            upsert_embedding(listing["id"], embedding)
+    except Exception as e:
+        print(f"Listing embedding upsert failed: {e}")
+    return embedding
+
+
+def _record_matches(pairs: List) -> List:
+    """Inserts (search, listing) pairs; returns only the ones not recorded before."""
+    body = [{"saved_search_id": s["id"], "listing_id": l["id"]} for s, l in pairs]
+    headers = sb.POST_HEADERS.copy()
+    headers["Prefer"] = "return=representation,resolution=ignore-duplicates"
+    resp = sb._post(f"{sb.REST_URL}/saved_search_matches", json=body,
+                    params={"on_conflict": "saved_search_id,listing_id"}, headers=headers)
+    sb._raise_for_resp(resp)
+    inserted = {(r["saved_search_id"], r["listing_id"]) for r in resp.json() or []}
+    return [(s, l) for s, l in pairs if (s["id"], l["id"]) in inserted]
+
+
+def _still_active(search_ids: Set[str]) -> Set[str]:
+    # a search cancelled through another worker may still be in this index
+    resp = sb._get(f"{sb.REST_URL}/saved_searches",
+                   params={"id": f"in.({','.join(sorted(search_ids))})", "active": "eq.true", "select": "id"},
+                   headers=sb.HEADERS)
+    sb._raise_for_resp(resp)
+    return {r["id"] for r in resp.json() or []}
+
+
+def _whatsapp_address(phone: str) -> str:
+    return "whatsapp:+" + phone.replace("whatsapp:", "").lstrip("+")
+
+
+def format_alert(listings: List[Dict]) -> str:
+    pieces = ["🔔 New listings matching your saved search:"]
+    for l in listings[:MAX_LISTINGS_PER_MESSAGE]:
+        pieces.append(f"🏠 {l.get('title', 'Listing')} — {l.get('location', '')}\n💰 KES {l.get('price', 'N/A')}\n🆔 {listing_ids.short_id(l.get('id'))}")
+    if len(listings) > MAX_LISTINGS_PER_MESSAGE:
+        pieces.append(f"…and {len(listings) - MAX_LISTINGS_PER_MESSAGE} more.")
+    pieces.append("Reply 'save <ID>' to save one, or 'stop alerts' to stop these messages.")
+    return "\n\n".join(pieces)
+
+
+def send_alert(phone: str, listings: List[Dict]) -> bool:
+    twilio = clients.twilio_client()
+    if not twilio or not WHATSAPP_FROM:
+        print(f"Alert for {phone} not sent: Twilio or TWILIO_WHATSAPP_FROM not configured")
+        return False
+    try:
+        twilio.messages.create(from_=_whatsapp_address(WHATSAPP_FROM), to=_whatsapp_address(phone), body=format_alert(listings))
+        return True
+    except Exception as e:
+        print(f"Alert for {phone} failed: {e}")
+        return False
+
+
+def process_new_listings(listings: List[Dict]) -> Dict[str, List[Dict]]:
+    """Matches a batch of new listings and sends one message per user.
+    Returns phone -> listings that were sent."""
+    if not listings:
+        return {}
+    ensure_loaded()
+    pairs = []
+    for listing in listings:
+        cached = []
+
+        def embed(listing=listing, cached=cached):
+            if not cached:
+                cached.append(_listing_embedding(listing))
+            return cached[0]
+
+        pairs.extend((search, listing) for search in INDEX.match(listing, embed))
+    if not pairs:
+        return {}
+
+    pairs = _record_matches(pairs)
+    if pairs:
+        active = _still_active({s["id"] for s, _ in pairs})
+        pairs = [(s, l) for s, l in pairs if s["id"] in active]
+
+    by_phone: Dict[str, List[Dict]] = {}
+    for search, listing in pairs:
+        sent = by_phone.setdefault(search["phone"], [])
+        if all(l["id"] != listing["id"] for l in sent):
+            sent.append(listing)
+    for phone, matched in by_phone.items():
+        send_alert(phone, matched)
+    print(f"Saved-search alerts: {len(listings)} listings, {len(pairs)} matches, {len(by_phone)} users")
+    return by_phone
+
+
+_pending: List[Dict] = []
+_pending_lock = threading.Lock()
+_flush_timer: Optional[threading.Timer] = None
+
+
+def _flush():
+    global _flush_timer
+    with _pending_lock:
+        batch = list(_pending)
+        _pending.clear()
+        _flush_timer = None
+    try:
+        process_new_listings(batch)
+    except Exception as e:
+        print(f"Saved-search alert batch failed: {e}")
+
+
+def _on_listing_created(rows: List[Dict]):
+    """create_listing listener: queue the rows and match them in one batch
+    BATCH_SECONDS later, off the request thread."""
+    global _flush_timer
+    rows = [r for r in rows if isinstance(r, dict) and r.get("id")]
+    if not ENABLED or not rows:
+        return
+    with _pending_lock:
+        _pending.extend(rows)
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(BATCH_SECONDS, _flush)
+            _flush_timer.start()
+
+
+sb.on_listing_created(_on_listing_created)
@@ -0,0 +1,162 @@
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .quantization import quantize_int8
+
+
+def normalize_query(text: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace for the exact-match fast path."""
+    return " ".join(re.sub(r"[^\w\s]", " ", (text or "").lower()).split())
+
+
+class _Partition:
+    """Fixed-capacity store for one language: a (capacity, dim) matrix of unit
+    vectors plus per-slot metadata, scanned with a single matrix-vector product."""
+
+    def __init__(self, capacity: int, dim: int, dtype: str = "float32"):
+        self.dtype = dtype
+        self.vectors = np.zeros((capacity, dim), dtype=np.int8 if dtype == "int8" else dtype)
+        self.scales = np.ones(capacity, dtype=np.float32) if dtype == "int8" else None
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.created = np.zeros(capacity, dtype=np.float64)
+        self.last_used = np.zeros(capacity, dtype=np.int64)  # access counter, not wall time
+        self.keys: List[Optional[str]] = [None] * capacity
+        self.answers: List[Optional[str]] = [None] * capacity
+        self.by_key: Dict[str, int] = {}
+
+    def store(self, slot: int, q: np.ndarray):
+        if self.dtype == "int8":
+            codes, scales = quantize_int8(q)
+            self.vectors[slot] = codes[0]
+            self.scales[slot] = scales[0]
+        else:
+            self.vectors[slot] = q
+
+    def similarities(self, q: np.ndarray) -> np.ndarray:
+        if self.dtype == "int8":
+            return (self.vectors @ q) * self.scales
+        return self.vectors.astype(np.float32, copy=False) @ q
+
+    def expire(self, now: float, ttl: float):
+        expired = np.flatnonzero(self.valid & (now - self.created > ttl))
+        for slot in expired:
+            self.drop(int(slot))
+
+    def drop(self, slot: int):
+        key = self.keys[slot]
+        if key is not None and self.by_key.get(key) == slot:
+            del self.by_key[key]
+        self.valid[slot] = False
+        self.keys[slot] = None
+        self.answers[slot] = None
+
+    def free_slot(self) -> int:
+        free = np.flatnonzero(~self.valid)
+        if len(free):
+            return int(free[0])
+        # full: evict the least recently used entry
+        slot = int(np.argmin(self.last_used))
+        self.drop(slot)
+        return slot
+
+
+class SemanticCache:
+    """
+    Bounded in-memory cache of (query, language) -> answer. Lookups first try an
+    exact match on the normalized query, then a cosine search over the cached
+    query embeddings of the same language; a hit needs similarity >= threshold.
+    Entries expire after ttl_seconds and the least recently used entry is
+    evicted when a language partition is full. dtype ("float32", "float16" or
+    "int8") sets how the cached embeddings are stored.
+    """
+
+    def __init__(self, capacity_per_language: int = 512, ttl_seconds: float = 24 * 3600, threshold: float = 0.92,
+                 dtype: str = "float32"):
+        self.capacity = capacity_per_language
+        self.dtype = dtype
+        self.ttl = ttl_seconds
+        self.threshold = threshold
+        self._partitions: Dict[str, _Partition] = {}
+        self._lock = threading.Lock()
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    @staticmethod
+    def _unit(embedding: Sequence[float]) -> np.ndarray:
+        v = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def _partition(self, lang: str, dim: int) -> _Partition:
+        part = self._partitions.get(lang)
+        if part is None or part.vectors.shape[1] != dim:
+            # first entry for this language, or the embedding size changed
+            part = _Partition(self.capacity, dim, self.dtype)
+            self._partitions[lang] = part
+        return part
+
+    def get_exact(self, query: str, lang: str) -> Optional[str]:
+        """Cheap lookup that needs no embedding."""
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            part = self._partitions.get(lang)
+            slot = part.by_key.get(key) if part else None
+            if slot is None or now - part.created[slot] > self.ttl:
+                return None
+            part.last_used[slot] = self._tick()
+            self.hits += 1
+            return part.answers[slot]
+
+    def get(self, embedding: Sequence[float], lang: str) -> Optional[str]:
+        q = self._unit(embedding)
+        now = time.time()
+        with self._lock:
+            part = self._partitions.get(lang)
+            if part is None or part.vectors.shape[1] != q.shape[0]:
+                self.misses += 1
+                return None
+            part.expire(now, self.ttl)
+            if not part.valid.any():
+                self.misses += 1
+                return None
+            sims = part.similarities(q)
+            sims[~part.valid] = -np.inf
+            slot = int(np.argmax(sims))
+            if sims[slot] < self.threshold:
+                self.misses += 1
+                return None
+            part.last_used[slot] = self._tick()
+            self.hits += 1
+            return part.answers[slot]
+
+    def put(self, query: str, embedding: Sequence[float], lang: str, answer: str):
+        q = self._unit(embedding)
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            part = self._partition(lang, q.shape[0])
+            slot = part.by_key.get(key)
+            if slot is None:
+                part.expire(now, self.ttl)
+                slot = part.free_slot()
+            part.store(slot, q)
+            part.valid[slot] = True
+            part.created[slot] = now
+            part.last_used[slot] = self._tick()
+            part.keys[slot] = key
+            part.answers[slot] = answer
+            part.by_key[key] = slot
+
+    def __len__(self) -> int:
+        with self._lock:
+            return int(sum(p.valid.sum() for p in self._partitions.values()))
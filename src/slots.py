@@ -0,0 +1,82 @@
+import re
+from typing import Dict, Optional
+
+# Regex slot extraction for housing queries and listings: location, property
+# type and budget. Used to index saved searches and to place new listings in
+# the same buckets, so both sides must normalize to the same canonical values.
+AREAS = [
+    "Kilimani", "Kileleshwa", "Lavington", "Westlands", "Parklands", "Ngara", "Kasarani", "Roysambu",
+    "Zimmerman", "Githurai", "Kahawa Wendani", "Kahawa Sukari", "Kahawa West", "Ruaka", "Juja",
+    "Madaraka", "South B", "South C", "Langata", "Rongai", "Karen", "Embakasi", "Donholm",
+    "Umoja", "Kayole", "Kitengela", "Ruiru", "Thika", "Kikuyu", "Kawangware", "Dagoretti",
+    "Upper Hill", "Hurlingham", "Ngong Road", "CBD", "Eastleigh", "Pangani", "Kariobangi",
+]
+AREA_ALIASES = {
+    "tao": "CBD",
+    "town": "CBD",
+    "kahawa": "Kahawa Wendani",
+    "wendani": "Kahawa Wendani",
+    "sukari": "Kahawa Sukari",
+    "ongata rongai": "Rongai",
+    "upperhill": "Upper Hill",
+}
+
+PROPERTY_TYPES = {
+    "Bedsitter": ["bedsitter", "bed sitter", "bed-sitter", "bedsit"],
+    "Studio": ["studio"],
+    "Single room": ["single room", "single", "chumba kimoja"],
+    "One bedroom": ["one bedroom", "one-bedroom", "1 bedroom", "1br", "1 br", "1bdr"],
+    "Two bedroom": ["two bedroom", "two-bedroom", "2 bedroom", "2br", "2 br", "2bdr"],
+    "Hostel room": ["hostel"],
+}
+
+_area_patterns = sorted(
+    [(a.lower(), a) for a in AREAS] + list(AREA_ALIASES.items()), key=lambda kv: -len(kv[0])
+)
+_AREA_RE = re.compile(r"\b(" + "|".join(re.escape(k) for k, _ in _area_patterns) + r")\b")
+_AREA_LOOKUP = dict(_area_patterns)
+
+_type_patterns = sorted(
+    [(syn, canonical) for canonical, syns in PROPERTY_TYPES.items() for syn in syns], key=lambda kv: -len(kv[0])
+)
+_TYPE_RE = re.compile(r"\b(" + "|".join(re.escape(k) for k, _ in _type_patterns) + r")\b")
+_TYPE_LOOKUP = dict(_type_patterns)
+
+# "under 8k", "max 12,000", "chini ya 7k", "ksh 9500", "budget 10000"
+MAX_RENT = 1_000_000  # anything larger is a phone number or an ID, not a budget
+_PRICE_RE = re.compile(r"(?:ksh\.?|kes)?\s*(\d{1,3}(?:,\d{3})+|\d+(?:\.\d+)?)\s*(k\b|000\b)?")
+
+
+def normalize_location(text: Optional[str]) -> Optional[str]:
+    if not text:
+        return None
+    m = _AREA_RE.search(text.lower())
+    return _AREA_LOOKUP[m.group(1)] if m else None
+
+
+def normalize_property_type(text: Optional[str]) -> Optional[str]:
+    if not text:
+        return None
+    m = _TYPE_RE.search(text.lower())
+    return _TYPE_LOOKUP[m.group(1)] if m else None
+
+
+def extract_price(text: str) -> Optional[int]:
+    best = None
+    for number, suffix in _PRICE_RE.findall(text.lower()):
+        value = float(number.replace(",", ""))
+        if suffix:  # "8k" or "8 000"
+            value *= 1000
+        if 1000 <= value <= MAX_RENT:
+            # the budget is the largest amount mentioned ("between 6k and 8k")
+            best = int(value) if best is None else max(best, int(value))
+    return best
+
+
+def extract_slots(text: str) -> Dict[str, Optional[object]]:
+    """{"location", "property_type", "max_price"}; missing slots are None."""
+    return {
+        "location": normalize_location(text),
+        "property_type": normalize_property_type(text),
+        "max_price": extract_price(text or ""),
+    }
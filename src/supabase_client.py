@@ -1,15 +1,21 @@
+import base64
 import os
+import threading
+import time
+from collections import OrderedDict
 import requests
-from dotenv import load_dotenv
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Iterator, Tuple
 
-load_dotenv()
+from . import clients  # noqa: F401  (loads .env)
+from .gazetteer import geocode_fields
+from .resilience import breaker, stage_timeout
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+SUPABASE_URL = os.getenv("SUPABASE_URL") or ""
+SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or ""
 
 if not SUPABASE_URL or not SERVICE_KEY:
-    raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY in environment")
+    # don't crash the import; every REST call will fail until this is configured
+    print("Warning: Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY in environment")
 
 # Base REST endpoint for PostgREST
 REST_URL = SUPABASE_URL.rstrip("/") + "/rest/v1"
@@ -25,6 +31,85 @@ POST_HEADERS["Prefer"] = "return=representation"
 
 REQUEST_TIMEOUT = 10.0
 
+USER_ID_CACHE_SIZE = int(os.getenv("USER_ID_CACHE_SIZE", 10000))
+PORTFOLIO_CACHE_TTL = float(os.getenv("PORTFOLIO_CACHE_TTL", 300))
+
+
+class _TTLCache:
+    """Small thread-safe LRU whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def drop_where(self, predicate) -> int:
+        with self._lock:
+            keys = [k for k, (v, _) in self._entries.items() if predicate(v)]
+            for k in keys:
+                del self._entries[k]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# phone number -> users.id; ids never change, so this skips the upsert that
+# used to run before every chat save, favorite and inquiry
+USER_ID_CACHE = _TTLCache(USER_ID_CACHE_SIZE, ttl=3600.0)
+
+
+def _send(method: str, url: str, **kwargs) -> requests.Response:
+    """Every PostgREST call goes through here: the timeout is drawn from the
+    request budget and the outcome feeds the Supabase circuit breaker."""
+    kwargs["timeout"] = stage_timeout(kwargs.get("timeout", REQUEST_TIMEOUT))
+    b = breaker("supabase")
+    b.check()
+    started = time.monotonic()
+    try:
+        resp = requests.request(method, url, **kwargs)
+    except requests.RequestException:
+        b.record_failure()
+        raise
+    if resp.status_code >= 500:
+        b.record_failure()
+    else:
+        b.record_success(time.monotonic() - started)
+    return resp
+
+
+def _get(url: str, **kwargs) -> requests.Response:
+    return _send("GET", url, **kwargs)
+
+
+def _post(url: str, **kwargs) -> requests.Response:
+    return _send("POST", url, **kwargs)
+
+
+def _patch(url: str, **kwargs) -> requests.Response:
+    return _send("PATCH", url, **kwargs)
+
 
 def _raise_for_resp(resp: requests.Response):
     try:
@@ -38,14 +123,14 @@ def _raise_for_resp(resp: requests.Response):
 def _get_or_create(table: str, match_params: Dict[str, Any], create_params: Dict[str, Any]) -> str:
     """Generic function to get or create a record in a table."""
     q = {**match_params, "select": "id"}
-    resp = requests.get(f"{REST_URL}/{table}", params=q, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+    resp = _get(f"{REST_URL}/{table}", params=q, headers=HEADERS)
     _raise_for_resp(resp)
     data = resp.json()
     if data and isinstance(data, list) and data:
         return data[0]["id"]
 
     # create record
-    resp = requests.post(f"{REST_URL}/{table}", json=create_params, params={"select": "id"}, headers=POST_HEADERS, timeout=REQUEST_TIMEOUT)
+    resp = _post(f"{REST_URL}/{table}", json=create_params, params={"select": "id"}, headers=POST_HEADERS)
     _raise_for_resp(resp)
     data = resp.json()
     if isinstance(data, list) and data:
@@ -55,6 +140,9 @@ def _get_or_create(table: str, match_params: Dict[str, Any], create_params: Dict
 
 def _get_or_create_user(phone_number: str) -> str:
     """Map a WhatsApp phone number to a Supabase users table id. Create if missing."""
+    cached = USER_ID_CACHE.get(phone_number)
+    if cached:
+        return cached
     # Use an 'upsert' to avoid race conditions
     body = {"phone_number": phone_number}
     # Add 'on_conflict' to the query params to specify the unique column
@@ -63,10 +151,11 @@ def _get_or_create_user(phone_number: str) -> str:
     upsert_headers = POST_HEADERS.copy()
     upsert_headers["Prefer"] = "return=representation,resolution=merge-duplicates"
 
-    resp = requests.post(f"{REST_URL}/users", json=body, params=params, headers=upsert_headers, timeout=REQUEST_TIMEOUT)
+    resp = _post(f"{REST_URL}/users", json=body, params=params, headers=upsert_headers)
     _raise_for_resp(resp)
     data = resp.json()
     if isinstance(data, list) and data:
+        USER_ID_CACHE.put(phone_number, data[0]["id"])
         return data[0]["id"]
     raise RuntimeError("Failed to get or create user")
 
@@ -86,7 +175,7 @@ def save_chat(user_phone: str, user_message: str, bot_response: str) -> Optional
         "user_message": user_message,
         "bot_response": bot_response,
     }
-    resp = requests.post(f"{REST_URL}/chats", json=body, headers=POST_HEADERS, timeout=REQUEST_TIMEOUT)
+    resp = _post(f"{REST_URL}/chats", json=body, headers=POST_HEADERS)
     _raise_for_resp(resp)
     try:
         return resp.json()
@@ -94,30 +183,96 @@ def save_chat(user_phone: str, user_message: str, bot_response: str) -> Optional
         return None
 
 
-def get_recent_chats(user_phone: str, limit: int = 10):
+CHAT_PAGE_COLUMNS = "id,user_message,bot_response,created_at"
+
+
+def _encode_cursor(row: Dict[str, Any]) -> str:
+    raw = f"{row['created_at']}|{row['id']}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor: str):
+    created_at, _, row_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").partition("|")
+    return created_at, row_id
+
+
+def get_chat_page(user_phone: str, limit: int = 20, before: Optional[str] = None,
+                  since: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    One page of a user's chats, newest first, paged by keyset on
+    (created_at, id) rather than offset so deep pages cost the same as the
+    first one. `before` is the cursor returned with the previous page; `since`
+    (ISO timestamp) bounds how far back to look, which also lets Postgres skip
+    older monthly partitions. Returns (rows, next_cursor or None).
+    """
     if user_phone == "anon":
-        return []
+        return [], None
     user_id = _get_or_create_user(user_phone)
-    resp = requests.get(
-        f"{REST_URL}/chats",
-        params={"user_id": f"eq.{user_id}", "select": "user_message,bot_response", "order": "created_at.asc", "limit": str(limit)},
-        headers=HEADERS,
-        timeout=REQUEST_TIMEOUT,
-    )
+    params = [
+        ("user_id", f"eq.{user_id}"),
+        ("select", CHAT_PAGE_COLUMNS),
+        ("order", "created_at.desc,id.desc"),
+        ("limit", str(limit)),
+    ]
+    if before:
+        created_at, row_id = _decode_cursor(before)
+        # the plain bound lets the planner prune partitions; the or() breaks ties on id
+        params.append(("created_at", f"lte.{created_at}"))
+        params.append(("or", f'(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{row_id}))'))
+    if since:
+        params.append(("created_at", f"gte.{since}"))
+    resp = _get(f"{REST_URL}/chats", params=params, headers=HEADERS)
     _raise_for_resp(resp)
     rows = resp.json() or []
+    next_cursor = _encode_cursor(rows[-1]) if len(rows) == limit else None
+    return rows, next_cursor
+
+
+def iter_chat_history(user_phone: str, page_size: int = 100, since: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """All of a user's chats, newest first, fetched page by page."""
+    cursor = None
+    while True:
+        rows, cursor = get_chat_page(user_phone, limit=page_size, before=cursor, since=since)
+        yield from rows
+        if not cursor:
+            return
+
+
+def get_recent_chats(user_phone: str, limit: int = 10):
+    """The user's last `limit` exchanges as chat messages, oldest first."""
+    rows, _ = get_chat_page(user_phone, limit=limit)
     history = []
-    for row in rows:
+    for row in reversed(rows):
         history.append({"role": "user", "content": row.get("user_message", "")})
         history.append({"role": "assistant", "content": row.get("bot_response", "")})
     return history
 
 
 # Listings & search helpers
+# callbacks run with the inserted listing rows after every create_listing
+# (saved-search alerts register here); they must not raise or block
+LISTING_LISTENERS: List[Callable[[List[Dict[str, Any]]], None]] = []
+
+
+def on_listing_created(fn: Callable[[List[Dict[str, Any]]], None]):
+    if fn not in LISTING_LISTENERS:
+        LISTING_LISTENERS.append(fn)
+
+
 def create_listing(listing: Dict[str, Any]):
-    resp = requests.post(f"{REST_URL}/listings", json=listing, headers=POST_HEADERS, timeout=REQUEST_TIMEOUT)
+    if "latitude" not in listing:
+        # geocode at ingest so "near <campus>" search can use the geo index
+        listing = {**listing, **geocode_fields(listing.get("location"))}
+    resp = _post(f"{REST_URL}/listings", json=listing, headers=POST_HEADERS)
     _raise_for_resp(resp)
-    return resp.json()
+    invalidate_landlord_portfolio(landlord_id=listing.get("landlord_id"), complex_id=listing.get("complex_id"))
+    rows = resp.json()
+    for listener in LISTING_LISTENERS:
+        try:
+            listener(rows if isinstance(rows, list) else [rows])
+        except Exception as e:
+            print(f"Listing listener error: {e}")
+    return rows
 
 
 def search_listings(location: Optional[str] = None, max_price: Optional[int] = None, room_type: Optional[str] = None):
@@ -129,33 +284,112 @@ def search_listings(location: Optional[str] = None, max_price: Optional[int] = N
     if room_type:
         query["room_type"] = f"ilike.%{room_type}%"
 
-    resp = requests.get(f"{REST_URL}/listings", params=query, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+    resp = _get(f"{REST_URL}/listings", params=query, headers=HEADERS)
     _raise_for_resp(resp)
     return resp.json()
 
 
-def get_complexes(user_phone: str):
-    landlord_id = _get_or_create_landlord(user_phone)
-    resp = requests.get(f"{REST_URL}/complexes", params={"landlord_id": f"eq.{landlord_id}"}, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+# Landlord portfolio
+#
+# One RPC (landlord_portfolio, see migrations.sql) returns complexes with nested
+# units and listing counts. Results are cached per phone number for
+# PORTFOLIO_CACHE_TTL seconds. Listing/unit writes invalidate the entry in this
+# process and bump a per-landlord generation in Redis, so other workers drop
+# their copy on the next read; without Redis they fall back to the TTL.
+#
+# The generation is read before the RPC, so a write landing in between leaves
+# the entry stamped with the older generation and it is dropped on the next
+# read. That needs the landlord id up front: phones are mapped to it in
+# PORTFOLIO_LANDLORDS, and a portfolio fetched before the id was known isn't
+# cached when Redis is up.
+PORTFOLIO_CACHE = _TTLCache(1000, ttl=PORTFOLIO_CACHE_TTL)
+PORTFOLIO_LANDLORDS = _TTLCache(1000, ttl=24 * 3600)
+
+
+def _portfolio_generation_key(landlord_id: str) -> str:
+    return f"portfolio:gen:{landlord_id}"
+
+
+def _portfolio_generation(landlord_id: str) -> Optional[int]:
+    redis_client = clients.redis_client()
+    if not redis_client:
+        return None
+    try:
+        return int(redis_client.get(_portfolio_generation_key(landlord_id)) or 0)
+    except Exception as e:
+        print(f"Portfolio cache generation lookup failed: {e}")
+        return None
+
+
+def get_landlord_portfolio(user_phone: str, refresh: bool = False) -> Dict[str, Any]:
+    """{"landlord_id", "complexes": [{..., "listing_count", "units": [...]}], "unassigned_listing_count"}"""
+    entry = None if refresh else PORTFOLIO_CACHE.get(user_phone)
+    known_landlord = entry[1]["landlord_id"] if entry is not None else PORTFOLIO_LANDLORDS.get(user_phone)
+    generation = _portfolio_generation(known_landlord) if known_landlord else None
+    if entry is not None and generation == entry[0]:
+        return entry[1]
+
+    resp = _post(f"{REST_URL}/rpc/landlord_portfolio", json={"p_phone": user_phone}, headers=HEADERS)
     _raise_for_resp(resp)
-    return resp.json()
+    portfolio = resp.json() or {}
+    landlord_id = portfolio.get("landlord_id")
+    # not-yet landlords aren't cached: they may be registered at any moment
+    if landlord_id:
+        PORTFOLIO_LANDLORDS.put(user_phone, landlord_id)
+        if landlord_id == known_landlord or clients.redis_client() is None:
+            PORTFOLIO_CACHE.put(user_phone, (generation, portfolio))
+    return portfolio
+
+
+def _complex_landlord(complex_id: str) -> Optional[str]:
+    resp = _get(f"{REST_URL}/complexes", params={"id": f"eq.{complex_id}", "select": "landlord_id"}, headers=HEADERS)
+    _raise_for_resp(resp)
+    rows = resp.json() or []
+    return rows[0].get("landlord_id") if rows else None
+
+
+def invalidate_landlord_portfolio(landlord_id: Optional[str] = None, complex_id: Optional[str] = None):
+    """Called after listing/unit writes; never raises."""
+    if not landlord_id and not complex_id:
+        return
+    try:
+        if not landlord_id:
+            landlord_id = _complex_landlord(complex_id)
+        PORTFOLIO_CACHE.drop_where(lambda entry: entry[1].get("landlord_id") == landlord_id)
+        redis_client = clients.redis_client()
+        if landlord_id and redis_client:
+            redis_client.incr(_portfolio_generation_key(landlord_id))
+    except Exception as e:
+        print(f"Portfolio cache invalidation failed: {e}")
+
+
+def get_complexes(user_phone: str):
+    """The landlord's complexes (with listing_count), without the nested units."""
+    portfolio = get_landlord_portfolio(user_phone)
+    return [{k: v for k, v in c.items() if k != "units"} for c in portfolio.get("complexes", [])]
 
 
 def get_units(user_phone: str, complex_id: Optional[str] = None):
-    landlord_id = _get_or_create_landlord(user_phone)
-    query = {"select": "*,complexes!inner(landlord_id)", "complexes.landlord_id": f"eq.{landlord_id}"}
-    if complex_id:
-        query["complex_id"] = f"eq.{complex_id}"
+    portfolio = get_landlord_portfolio(user_phone)
+    units = []
+    for c in portfolio.get("complexes", []):
+        if complex_id and c["id"] != complex_id:
+            continue
+        units.extend({**u, "complex_id": c["id"]} for u in c.get("units", []))
+    return units
+
 
-    resp = requests.get(f"{REST_URL}/units", params=query, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+def create_unit(unit: Dict[str, Any]):
+    resp = _post(f"{REST_URL}/units", json=unit, headers=POST_HEADERS)
     _raise_for_resp(resp)
+    invalidate_landlord_portfolio(complex_id=unit.get("complex_id"))
     return resp.json()
 
 
 def save_listing_to_favorites(user_phone: str, listing_id: str):
     user_app_id = _get_or_create_user(user_phone)
     body = {"user_id": user_app_id, "listing_id": listing_id}
-    resp = requests.post(f"{REST_URL}/favorites", json=body, headers=POST_HEADERS, timeout=REQUEST_TIMEOUT)
+    resp = _post(f"{REST_URL}/favorites", json=body, headers=POST_HEADERS)
     _raise_for_resp(resp)
     return resp.json()
 
@@ -167,7 +401,7 @@ def create_inquiry(user_phone: str, listing_id: str, message: str):
         "user_id": user_app_id,
         "message": message
     }
-    resp = requests.post(f"{REST_URL}/inquiries", json=body, headers=POST_HEADERS, timeout=REQUEST_TIMEOUT)
+    resp = _post(f"{REST_URL}/inquiries", json=body, headers=POST_HEADERS)
     _raise_for_resp(resp)
     return resp.json()
 
@@ -179,7 +413,7 @@ def save_trace_snapshot(snapshot: Dict[str, Any]):
     """
     try:
         body = {"payload": snapshot}
-        resp = requests.post(f"{REST_URL}/agent_traces", json=body, headers=POST_HEADERS, timeout=REQUEST_TIMEOUT)
+        resp = _post(f"{REST_URL}/agent_traces", json=body, headers=POST_HEADERS)
         # allow 404 if table doesn't exist
         if resp.status_code == 404:
             return None
@@ -0,0 +1,449 @@
+import argparse
+import glob
+import gzip
+import json
+import mmap
+import os
+import re
+import sys
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import orjson  # optional, several times faster than json on large histories
+    _loads = orjson.loads
+    _DecodeError = orjson.JSONDecodeError
+except ImportError:
+    _loads = json.loads
+    _DecodeError = ValueError
+
+from .tracing import DEGRADED_PHRASES, TRACE_DIR
+
+# Streaming analytics over the chat_api traces (traces/traces.jsonl plus its
+# rotated traces-<ms>.jsonl[.gz] segments):
+#
+#     python -m src.trace_analytics summary --since 7d --task rent_search_or_portfolio
+#     python -m src.trace_analytics export --out traces/traces.npz
+#     python -m src.trace_analytics summary --columnar traces/traces.npz --user <id>
+#
+# Plain segments are memory-mapped and cut into CHUNK_BYTES work items that
+# worker processes scan in parallel; gzipped segments are streamed whole.
+# Lines are pre-filtered on raw bytes (ts, user, task) and only survivors are
+# JSON-parsed. Every aggregate is a fixed set of counters, so memory does not
+# grow with history size. `export` writes the same per-trace facts as compact
+# numpy columns, so repeated questions skip the JSON parse altogether.
+CHUNK_BYTES = 64 * 1024 * 1024
+STEP_TYPES = ["plan", "act", "critique", "decision"]
+# a trace's ts is when it started but it is written when it finishes, so a
+# segment can hold traces slightly older than the previous rotation
+ROTATION_SLACK_MS = 60 * 1000
+
+_STEP_SLOTS = {name: slot for slot, name in enumerate(STEP_TYPES)}
+_OTHER_SLOT = len(STEP_TYPES)
+_SEGMENT_RE = re.compile(r"traces-(\d+)\.jsonl(\.gz)?$")
+_TS_RE = re.compile(rb'"ts": (\d+)')
+
+
+class TraceFilter:
+    def __init__(self, since: Optional[int] = None, until: Optional[int] = None,
+                 user: Optional[str] = None, task: Optional[str] = None):
+        self.since = since
+        self.until = until
+        self.user = user
+        self.task = task
+        # byte needles exactly as tracing.finish_trace serializes these fields
+        self.user_needle = json.dumps({"user_id": user}, ensure_ascii=False)[1:-1].encode("utf-8") if user else None
+        self.task_needle = json.dumps({"task": task}, ensure_ascii=False)[1:-1].encode("utf-8") if task else None
+
+    def block_may_match(self, block: bytes) -> bool:
+        return all(n is None or n in block for n in (self.user_needle, self.task_needle))
+
+    def line_may_match(self, line: bytes) -> bool:
+        if not self.block_may_match(line):
+            return False
+        if self.since is None and self.until is None:
+            return True
+        m = _TS_RE.search(line)
+        return m is not None and self.ts_in_range(int(m.group(1)))
+
+    def ts_in_range(self, ts: int) -> bool:
+        return (self.since is None or ts >= self.since) and (self.until is None or ts < self.until)
+
+    def matches(self, trace: Dict) -> bool:
+        # exact check after parsing (the byte needles can match inside goal text)
+        return (self.ts_in_range(int(trace.get("ts") or 0))
+                and (self.user is None or trace.get("user_id") == self.user)
+                and (self.task is None or trace.get("task") == self.task))
+
+
+def trace_facts(trace: Dict) -> Tuple[Optional[bool], int, Tuple[int, ...], Tuple[int, ...]]:
+    """(meets_goal or None, degraded-phrase bitmask, step counts, step failures) for one trace."""
+    meets_goal = None
+    degraded = 0
+    counts = [0] * (len(STEP_TYPES) + 1)
+    failures = [0] * (len(STEP_TYPES) + 1)
+    for step in trace.get("steps") or ():
+        step_type = step.get("step_type")
+        slot = _STEP_SLOTS.get(step_type, _OTHER_SLOT)
+        counts[slot] += 1
+        if step.get("success") is False:
+            failures[slot] += 1
+        if step_type == "critique":
+            content = step.get("content") or {}
+            if "meets_goal" in content:
+                meets_goal = bool(content["meets_goal"])
+            observation = str(content.get("observation") or "").lower()
+            for bit, phrase in enumerate(DEGRADED_PHRASES):
+                if phrase in observation:
+                    degraded |= 1 << bit
+    return meets_goal, degraded, tuple(counts), tuple(failures)
+
+
+class TraceStats:
+    """Constant-size aggregates; partial results from workers are merged."""
+
+    def __init__(self):
+        self.traces = 0
+        self.malformed = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.tasks = Counter()
+        self.critiques = 0
+        self.meets_goal = 0
+        self.degraded = Counter()
+        self.steps = Counter()
+        self.step_failures = Counter()
+
+    def add(self, task: str, meets_goal: Optional[bool], degraded: int, counts, failures, n: int = 1):
+        """Adds n traces with the same facts (timestamps are tracked separately)."""
+        self.traces += n
+        self.tasks[task] += n
+        if meets_goal is not None:
+            self.critiques += n
+            self.meets_goal += n * int(meets_goal)
+        for bit, phrase in enumerate(DEGRADED_PHRASES):
+            if degraded & (1 << bit):
+                self.degraded[phrase] += n
+        for slot, name in enumerate(STEP_TYPES + ["other"]):
+            if counts[slot]:
+                self.steps[name] += n * int(counts[slot])
+            if failures[slot]:
+                self.step_failures[name] += n * int(failures[slot])
+
+    def add_ts(self, first: int, last: int):
+        self.first_ts = first if self.first_ts is None else min(self.first_ts, first)
+        self.last_ts = last if self.last_ts is None else max(self.last_ts, last)
+
+    def merge(self, other: "TraceStats") -> "TraceStats":
+        self.traces += other.traces
+        self.malformed += other.malformed
+        if other.first_ts is not None:
+            self.add_ts(other.first_ts, other.last_ts)
+        self.tasks.update(other.tasks)
+        self.critiques += other.critiques
+        self.meets_goal += other.meets_goal
+        self.degraded.update(other.degraded)
+        self.steps.update(other.steps)
+        self.step_failures.update(other.step_failures)
+        return self
+
+    def to_dict(self) -> Dict:
+        return {
+            "traces": self.traces,
+            "malformed_lines": self.malformed,
+            "first_ts": self.first_ts,
+            "last_ts": self.last_ts,
+            "tasks": dict(self.tasks),
+            "critiques": self.critiques,
+            "meets_goal_rate": self.meets_goal / self.critiques if self.critiques else None,
+            "degraded_phrases": {p: self.degraded[p] for p in DEGRADED_PHRASES},
+            "steps": dict(self.steps),
+            "step_failures": dict(self.step_failures),
+        }
+
+
+# Segments and work items
+def list_segments(trace_dir: str = TRACE_DIR) -> List[Tuple[str, int, Optional[int]]]:
+    """(path, lower ts bound, upper ts bound) oldest first. A rotated segment
+    holds traces written before its rotation time and after the previous one's."""
+    rotated = []
+    for path in glob.glob(os.path.join(trace_dir, "traces-*.jsonl*")):
+        m = _SEGMENT_RE.search(os.path.basename(path))
+        if m:
+            rotated.append((int(m.group(1)), path))
+    rotated.sort()
+    segments, lower = [], 0
+    for upper, path in rotated:
+        segments.append((path, lower, upper))
+        lower = upper
+    active = os.path.join(trace_dir, "traces.jsonl")
+    if os.path.exists(active):
+        segments.append((active, lower, None))
+    return segments
+
+
+def plan_work(segments, flt: TraceFilter, chunk_bytes: int = CHUNK_BYTES) -> List[Tuple[str, int, int]]:
+    """(path, start, end) byte ranges; gzipped segments are one item (end = -1)."""
+    items = []
+    for path, lower, upper in segments:
+        # whole segments outside the time range are never opened
+        if flt.until is not None and lower - ROTATION_SLACK_MS >= flt.until:
+            continue
+        if flt.since is not None and upper is not None and upper < flt.since:
+            continue
+        if path.endswith(".gz"):
+            items.append((path, 0, -1))
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, size, chunk_bytes):
+            items.append((path, start, min(start + chunk_bytes, size)))
+    return items
+
+
+def _mmap_block(path: str, start: int, end: int) -> bytes:
+    """Bytes of the lines that *start* in [start, end)."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return b""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if start > 0 and mm[start - 1:start] != b"\n":
+                nl = mm.find(b"\n", start)
+                if nl == -1 or nl >= end:
+                    return b""
+                start = nl + 1
+            stop = mm.find(b"\n", end - 1) if end < size else size
+            stop = size if stop == -1 else stop + 1
+            return mm[start:stop]
+
+
+def _blocks(path: str, start: int, end: int, flt: TraceFilter) -> Iterator[Iterable[bytes]]:
+    """Yields blocks of raw lines for one work item, skipping blocks that
+    cannot contain the filtered user/task at all."""
+    if end == -1:
+        with gzip.open(path, "rb") as f:
+            while True:
+                lines = f.readlines(8 * 1024 * 1024)
+                if not lines:
+                    return
+                yield lines
+    else:
+        block = _mmap_block(path, start, end)
+        if block and flt.block_may_match(block):
+            yield block.split(b"\n")
+
+
+def _parsed(item: Tuple[str, int, int], flt: TraceFilter, stats: TraceStats) -> Iterator[Dict]:
+    path, start, end = item
+    for lines in _blocks(path, start, end, flt):
+        for line in lines:
+            if not line.strip() or not flt.line_may_match(line):
+                continue
+            try:
+                trace = _loads(line)
+            except _DecodeError:
+                # e.g. a line cut short while a worker was still appending
+                stats.malformed += 1
+                continue
+            if flt.matches(trace):
+                yield trace
+
+
+def scan_item(item: Tuple[str, int, int], flt: TraceFilter) -> TraceStats:
+    # traces repeat a handful of shapes, so count distinct fact tuples and
+    # expand them into the aggregates once at the end
+    stats = TraceStats()
+    shapes = Counter()
+    first = last = None
+    for trace in _parsed(item, flt, stats):
+        ts = int(trace.get("ts") or 0)
+        if first is None or ts < first:
+            first = ts
+        if last is None or ts > last:
+            last = ts
+        shapes[(str(trace.get("task")),) + trace_facts(trace)] += 1
+    for facts, n in shapes.items():
+        stats.add(*facts, n=n)
+    if first is not None:
+        stats.add_ts(first, last)
+    return stats
+
+
+def summarize(trace_dir: str = TRACE_DIR, flt: Optional[TraceFilter] = None, jobs: int = 1,
+              chunk_bytes: int = CHUNK_BYTES) -> TraceStats:
+    flt = flt or TraceFilter()
+    items = plan_work(list_segments(trace_dir), flt, chunk_bytes)
+    total = TraceStats()
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            total.merge(scan_item(item, flt))
+        return total
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for partial in pool.map(scan_item, items, [flt] * len(items)):
+            total.merge(partial)
+    return total
+
+
+# Columnar export
+def export_columns(out_path: str, trace_dir: str = TRACE_DIR, flt: Optional[TraceFilter] = None) -> int:
+    """Writes one row per trace as numpy columns; returns the row count."""
+    flt = flt or TraceFilter()
+    ts, users, tasks = array("q"), array("i"), array("i")
+    meets, degraded = array("b"), array("B")
+    counts, failures = array("H"), array("H")
+    user_codes: Dict[str, int] = {}
+    task_codes: Dict[str, int] = {}
+    stats = TraceStats()
+    for item in plan_work(list_segments(trace_dir), flt):
+        for trace in _parsed(item, flt, stats):
+            goal, bits, step_counts, step_failures = trace_facts(trace)
+            ts.append(int(trace.get("ts") or 0))
+            users.append(user_codes.setdefault(str(trace.get("user_id")), len(user_codes)))
+            tasks.append(task_codes.setdefault(str(trace.get("task")), len(task_codes)))
+            meets.append(-1 if goal is None else int(goal))
+            degraded.append(bits)
+            counts.extend(min(c, 65535) for c in step_counts)
+            failures.extend(min(c, 65535) for c in step_failures)
+    width = len(STEP_TYPES) + 1
+    np.savez(
+        out_path,
+        ts=np.frombuffer(ts, dtype=np.int64),
+        user=np.frombuffer(users, dtype=np.int32),
+        task=np.frombuffer(tasks, dtype=np.int32),
+        meets_goal=np.frombuffer(meets, dtype=np.int8),
+        degraded=np.frombuffer(degraded, dtype=np.uint8),
+        step_counts=np.frombuffer(counts, dtype=np.uint16).reshape(-1, width),
+        step_failures=np.frombuffer(failures, dtype=np.uint16).reshape(-1, width),
+        user_vocab=np.array(list(user_codes), dtype=str),
+        task_vocab=np.array(list(task_codes), dtype=str),
+        degraded_phrases=np.array(DEGRADED_PHRASES, dtype=str),
+    )
+    if stats.malformed:
+        print(f"Skipped {stats.malformed} malformed lines", file=sys.stderr)
+    return len(ts)
+
+
+def summarize_columns(path: str, flt: Optional[TraceFilter] = None) -> TraceStats:
+    flt = flt or TraceFilter()
+    cols = np.load(path)
+    mask = np.ones(len(cols["ts"]), dtype=bool)
+    if flt.since is not None:
+        mask &= cols["ts"] >= flt.since
+    if flt.until is not None:
+        mask &= cols["ts"] < flt.until
+    for name, value in (("user", flt.user), ("task", flt.task)):
+        if value is not None:
+            vocab = cols[f"{name}_vocab"].tolist()
+            mask &= cols[name] == (vocab.index(value) if value in vocab else -1)
+
+    stats = TraceStats()
+    stats.traces = int(mask.sum())
+    if not stats.traces:
+        return stats
+    ts = cols["ts"][mask]
+    stats.add_ts(int(ts.min()), int(ts.max()))
+    task_vocab = cols["task_vocab"].tolist()
+    for code, n in zip(*np.unique(cols["task"][mask], return_counts=True)):
+        stats.tasks[task_vocab[code]] = int(n)
+    meets = cols["meets_goal"][mask]
+    stats.critiques = int((meets >= 0).sum())
+    stats.meets_goal = int((meets == 1).sum())
+    bits = cols["degraded"][mask]
+    for bit, phrase in enumerate(cols["degraded_phrases"].tolist()):
+        stats.degraded[phrase] = int(((bits >> bit) & 1).sum())
+    for slot, name in enumerate(STEP_TYPES + ["other"]):
+        stats.steps[name] = int(cols["step_counts"][mask, slot].sum())
+        stats.step_failures[name] = int(cols["step_failures"][mask, slot].sum())
+    stats.steps += Counter()  # drop zero counts
+    stats.step_failures += Counter()
+    return stats
+
+
+# CLI
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """Unix ms from epoch ms, an ISO date/datetime (UTC if naive), or a relative
+    age like 30m / 24h / 7d."""
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    m = re.fullmatch(r"(\d+)([mhd])", value)
+    if m:
+        seconds = int(m.group(1)) * {"m": 60, "h": 3600, "d": 86400}[m.group(2)]
+        return int((time.time() - seconds) * 1000)
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def _format_ts(ts: Optional[int]) -> str:
+    return "-" if ts is None else datetime.fromtimestamp(ts / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+def print_report(stats: TraceStats, elapsed: float):
+    d = stats.to_dict()
+    print(f"traces: {d['traces']}  ({_format_ts(d['first_ts'])} .. {_format_ts(d['last_ts'])})  in {elapsed:.2f}s")
+    if d["malformed_lines"]:
+        print(f"malformed lines skipped: {d['malformed_lines']}")
+    rate = d["meets_goal_rate"]
+    print(f"critique meets_goal: {stats.meets_goal}/{stats.critiques}" + (f" ({rate:.1%})" if rate is not None else ""))
+    print("\ntasks:")
+    for task, n in stats.tasks.most_common():
+        print(f"  {n:>10}  {task}")
+    print("\nsteps:            count   failed")
+    for name in STEP_TYPES + ["other"]:
+        if stats.steps[name] or stats.step_failures[name]:
+            print(f"  {name:<12}{stats.steps[name]:>10}{stats.step_failures[name]:>9}")
+    print("\ndegraded phrases (traces):")
+    for phrase in DEGRADED_PHRASES:
+        share = stats.degraded[phrase] / stats.traces if stats.traces else 0.0
+        print(f"  {stats.degraded[phrase]:>10}  {share:>6.1%}  {phrase!r}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Analyse chat_api traces (traces.jsonl and rotated segments)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    summary = sub.add_parser("summary", help="meets_goal rate, degraded phrases and step counts")
+    summary.add_argument("--columnar", help="read a file written by `export` instead of the JSONL")
+    summary.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="worker processes")
+    summary.add_argument("--json", action="store_true", help="print the aggregates as JSON")
+
+    export = sub.add_parser("export", help="write compact numpy columns for repeated queries")
+    export.add_argument("--out", required=True)
+
+    for p in (summary, export):
+        p.add_argument("--dir", default=TRACE_DIR)
+        p.add_argument("--since", help="epoch ms, ISO date/time, or age like 24h / 7d")
+        p.add_argument("--until", help="epoch ms, ISO date/time, or age like 24h / 7d")
+        p.add_argument("--user", help="only traces for this user_id")
+        p.add_argument("--task", help="only traces for this task")
+
+    args = parser.parse_args(argv)
+    flt = TraceFilter(parse_time(args.since), parse_time(args.until), args.user, args.task)
+
+    started = time.monotonic()
+    if args.command == "export":
+        rows = export_columns(args.out, args.dir, flt)
+        print(f"wrote {rows} traces to {args.out} in {time.monotonic() - started:.2f}s")
+        return
+
+    if args.columnar:
+        stats = summarize_columns(args.columnar, flt)
+    else:
+        stats = summarize(args.dir, flt, jobs=args.jobs)
+    if args.json:
+        print(json.dumps(stats.to_dict(), indent=2))
+    else:
+        print_report(stats, time.monotonic() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,12 @@ from typing import Any, Dict, List
 
 TRACE_DIR = os.path.join(os.path.dirname(__file__), '..', 'traces')
 TRACE_PATH = os.path.abspath(os.path.join(TRACE_DIR, 'traces.jsonl'))
+# traces.jsonl is rotated to traces-<unix ms>.jsonl once it reaches this size;
+# rotated segments may be gzipped in place (trace_analytics reads .jsonl.gz too)
+TRACE_MAX_BYTES = int(float(os.getenv("RINA_TRACE_MAX_MB", 256)) * 1024 * 1024)
+
+# phrases in a reply that mark it as degraded (critique step in chat_api)
+DEGRADED_PHRASES = ["couldn't find", "trouble", "sorry", "try later", "busy"]
 
 
 def _ensure_dir():
@@ -32,10 +38,25 @@ def add_step(trace: Dict[str, Any], step: Dict[str, Any]):
     trace.setdefault("steps", []).append(step)
 
 
+def rotated_path(ts_ms: int) -> str:
+    return os.path.abspath(os.path.join(TRACE_DIR, f"traces-{ts_ms}.jsonl"))
+
+
+def _rotate_if_needed():
+    try:
+        if os.path.getsize(TRACE_PATH) < TRACE_MAX_BYTES:
+            return
+        os.replace(TRACE_PATH, rotated_path(int(time.time() * 1000)))
+    except OSError:
+        # missing file, or another worker rotated it first
+        pass
+
+
 def finish_trace(trace: Dict[str, Any], result: Dict[str, Any]):
     trace["result"] = result
     # append to local jsonl
     try:
+        _rotate_if_needed()
         with open(TRACE_PATH, 'a', encoding='utf-8') as f:
             f.write(json.dumps(trace, ensure_ascii=False) + "\n")
     except Exception:
@@ -1,16 +1,17 @@
 import os
 from flask import Flask, request, Response, jsonify
 from flask_cors import CORS
-from dotenv import load_dotenv
 from twilio.request_validator import RequestValidator
 from twilio.twiml.messaging_response import MessagingResponse
-from supabase import create_client, Client
-
-load_dotenv()
 
+from . import admission, clients, idempotency, media
+from .auth import verify_token
+from .coalescer import coalesce
 from .chat_service import get_bot_response
 from .supabase_client import save_chat, _get_or_create, create_listing, save_trace_snapshot
-from .tracing import start_trace, add_step, finish_trace
+from .tracing import start_trace, add_step, finish_trace, DEGRADED_PHRASES
+from .profiling import profiled, current_profile_id, PROFILE_HEADER
+from .resilience import budgeted
 
 # Environment validation
 FLASK_ENV = os.getenv("FLASK_ENV", "production").lower()
@@ -32,9 +33,8 @@ if not ADMIN_API_KEY:
 if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     print("Warning: Supabase credentials not set - auth and other features may not work")
 
-# Initialize validators and clients
+# Initialize validators (API clients are created lazily, see clients.py)
 validator = RequestValidator(TWILIO_AUTH_TOKEN) if TWILIO_AUTH_TOKEN else None
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY) if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY else None
 
 app = Flask(__name__)
 
@@ -42,7 +42,7 @@ app = Flask(__name__)
 cors_resources = {
     r"/*": {
         "origins": ALLOWED_ORIGINS,
-        "allow_headers": ["Content-Type", "Authorization"],
+        "allow_headers": ["Content-Type", "Authorization", PROFILE_HEADER],
         "methods": ["GET", "POST", "OPTIONS", "PUT", "PATCH", "DELETE"],
         "max_age": 3600,
     }
@@ -53,7 +53,14 @@ CORS(app, resources=cors_resources, supports_credentials=True)
 def health():
     return jsonify({"status": "ok", "service": "RINA webhook"}), 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Admission tier, per-tier counts, tier switches and circuit state (Prometheus text)."""
+    return Response(admission.prometheus_metrics(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/webhook", methods=["POST"])
+@profiled("webhook")
+@budgeted
 def twilio_webhook():
     """Twilio WhatsApp sandbox integration endpoint"""
     if PRODUCTION and validator:
@@ -68,24 +75,101 @@ def twilio_webhook():
         body = request.values.get("Body", "").strip()
         user_key = f"whatsapp:{sender.lstrip('+')}" or "anon"
 
-        num_media = int(request.values.get("NumMedia", 0))
-        if num_media > 0:
-            # Placeholder for media handling
-            pass
-
-        reply = get_bot_response(body, user_id=user_key)
-        save_chat(user_key, body, reply)
-
-        twiml = MessagingResponse()
-        twiml.message(reply)
-        return Response(str(twiml), mimetype="text/xml")
+        def handle() -> str:
+            # photos are only queued here; media workers download and store them
+            media_reply = media.webhook_reply(request.values, user_key)
+            if media_reply is not None:
+                twiml = MessagingResponse()
+                twiml.message(media_reply)
+                return str(twiml)
+
+            # merge bursts of short messages; only one request of a burst replies
+            text = coalesce(user_key, body)
+            if text is None:
+                return str(MessagingResponse())
+
+            reply = get_bot_response(text, user_id=user_key)
+            try:
+                save_chat(user_key, text, reply)
+            except Exception as e:
+                # the reply is ready; don't swap it for an error because persistence failed
+                print(f"Warning: Failed to save chat for user {user_key}: {e}")
+
+            twiml = MessagingResponse()
+            twiml.message(reply)
+            return str(twiml)
+
+        # Twilio retries slow webhooks; a retry gets the original's TwiML instead of re-running it
+        return Response(idempotency.once(request.values.get("MessageSid", ""), handle), mimetype="text/xml")
+    except idempotency.StillProcessing:
+        return Response("Still processing this message", status=503, headers={"Retry-After": "5"})
     except Exception as e:
         app.logger.exception("Error in webhook")
         twiml = MessagingResponse()
         twiml.message("Sorry, something went wrong. Try again later.")
         return Response(str(twiml), mimetype="text/xml")
 
+def _start_chat_trace(user_id: str, user_message: str):
+    """Open the chat trace with its plan and act steps."""
+    # start trace (decompose goal)
+    trace = start_trace(user_id=user_id, task="rent_search_or_portfolio", goal={"user_message": user_message})
+    add_step(trace, {
+        "step_no": 1,
+        "step_type": "plan",
+        "content": {
+            "restated_goal": user_message,
+            "substeps": [
+                "Classify intent (search/save/inquiry/fallback)",
+                "Call agent service to get response",
+                "Persist chat and trace",
+            ]
+        },
+        "success": True
+    })
+
+    # act
+    add_step(trace, {
+        "step_no": 2,
+        "step_type": "act",
+        "content": {
+            "tool": "chat_service.get_bot_response",
+            "args": {"user_id": user_id, "message_excerpt": user_message[:120], "len": len(user_message)}
+        },
+        "success": True
+    })
+    return trace
+
+
+def _critique_chat_trace(trace, bot_response: str):
+    """Add the critique and decision steps for the produced reply."""
+    # critique
+    ok = not any(p in bot_response.lower() for p in DEGRADED_PHRASES)
+    add_step(trace, {
+        "step_no": 3,
+        "step_type": "critique",
+        "content": {
+            "observation": bot_response[:200],
+            "meets_goal": ok,
+            "note": "Response contains apology/issue" if not ok else "Looks good"
+        },
+        "success": ok
+    })
+
+    # decision
+    add_step(trace, {
+        "step_no": 4,
+        "step_type": "decision",
+        "content": {
+            "decision": "stop" if ok else "revise",
+            "tradeoff": "Stop when response satisfies query; otherwise suggest broader search"
+        },
+        "success": True
+    })
+
+
 @app.route("/api/chat", methods=["POST"])
+@profiled("chat_api")
+@budgeted
 def chat_api():
     """API endpoint for the web chat frontend."""
     auth_header = request.headers.get("Authorization")
@@ -94,13 +178,8 @@ def chat_api():
 
     jwt = auth_header.split(" ")[1]
     try:
-        if not supabase:
-            raise Exception("Supabase client not initialized")
-        user_response = supabase.auth.get_user(jwt)
-        user = user_response.user
-        if not user:
-            raise Exception("Invalid token")
-        user_id = user.id
+        # verified locally against the project JWT secret / JWKS (see auth.py)
+        user_id = verify_token(jwt)
     except Exception as e:
         return jsonify({"error": f"Unauthorized: {e}"}), 401
 
@@ -111,65 +190,24 @@ def chat_api():
     user_message = data["message"]
 
     try:
-        # start trace (decompose goal)
-        trace = start_trace(user_id=user_id, task="rent_search_or_portfolio", goal={"user_message": user_message})
-        add_step(trace, {
-            "step_no": 1,
-            "step_type": "plan",
-            "content": {
-                "restated_goal": user_message,
-                "substeps": [
-                    "Classify intent (search/save/inquiry/fallback)",
-                    "Call agent service to get response",
-                    "Persist chat and trace",
-                ]
-            },
-            "success": True
-        })
-
-        # act
-        add_step(trace, {
-            "step_no": 2,
-            "step_type": "act",
-            "content": {
-                "tool": "chat_service.get_bot_response",
-                "args": {"user_id": user_id, "message_excerpt": user_message[:120], "len": len(user_message)}
-            },
-            "success": True
-        })
+        trace = _start_chat_trace(user_id, user_message)
 
         bot_response = get_bot_response(user_message, user_id=user_id)
 
-        # critique
-        degraded_phrases = ["couldn't find", "trouble", "sorry", "try later"]
-        ok = not any(p in bot_response.lower() for p in degraded_phrases)
-        add_step(trace, {
-            "step_no": 3,
-            "step_type": "critique",
-            "content": {
-                "observation": bot_response[:200],
-                "meets_goal": ok,
-                "note": "Response contains apology/issue" if not ok else "Looks good"
-            },
-            "success": ok
-        })
-
-        # decision
-        add_step(trace, {
-            "step_no": 4,
-            "step_type": "decision",
-            "content": {
-                "decision": "stop" if ok else "revise",
-                "tradeoff": "Stop when response satisfies query; otherwise suggest broader search"
-            },
-            "success": True
-        })
+        _critique_chat_trace(trace, bot_response)
 
         # persist chat
-        save_chat(user_id, user_message, bot_response)
+        try:
+            save_chat(user_id, user_message, bot_response)
+        except Exception as e:
+            print(f"Warning: Failed to save chat for user {user_id}: {e}")
 
         # outcome
-        snapshot = finish_trace(trace, {"reply_preview": bot_response[:200]})
+        result = {"reply_preview": bot_response[:200]}
+        profile_id = current_profile_id()
+        if profile_id:
+            result["profile_id"] = profile_id
+        snapshot = finish_trace(trace, result)
         save_trace_snapshot(snapshot)
         return jsonify({"reply": bot_response})
     except Exception as e:
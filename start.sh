@@ -21,5 +21,13 @@ psql "$DATABASE_URL" -f migrations.sql
 echo "Migrations complete."
 
 # Start the application with Gunicorn
+# RINA_SERVER_MODE=asgi serves /webhook and /api/chat from the async pipeline
+# (needs the packages in requirements-optional.txt)
+# WEB_CONCURRENCY also sizes admission control (src/admission.py)
+export WEB_CONCURRENCY="${WEB_CONCURRENCY:-4}"
 echo "Starting application with Gunicorn..."
-gunicorn --workers 4 --bind 0.0.0.0:5000 src.webhook_handler:app
\ No newline at end of file
+if [ "$RINA_SERVER_MODE" = "asgi" ]; then
+  gunicorn --workers "$WEB_CONCURRENCY" --bind 0.0.0.0:5000 --preload -k uvicorn.workers.UvicornWorker src.asgi:app
+else
+  gunicorn --workers "$WEB_CONCURRENCY" --bind 0.0.0.0:5000 --preload src.webhook_handler:app
+fi
\ No newline at end of file
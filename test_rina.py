@@ -1,27 +1,124 @@
+import asyncio
+import gzip
+import json
+import jwt
+import numpy as np
+import os
+import tempfile
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 
-from src.chat_service import get_bot_response
+from src.chat_service import get_bot_response, get_bot_response_async
+from src import admission, auth, clients, gazetteer, geo_index, idempotency, listing_ids, media, profiling, resilience, saved_searches, trace_analytics
+from src.semantic_cache import SemanticCache
+from src.quantization import QuantizedIndex
+
+
+def understood(intent, confidence=0.9, language=None, **slots):
+    """Result of the understanding stage (INTENT.understand) for mocking."""
+    return {"intent": intent, "confidence": confidence, "language": language,
+            "slots": {"location": None, "property_type": None, "max_price": None, "listing_id": None, **slots}}
+
+class FakeRedis:
+    """In-memory stand-in for the few Redis commands the app uses; a pipeline
+    runs its commands atomically, like MULTI/EXEC. No key expiry."""
+
+    def __init__(self):
+        import threading
+        self.data = {}
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def set(self, key, value, nx=False, px=None, ex=None):
+        with self.lock:
+            if nx and key in self.data:
+                return None
+            self.data[key] = str(value)
+            return True
+
+    def rpush(self, key, value):
+        with self.lock:
+            self.data.setdefault(key, []).append(value)
+            return len(self.data[key])
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            return list(self.data.get(key, []))
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self.data.pop(k, None) is not None for k in keys)
+
+    def pexpire(self, key, ms):
+        return key in self.data
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis, self.calls = redis, []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        with self.redis.lock:
+            return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeAsyncRedis:
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def get(self, key):
+        return self.redis.get(key)
+
+    def pipeline(self):
+        return FakeAsyncPipeline(self.redis)
+
+
+class FakeAsyncPipeline(FakePipeline):
+    async def execute(self):
+        return FakePipeline.execute(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
 
 class TestRinaBot(unittest.TestCase):
 
     @patch('src.chat_service.detect_language')
-    @patch('src.chat_service.INTENT.predict')
+    @patch('src.chat_service.INTENT.understand')
     def test_greeting(self, mock_intent_predict, mock_lang_detect):
         """Test that the bot responds with a greeting."""
         mock_lang_detect.return_value = 'en'
-        mock_intent_predict.return_value = ('greeting', 0.9)
+        mock_intent_predict.return_value = understood('greeting', 0.9)
 
         response = get_bot_response('hello')
         self.assertIn('Hi! I can help you find student housing', response)
 
     @patch('src.chat_service.detect_language')
-    @patch('src.chat_service.INTENT.predict')
+    @patch('src.chat_service.INTENT.understand')
     @patch('src.chat_service.retrieve_listings')
     def test_search_intent(self, mock_retrieve_listings, mock_intent_predict, mock_lang_detect):
         """Test that the bot correctly identifies a search intent."""
         mock_lang_detect.return_value = 'en'
-        mock_intent_predict.return_value = ('search_listings', 0.9)
+        mock_intent_predict.return_value = understood('search_listings', 0.9)
         mock_retrieve_listings.return_value = [
             {
                 'id': '123',
@@ -38,16 +135,780 @@ class TestRinaBot(unittest.TestCase):
         self.assertIn('Test Listing', response)
 
     @patch('src.chat_service.detect_language')
-    @patch('src.chat_service.INTENT.predict')
+    @patch('src.chat_service.INTENT.understand')
     @patch('src.chat_service.sb.save_listing_to_favorites')
     def test_save_listing_intent(self, mock_save_listing, mock_intent_predict, mock_lang_detect):
         """Test that the bot correctly identifies a save listing intent."""
         mock_lang_detect.return_value = 'en'
-        mock_intent_predict.return_value = ('save_listing', 0.9)
+        mock_intent_predict.return_value = understood('save_listing', 0.9)
         mock_save_listing.return_value = None
 
-        response = get_bot_response('save 12345678')
-        self.assertIn('Saved listing 12345678 to your favorites', response)
+        response = get_bot_response('save 3f9a1c22')
+        self.assertIn('Saved listing 3f9a1c22 to your favorites', response)
+
+    @patch('src.chat_service.detect_language')
+    @patch('src.chat_service.INTENT.aunderstand')
+    @patch('src.chat_service.asb.save_chat')
+    def test_async_pipeline_greeting(self, mock_save_chat, mock_intent_apredict, mock_lang_detect):
+        """Test that the async pipeline routes and replies like the sync one."""
+        mock_lang_detect.return_value = 'en'
+        mock_intent_apredict.return_value = understood('greeting', 0.9)
+        mock_save_chat.return_value = None
+
+        response = asyncio.run(get_bot_response_async('hello'))
+        self.assertIn('Hi! I can help you find student housing', response)
+        mock_save_chat.assert_awaited_once()
+    @patch('src.chat_service.detect_language')
+    @patch('src.chat_service.INTENT.understand')
+    @patch('src.chat_service.embed_text')
+    @patch('src.chat_service.clients.openai_client')
+    def test_fallback_answer_is_cached(self, mock_openai_client, mock_embed_text, mock_intent_predict, mock_lang_detect):
+        """Test that a near-duplicate fallback question is answered from the semantic cache."""
+        mock_lang_detect.return_value = 'en'
+        mock_intent_predict.return_value = understood('fallback', 0.5)
+        mock_embed_text.side_effect = [[1.0, 0.0, 0.0], [0.99, 0.05, 0.0]]
+        completion = MagicMock()
+        completion.choices[0].message.content = 'Pay the deposit via M-Pesa to the landlord.'
+        mock_openai_client.return_value.chat.completions.create.return_value = completion
+
+        with patch('src.chat_service.FALLBACK_CACHE', SemanticCache(threshold=0.9)):
+            first = get_bot_response('how do I pay deposit')
+            second = get_bot_response('how can I pay the deposit?')
+
+        self.assertEqual(first, second)
+        mock_openai_client.return_value.chat.completions.create.assert_called_once()
+
+
+class TestUnderstanding(unittest.TestCase):
+
+    @patch('src.intent_classifier.clients.openai_client')
+    def test_one_cached_completion_gives_intent_language_and_slots(self, mock_openai_client):
+        """Test that intent, language and normalized slots come from one completion, cached per message."""
+        from src import intent_classifier
+        completion = MagicMock()
+        completion.choices[0].message.content = json.dumps({
+            "intent": "search_listings", "language": "sheng", "location": "kahawa", "property_type": "Bedsitter",
+            "max_price": 7000, "listing_id": "abc12345"})
+        mock_openai_client.return_value.chat.completions.create.return_value = completion
+
+        with patch.object(intent_classifier, 'UNDERSTANDING_CACHE', intent_classifier._TTLCache(8, 60)):
+            first = intent_classifier.IntentClassifier().understand("Niko na 7k, bedsitter Kahawa")
+            again = intent_classifier.IntentClassifier().understand("niko na 7k,  bedsitter kahawa")
+        self.assertEqual(first, again)
+        mock_openai_client.return_value.chat.completions.create.assert_called_once()
+        request = mock_openai_client.return_value.chat.completions.create.call_args.kwargs
+        self.assertTrue(request["response_format"]["json_schema"]["strict"])
+        self.assertEqual((first["intent"], first["language"]), ("search_listings", "sheng"))
+        self.assertEqual(first["slots"], {"location": "Kahawa Wendani", "property_type": "Bedsitter",
+                                          "max_price": 7000, "listing_id": None})
+
+    def test_parser_rejects_responses_outside_the_schema(self):
+        """Test that malformed or off-schema completions are rejected and fall back to local extraction."""
+        from src.intent_classifier import parse_understanding, _fallback_understanding
+        good = {"intent": "save_listing", "language": "en", "location": None, "property_type": None,
+                "max_price": None, "listing_id": "3f9a1c"}
+        self.assertEqual(parse_understanding(json.dumps(good), "save 3F9A1C")["slots"]["listing_id"], "3f9a1c")
+        for bad in ({**good, "intent": "buy_house"}, {**good, "extra": 1}, {k: v for k, v in good.items() if k != "language"}):
+            self.assertRaises(ValueError, parse_understanding, json.dumps(bad), "save 3f9a1c")
+        self.assertRaises(ValueError, parse_understanding, "Intent: save_listing", "save 3f9a1c")
+        self.assertEqual(_fallback_understanding("bedsitter in Ruaka under 9k")["slots"]["max_price"], 9000)
+
+
+class TestSemanticCache(unittest.TestCase):
+
+    def test_language_partitions_and_lru_eviction(self):
+        """Test that lookups stay within a language and the least recently used entry is evicted."""
+        cache = SemanticCache(capacity_per_language=2, threshold=0.9)
+        cache.put('is water included', [1.0, 0.0], 'en', 'Usually yes.')
+        cache.put('how to contact landlord', [0.0, 1.0], 'en', 'Use the number on the card.')
+        self.assertIsNone(cache.get([1.0, 0.0], 'sw'))
+        self.assertEqual(cache.get([1.0, 0.01], 'en'), 'Usually yes.')
+
+        cache.put('wifi speed', [0.7, 0.7], 'en', 'Depends on the building.')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get_exact('how to contact landlord', 'en'))
+        self.assertEqual(cache.get_exact('Is water included?', 'en'), 'Usually yes.')
+
+
+class TestLocalAuth(unittest.TestCase):
+
+    def setUp(self):
+        auth.TOKEN_CACHE.clear()
+
+    @patch('src.auth.JWT_SECRET', 'test-secret-0123456789abcdef0123456789')
+    @patch('src.auth._verify_remote')
+    def test_token_verified_locally_and_cached(self, mock_verify_remote):
+        """Test that a Supabase HS256 token is verified in-process and then served from cache."""
+        claims = {'sub': 'user-1', 'aud': 'authenticated', 'exp': int(time.time()) + 600}
+        token = jwt.encode(claims, 'test-secret-0123456789abcdef0123456789', algorithm='HS256')
+
+        self.assertEqual(auth.verify_token(token), 'user-1')
+        with patch('src.auth._verify_local') as mock_verify_local:
+            self.assertEqual(auth.verify_token(token), 'user-1')
+            mock_verify_local.assert_not_called()
+        mock_verify_remote.assert_not_called()
+
+    @patch('src.auth.JWT_SECRET', 'test-secret-0123456789abcdef0123456789')
+    @patch('src.auth._verify_remote')
+    def test_expired_or_forged_token_rejected(self, mock_verify_remote):
+        """Test that expired or badly signed tokens are rejected without a remote call."""
+        expired = jwt.encode({'sub': 'u', 'aud': 'authenticated', 'exp': int(time.time()) - 60}, 'test-secret-0123456789abcdef0123456789', algorithm='HS256')
+        forged = jwt.encode({'sub': 'u', 'aud': 'authenticated', 'exp': int(time.time()) + 600}, 'other-secret-0123456789abcdef01234567', algorithm='HS256')
+        for token in (expired, forged):
+            with self.assertRaises(auth.AuthError):
+                auth.verify_token(token)
+        mock_verify_remote.assert_not_called()
+
+
+class TestQuantization(unittest.TestCase):
+
+    def test_int8_index_with_rescoring_matches_exact_search(self):
+        """Test that int8 storage with float rescoring returns the exact top-k at reduced dimensions."""
+        rng = np.random.default_rng(0)
+        corpus = rng.standard_normal((300, 64)).astype(np.float32)
+        query = corpus[7] + 0.1 * rng.standard_normal(64).astype(np.float32)
+        exact = QuantizedIndex(corpus, range(300), dtype='float32', dims=32)
+        compact = QuantizedIndex(corpus, range(300), dtype='int8', dims=32, keep_float=True)
+
+        expected = [i for i, _ in exact.search(query, k=5)]
+        self.assertEqual([i for i, _ in compact.search(query, k=5, rescore=20)], expected)
+        self.assertLess(compact.nbytes, exact.nbytes / 3)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_profile_is_written_and_aggregated(self):
+        """Test that a profiled call writes collapsed stacks the CLI can aggregate."""
+        def busy():
+            end = time.time() + 0.05
+            while time.time() < end:
+                pass
+            return 'done'
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch.object(profiling, 'PROFILE_DIR', tmp), \
+                patch.object(profiling, 'PROFILE_INDEX_PATH', os.path.join(tmp, 'index.jsonl')):
+            self.assertEqual(profiling.run_profiled('chat_api', busy), 'done')
+            paths = profiling._select_profiles(tmp, 'chat_api', None)
+            self.assertEqual(len(paths), 1)
+            self_counts, total_counts, grand_total = profiling.aggregate(paths)
+            self.assertGreater(grand_total, 0)
+            self.assertTrue(any(fn.endswith('busy') for fn in total_counts))
+
+
+class TestResilience(unittest.TestCase):
+
+    def test_circuit_breaker_opens_and_recovers(self):
+        """Test that the breaker fails fast after repeated failures and closes after a good trial call."""
+        b = resilience.CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+        b.record_failure()
+        b.record_failure()
+        self.assertEqual(b.state, 'open')
+        self.assertRaises(resilience.CircuitOpenError, b.check)
+        time.sleep(0.06)
+        self.assertTrue(b.allow())   # one trial call in half-open state
+        self.assertFalse(b.allow())
+        b.record_success(0.01)
+        self.assertEqual(b.state, 'closed')
+
+    def test_cancelled_or_client_error_trial_does_not_wedge_the_breaker(self):
+        """Test that a cancelled half-open trial, or a 4xx error, releases the trial instead of keeping the circuit shut."""
+        b = resilience.CircuitBreaker('test', failure_threshold=1, reset_timeout=0.0)
+
+        async def trial():
+            with resilience.guarded('test'):
+                await asyncio.sleep(10)
+
+        async def cancel_trial():
+            task = asyncio.ensure_future(trial())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        class BadRequest(Exception):
+            status_code = 400
+
+        with patch.dict(resilience.BREAKERS, {'test': b}):
+            b.record_failure()
+            self.assertEqual(b.state, 'half_open')
+            asyncio.run(cancel_trial())
+            self.assertTrue(b.allow())  # a new trial is let through
+            b.release_trial()
+            for _ in range(3):
+                with self.assertRaises(BadRequest):
+                    with resilience.guarded('test'):
+                        raise BadRequest()
+            self.assertEqual(b.state, 'half_open')
+            self.assertTrue(b.allow())
+
+    @patch('src.chat_service.detect_language')
+    @patch('src.chat_service.INTENT.understand')
+    @patch('src.chat_service.retrieve_listings')
+    def test_search_reply_when_budget_exhausted(self, mock_retrieve, mock_predict, mock_detect_language):
+        """Test that a spent request budget gives the canned search reply instead of 'no matches'."""
+        mock_detect_language.return_value = 'en'
+        mock_predict.return_value = understood('search_listings', 0.9)
+        mock_retrieve.side_effect = lambda *a, **k: resilience.stage_timeout(10.0)
+        with resilience.deadline(0.0):
+            self.assertRaises(resilience.DeadlineExceeded, resilience.stage_timeout, 1.0)
+            response = get_bot_response("bedsitter in Kilimani")
+        self.assertIn("try again", response)
+
+
+class TestAdmission(unittest.TestCase):
+
+    @patch('src.admission.BREAKERS', {'openai': resilience.CircuitBreaker('openai')})
+    @patch('src.admission.clients.redis_client', return_value=None)
+    def test_tiers_follow_in_flight_load(self, mock_redis):
+        """Test that the tier rises with in-flight messages, sheds past capacity and steps down one tier at a time."""
+        controller = admission.AdmissionController(capacity=4, async_capacity=4)
+        tiers = []
+
+        def nest(depth, shared):
+            with controller.admit(shared) as tier:
+                tiers.append(tier)
+                if depth > 1:
+                    nest(depth - 1, shared)
+        # a sync worker without Redis can't see the other workers' messages
+        nest(6, shared=True)
+        self.assertEqual(tiers, [0] * 6)
+
+        tiers.clear()
+        nest(6, shared=False)
+        # 1/4 .. 6/4 in flight against thresholds 0.7, 0.85, 1.0, 1.3
+        self.assertEqual(tiers, [0, 0, 1, 3, 3, admission.SHED])
+
+        tiers.clear()
+        with patch('src.admission.STEP_DOWN_SECONDS', 0.0):
+            for _ in range(6):
+                with controller.admit(shared=False) as tier:
+                    tiers.append(tier)
+        self.assertEqual(tiers, [admission.SHED, 3, 2, 1, 0, 0])
+        self.assertEqual(controller.metrics()["admitted"]["shed"], 2)
+        self.assertEqual(controller.metrics()["tier_switches"]["full->no_llm_fallback"], 1)
+
+    @patch('src.admission.BREAKERS', {'openai': resilience.CircuitBreaker('openai')})
+    def test_busy_sync_workers_are_not_overloaded(self):
+        """Test that N messages in flight on N sync workers stay below the cached-search tier."""
+        redis_client = MagicMock()
+        redis_client.zcard.return_value = 4
+        controller = admission.AdmissionController(capacity=4)
+        with patch('src.admission.clients.redis_client', return_value=redis_client):
+            with controller.admit() as tier:
+                self.assertLessEqual(tier, admission.NO_LLM_FALLBACK)
+            redis_client.zcard.return_value = 9  # stale entries from killed workers
+            with controller.admit() as tier:
+                self.assertLess(tier, admission.CACHED_SEARCH)
+
+    @patch('src.chat_service.detect_language', return_value='en')
+    @patch('src.chat_service.retrieve_listings')
+    @patch('src.chat_service.INTENT.understand')
+    def test_degraded_tiers_skip_expensive_stages(self, mock_understand, mock_retrieve, mock_detect_language):
+        """Test that overload sheds without work, and the cached-search tier answers only from recent results."""
+        from src import chat_service
+        chat_service.SEARCH_CACHE.clear()
+        mock_retrieve.return_value = [{'id': '123', 'title': 'Ruaka Bedsitter', 'location': 'Ruaka', 'price': '8000'}]
+
+        def at_load(load):
+            controller = admission.AdmissionController()
+            controller.load = MagicMock(return_value=load)
+            return patch('src.admission.CONTROLLER', controller)
+
+        with patch('src.chat_service.save_chat'):
+            mock_understand.return_value = understood('search_listings', 0.9)
+            get_bot_response("Bedsitter in  Ruaka")  # full tier fills the search cache
+            with at_load(2.0):
+                self.assertEqual(get_bot_response("bedsitter in Ruaka"), chat_service.BUSY_REPLY)
+            with at_load(1.1):
+                cached = get_bot_response("bedsitter in ruaka")
+                missed = get_bot_response("hostel near JKUAT")
+        self.assertIn("Ruaka Bedsitter", cached)
+        self.assertEqual(missed, chat_service.SEARCH_UNAVAILABLE_REPLY)
+        mock_understand.assert_called_once()  # the local tiers never ask the model
+        mock_retrieve.assert_called_once()
+
+        text = admission.prometheus_metrics()
+        self.assertIn('rina_admission_admitted_total{tier="full"}', text)
+        self.assertIn('rina_circuit_open{dependency="openai"}', text)
+
+@patch('src.coalescer.ENABLED', True)
+@patch('src.coalescer.WINDOW_MS', 150)
+@patch('src.coalescer.MAX_WAIT_MS', 600)
+@patch('src.coalescer.POLL_MS', 10)
+class TestCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        from src import coalescer
+        self.coalescer = coalescer
+        self.redis = FakeRedis()
+        patcher = patch('src.coalescer.clients.redis_client', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _in_thread(self, body, results):
+        import threading
+        t = threading.Thread(target=lambda: results.append((body, self.coalescer.coalesce("whatsapp:254700000002", body))))
+        t.start()
+        return t
+
+    def test_burst_is_answered_once_by_the_leader(self):
+        """Test that lines sent within the window are merged into the leader's reply and followers get None."""
+        results = []
+        threads = [self._in_thread("hi", results)]
+        for line in ("looking for bedsitter", "near KU"):
+            time.sleep(0.05)
+            threads.append(self._in_thread(line, results))
+        for t in threads:
+            t.join(2)
+        replies = dict(results)
+        self.assertEqual(replies["hi"], "hi\nlooking for bedsitter\nnear KU")
+        self.assertIsNone(replies["looking for bedsitter"])
+        self.assertIsNone(replies["near KU"])
+        self.assertEqual(self.redis.data.get("coalesce:whatsapp:254700000002:msgs"), None)
+
+    def test_leader_waits_at_most_max_wait(self):
+        """Test that a user who keeps typing still gets an answer after MAX_WAIT_MS."""
+        results, threads = [], []
+        started = time.monotonic()
+        threads.append(self._in_thread("line 0", results))
+        for i in range(1, 12):
+            time.sleep(0.1)
+            if "line 0" in dict(results):
+                break
+            threads.append(self._in_thread(f"line {i}", results))
+        waited = time.monotonic() - started
+        for t in threads:
+            t.join(2)
+        replies = dict(results)
+        self.assertLess(waited, 1.0)  # MAX_WAIT_MS is 0.6s; the user was still typing
+        self.assertTrue(replies["line 0"].startswith("line 0\nline 1"))
+
+    def test_line_after_drain_starts_a_new_burst(self):
+        """Test that drain and leader release are atomic: the next line leads its own burst instead of being lost."""
+        self.assertEqual(self.coalescer.coalesce("whatsapp:254700000002", "first"), "first")
+        self.assertEqual(self.coalescer.coalesce("whatsapp:254700000002", "second"), "second")
+
+        # a follower whose line landed just before the drain is answered by that drain
+        self.redis.set("coalesce:whatsapp:254700000002:leader", "someone-else")
+        self.assertIsNone(self.coalescer.coalesce("whatsapp:254700000002", "queued"))
+        self.redis.delete("coalesce:whatsapp:254700000002:leader")
+        self.assertEqual(self.coalescer.coalesce("whatsapp:254700000002", "next"), "queued\nnext")
+
+    def test_async_variant_merges_bursts(self):
+        """Test that acoalesce merges a burst the same way on the event loop."""
+        async def burst():
+            leader = asyncio.ensure_future(self.coalescer.acoalesce("whatsapp:254700000003", "bedsitter"))
+            await asyncio.sleep(0.05)
+            follower = await self.coalescer.acoalesce("whatsapp:254700000003", "under 7k")
+            return await leader, follower
+
+        with patch('src.coalescer.clients.async_redis_client', return_value=FakeAsyncRedis(self.redis)):
+            self.assertEqual(asyncio.run(burst()), ("bedsitter\nunder 7k", None))
+
+    def test_sync_app_does_not_wait_by_default(self):
+        """Test that coalescing is off for the sync app unless enabled, so no worker sleeps."""
+        with patch('src.coalescer.ENABLED', False):
+            started = time.monotonic()
+            self.assertEqual(self.coalescer.coalesce("whatsapp:254700000004", "hi"), "hi")
+        self.assertLess(time.monotonic() - started, 0.05)
+        self.assertEqual(self.redis.data, {})
+
+
+class TestIdempotency(unittest.TestCase):
+
+    @patch('src.webhook_handler.save_chat')
+    @patch('src.webhook_handler.get_bot_response', return_value='Here are some listings')
+    @patch('src.idempotency.clients.redis_client', return_value=None)
+    def test_twilio_retry_reuses_the_first_reply(self, mock_redis, mock_reply, mock_save_chat):
+        """Test that a retried webhook with the same MessageSid gets the cached TwiML without recomputing."""
+        from src.webhook_handler import app
+        form = {"From": "whatsapp:+254700000001", "Body": "bedsitter in Ruaka", "MessageSid": "SM-retry-test"}
+        with patch('src.coalescer.clients.redis_client', return_value=None):
+            first = app.test_client().post('/webhook', data=form)
+            retry = app.test_client().post('/webhook', data=form)
+        self.assertEqual(first.data, retry.data)
+        self.assertIn(b'Here are some listings', retry.data)
+        mock_reply.assert_called_once()
+        mock_save_chat.assert_called_once()
+
+    @patch('src.idempotency.clients.redis_client', return_value=None)
+    def test_concurrent_retry_waits_for_the_original(self, mock_redis):
+        """Test that a retry arriving mid-flight waits for the original result, and a failure lets the next try compute."""
+        import threading
+        started, release, calls = threading.Event(), threading.Event(), []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(2)
+            return "<Response/>"
+
+        results = []
+        owner = threading.Thread(target=lambda: results.append(idempotency.once("SM-concurrent", slow)))
+        owner.start()
+        started.wait(2)
+        retry = threading.Thread(target=lambda: results.append(idempotency.once("SM-concurrent", slow)))
+        retry.start()
+        release.set()
+        owner.join(2)
+        retry.join(2)
+        self.assertEqual((results, len(calls)), (["<Response/>", "<Response/>"], 1))
+
+        def broken():
+            raise RuntimeError("boom")
+        self.assertRaises(RuntimeError, idempotency.once, "SM-failed", broken)
+        self.assertEqual(idempotency.once("SM-failed", lambda: "ok"), "ok")
+
+
+class TestChatHistory(unittest.TestCase):
+
+    @patch('src.supabase_client._get_or_create_user', return_value='user-1')
+    @patch('src.supabase_client._get')
+    def test_history_is_paged_by_keyset(self, mock_get, mock_user):
+        """Test that the next page is requested after the last row's (created_at, id), not by offset."""
+        from src import supabase_client as sb
+        pages = [
+            [{"id": "c3", "created_at": "2025-05-03T10:00:00+00:00", "user_message": "3", "bot_response": "r3"},
+             {"id": "c2", "created_at": "2025-05-02T10:00:00+00:00", "user_message": "2", "bot_response": "r2"}],
+            [{"id": "c1", "created_at": "2025-05-01T10:00:00+00:00", "user_message": "1", "bot_response": "r1"}],
+        ]
+        mock_get.side_effect = [MagicMock(status_code=200, json=MagicMock(return_value=p)) for p in pages]
+
+        rows = list(sb.iter_chat_history("whatsapp:254700000000", page_size=2))
+        self.assertEqual([r["id"] for r in rows], ["c3", "c2", "c1"])
+        second_params = dict(mock_get.call_args_list[1].kwargs["params"])
+        self.assertEqual(second_params["created_at"], "lte.2025-05-02T10:00:00+00:00")
+        self.assertIn("id.lt.c2", second_params["or"])
+        self.assertNotIn("offset", second_params)
+
+
+class TestLandlordPortfolio(unittest.TestCase):
+
+    @patch('src.supabase_client.clients.redis_client', return_value=None)
+    @patch('src.supabase_client._post')
+    def test_portfolio_is_cached_until_a_listing_write(self, mock_post, mock_redis):
+        """Test that the portfolio RPC result is reused and dropped when the landlord adds a listing."""
+        from src import supabase_client as sb
+        portfolio = {"landlord_id": "l1", "unassigned_listing_count": 0, "complexes": [
+            {"id": "c1", "name": "Campus View", "location": "Kilimani", "listing_count": 2,
+             "units": [{"id": "u1", "label": "A1", "status": "vacant"}]}]}
+        mock_post.return_value = MagicMock(status_code=200, json=MagicMock(return_value=portfolio))
+        sb.PORTFOLIO_CACHE.clear()
+
+        self.assertEqual(sb.get_complexes("whatsapp:254712345678")[0]["listing_count"], 2)
+        self.assertEqual(sb.get_units("whatsapp:254712345678", "c1")[0]["complex_id"], "c1")
+        self.assertEqual(mock_post.call_count, 1)
+
+        sb.create_listing({"title": "Studio", "landlord_id": "l1", "complex_id": "c1"})
+        sb.get_landlord_portfolio("whatsapp:254712345678")
+        rpc_calls = [c for c in mock_post.call_args_list if c.args[0].endswith("/rpc/landlord_portfolio")]
+        self.assertEqual(len(rpc_calls), 2)
+
+    @patch('src.supabase_client._post')
+    def test_write_during_the_rpc_is_not_cached_as_current(self, mock_post):
+        """Test that a generation bump between the portfolio RPC and caching makes the next read refetch."""
+        from src import supabase_client as sb
+        redis_client = FakeRedis()
+        writes = []
+
+        def rpc(*args, **kwargs):
+            if writes:  # a listing write lands while the RPC is running
+                redis_client.set(sb._portfolio_generation_key("l1"), writes.pop())
+            return MagicMock(status_code=200, json=MagicMock(return_value={"landlord_id": "l1", "complexes": []}))
+        mock_post.side_effect = rpc
+        sb.PORTFOLIO_CACHE.clear()
+        sb.PORTFOLIO_LANDLORDS.clear()
+
+        with patch('src.supabase_client.clients.redis_client', return_value=redis_client):
+            sb.get_landlord_portfolio("whatsapp:254712345678")  # landlord unknown: not cached
+            writes.append(1)
+            sb.get_landlord_portfolio("whatsapp:254712345678")  # cached under generation 0
+            sb.get_landlord_portfolio("whatsapp:254712345678")
+            sb.get_landlord_portfolio("whatsapp:254712345678")
+        self.assertEqual(mock_post.call_count, 3)
+
+
+class TestListingIds(unittest.TestCase):
+
+    def test_short_ids_are_unique_prefixes(self):
+        """Test that cards show the shortest unambiguous prefix and that prefixes resolve back to the full ID."""
+        ids = ["3f9a1c22-0000-4000-8000-000000000001", "3f9a1c27-0000-4000-8000-000000000002",
+               "abcdef01-0000-4000-8000-000000000003", "b1000000-0000-4000-8000-000000000004"]
+        index = listing_ids.ListingIdIndex(ids)
+        self.assertEqual(index.short_id(ids[0]), "3f9a1c22")
+        self.assertEqual(index.short_id(ids[2]), "abcdef0")  # extended until it has a digit
+        self.assertEqual(index.short_id(ids[3]), "b10000")
+        self.assertEqual(index.lookup("3F9A1C27"), [ids[1]])
+        self.assertEqual(len(index.lookup("3f9a1c")), 2)
+        self.assertEqual(listing_ids.extract_token("save abcdef0 please"), "abcdef0")
+        self.assertIsNone(listing_ids.extract_token("inquire about the facade"))
+        digits_first = "12345678-9abc-4000-8000-000000000005"
+        self.assertEqual(listing_ids.ListingIdIndex([digits_first]).short_id(digits_first), "12345678-9a")
+
+        with patch.object(listing_ids, 'INDEX', index), patch.object(listing_ids, 'ensure_loaded', return_value=True):
+            self.assertEqual(listing_ids.resolve("b10000"), ids[3])
+            self.assertIsNone(listing_ids.resolve("c12345"))
+            with self.assertRaises(listing_ids.AmbiguousListingId):
+                listing_ids.resolve("3f9a1c")
+
+    def test_budgets_and_phone_numbers_are_not_ids(self):
+        """Test that all-digit tokens (budgets, phone numbers) are never taken as listing IDs."""
+        from src.intent_classifier import IntentClassifier
+        for text in ("bedsitter in kilimani under 150000", "call me 0712345678", "save 254712345678"):
+            self.assertIsNone(listing_ids.extract_token(text), text)
+        local = IntentClassifier().understand_local("bedsitter in kilimani under 150000")
+        self.assertEqual((local["intent"], local["slots"]["listing_id"]), ("search_listings", None))
+
+    @patch('src.chat_service.listing_ids.ensure_loaded', return_value=True)
+    @patch('src.chat_service.sb.create_inquiry')
+    def test_inquiry_with_short_id(self, mock_inquiry, mock_loaded):
+        """Test that an inquiry made with a short ID is written against the full listing ID."""
+        from src.chat_service import _handle_inquiry
+        full = "3f9a1c22-0000-4000-8000-000000000001"
+        with patch.object(listing_ids, 'INDEX', listing_ids.ListingIdIndex([full])):
+            reply = _handle_inquiry("inquire 3f9a1c is it still available?", "whatsapp:254700000001")
+        self.assertIn("3f9a1c", reply)
+        mock_inquiry.assert_called_once_with("whatsapp:254700000001", full, "is it still available?")
+
+
+class TestGeo(unittest.TestCase):
+
+    def test_grid_index_matches_brute_force(self):
+        """Test that radius and nearest queries on the grid return the same listings as a full scan."""
+        from src.slots import AREAS
+        names = {p["name"] for p in gazetteer.places()}
+        self.assertTrue(set(AREAS) <= names)
+
+        rng = np.random.default_rng(0)
+        points = [(f"l{i}", -1.29 + rng.uniform(-0.15, 0.15), 36.82 + rng.uniform(-0.15, 0.15)) for i in range(2000)]
+        index = geo_index.GridIndex(points)
+        ku = gazetteer.geocode("near KU")
+        dists = gazetteer.haversine_km(ku["lat"], ku["lon"], np.array([p[1] for p in points]), np.array([p[2] for p in points]))
+        expected = sorted((points[i][0] for i in np.flatnonzero(dists <= 3.0)), key=lambda i: dists[int(i[1:])])
+        self.assertEqual([i for i, _ in index.within(ku["lat"], ku["lon"], 3.0)], expected)
+        self.assertEqual([i for i, _ in index.nearest(ku["lat"], ku["lon"], k=5)], [points[i][0] for i in np.argsort(dists)[:5]])
+
+    @patch('src.retrieval.embed_text', return_value=[0.1, 0.2])
+    @patch('src.retrieval.sb._post')
+    def test_near_campus_search_scores_only_nearby_listings(self, mock_post, mock_embed):
+        """Test that a "near <campus>" query sends only listings inside the radius to vector scoring, ranked with distance."""
+        from src.retrieval import retrieve_listings
+        place, radius = gazetteer.find_landmark("bedsitter near Kenyatta University")
+        self.assertEqual((place["name"], radius), ("Kenyatta University", gazetteer.NEAR_RADIUS_KM))
+        index = geo_index.GridIndex([("near", -1.1830, 36.9330), ("close", -1.1800, 36.9365), ("far", -1.2906, 36.7850)])
+        rows = [{"id": "near", "title": "Bedsitter", "property_type": "Bedsitter", "similarity": 0.6},
+                {"id": "close", "title": "Bedsitter", "property_type": "Bedsitter", "similarity": 0.6}]
+        mock_post.return_value = MagicMock(status_code=200, json=MagicMock(return_value=rows))
+        with patch.object(geo_index, 'INDEX', index), patch.object(geo_index, 'ensure_loaded', return_value=True):
+            results = retrieve_listings("bedsitter near Kenyatta University", top_k=2)
+        body = mock_post.call_args.kwargs["json"]
+        self.assertTrue(mock_post.call_args.args[0].endswith("/rpc/match_listings_in"))
+        self.assertEqual(sorted(body["candidate_ids"]), ["close", "near"])
+        self.assertEqual([r["id"] for r in results], ["close", "near"])
+        self.assertEqual(results[0]["landmark"], "Kenyatta University")
+
+
+class TestSavedSearches(unittest.TestCase):
+
+    def test_index_matches_on_slots_then_embeddings(self):
+        """Test that a new listing reaches only searches whose slots admit it and whose query is similar."""
+        index = saved_searches.SavedSearchIndex()
+        near, far = [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]
+        index.add({"id": "s1", "phone": "a", "location": "Kilimani", "property_type": "Bedsitter", "max_price": 8000, "embedding": near})
+        index.add({"id": "s2", "phone": "b", "location": "Kilimani", "property_type": None, "max_price": None, "embedding": far})
+        index.add({"id": "s3", "phone": "c", "location": "Roysambu", "property_type": "Bedsitter", "max_price": 8000, "embedding": near})
+        index.add({"id": "s4", "phone": "d", "location": None, "property_type": "Bedsitter", "max_price": 6000, "embedding": None})
+        index.add({"id": "s5", "phone": "e", "location": None, "property_type": None, "max_price": None, "embedding": "[0.9,0.1,0]"})
+
+        listing = {"id": "l1", "title": "Cosy bedsitter", "location": "Kilimani, Nairobi", "price": 7500}
+        embed = MagicMock(return_value=[0.95, 0.05, 0.0])
+        self.assertEqual(sorted(s["id"] for s in index.match(listing, embed)), ["s1", "s5"])
+        embed.assert_called_once()
+
+        self.assertEqual(index.remove(lambda s: s["phone"] in ("a", "e")), 2)
+        embed = MagicMock()
+        self.assertEqual(index.match({"id": "l2", "title": "Bedsitter", "location": "Ruaka", "price": 5000}, embed)[0]["id"], "s4")
+        embed.assert_not_called()
+
+    @patch('src.chat_service.saved_searches.save_search')
+    def test_alerts_need_a_whatsapp_number(self, mock_save):
+        """Test that web chat users (keyed by auth user id) can't save an alert that could never be delivered."""
+        from src.chat_service import _handle_save_search
+        for user in ("anon", "6f1c2a9e-8d4b-4c1e-9a7f-2b3c4d5e6f70"):
+            self.assertIn("only available on WhatsApp", _handle_save_search("notify me bedsitter in Ruaka", user, "en"))
+        mock_save.assert_not_called()
+
+    def test_slot_extraction(self):
+        """Test that queries are reduced to the canonical location, type and budget used by the index."""
+        from src.slots import extract_slots
+        self.assertEqual(extract_slots("bedsitter in kahawa under 8k"),
+                         {"location": "Kahawa Wendani", "property_type": "Bedsitter", "max_price": 8000})
+        self.assertEqual(extract_slots("1br westlands ksh 15,000 call 0712345678")["max_price"], 15000)
+
+
+class TestMedia(unittest.TestCase):
+
+    def setUp(self):
+        """Serve fake Twilio media from a local HTTP server."""
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        photo = b"\x89PNG\r\n\x1a\n" + os.urandom(2048)
+
+        class FakeMedia(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/pdf" if self.path == "/doc" else "image/png")
+                self.end_headers()
+                try:
+                    # /huge has no Content-Length, so only the streamed byte count can stop it
+                    for _ in range(64 if self.path == "/huge" else 1):
+                        self.wfile.write(photo if self.path != "/huge" else os.urandom(16 * 1024))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeMedia)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @patch('src.media.upload', side_effect=lambda path, data, content_type: f"https://cdn/{path}")
+    @patch('src.media.sb._post')
+    def test_media_is_streamed_deduped_and_appended_in_one_batch(self, mock_post, mock_upload):
+        """Test that workers store each distinct photo once, skip oversize and non-image files, and append in bulk."""
+        listing_id = "3f9a1c22-0000-4000-8000-000000000001"
+
+        def rpc(url, json=None, **kwargs):
+            body = listing_id if url.endswith("media_target_listing") else 1
+            return MagicMock(status_code=200, json=MagicMock(return_value=body))
+        mock_post.side_effect = rpc
+
+        urls = [f"{self.base}/a.png", f"{self.base}/same-photo-again.png", f"{self.base}/huge", f"{self.base}/doc"]
+        with patch('src.media.MAX_BYTES', 256 * 1024), patch('src.media.BATCH_SECONDS', 60):
+            self.assertTrue(media.enqueue("whatsapp:254700000009", "", urls))
+            self.assertTrue(media.drain(10))
+
+        mock_upload.assert_called_once()  # duplicate content stored once; no Pillow here, so no thumbnail
+        appends = [c for c in mock_post.call_args_list if c.args[0].endswith("append_listing_photos")]
+        self.assertEqual(len(appends), 1)
+        items = appends[0].kwargs["json"]["p_items"]
+        self.assertEqual(len(items), 2)
+        self.assertEqual({i["listing_id"] for i in items}, {listing_id})
+        self.assertEqual(len({i["url"] for i in items}), 1)
+
+    @patch('src.media.WHATSAPP_FROM', '+14155238886')
+    @patch('src.media.clients.twilio_client')
+    @patch('src.media.sb._post', return_value=MagicMock(status_code=200, json=MagicMock(return_value=None)))
+    def test_sender_without_listing_is_told_in_e164(self, mock_post, mock_twilio):
+        """Test that photos from a number with no listing are not downloaded and the notice goes to a valid WhatsApp address."""
+        media.process({"phone": "whatsapp:254700000009", "token": None, "urls": [f"{self.base}/a.png"]})
+        sent = mock_twilio.return_value.messages.create.call_args.kwargs
+        self.assertEqual((sent["from_"], sent["to"]), ("whatsapp:+14155238886", "whatsapp:+254700000009"))
+
+    @patch('src.webhook_handler.get_bot_response')
+    @patch('src.media.enqueue', return_value=True)
+    def test_webhook_only_queues_media(self, mock_enqueue, mock_reply):
+        """Test that a message with photos is acknowledged without running the chat pipeline."""
+        from src.webhook_handler import app
+        form = {"From": "whatsapp:+254700000009", "Body": "3f9a1c", "NumMedia": "2",
+                "MediaUrl0": f"{self.base}/a.png", "MediaContentType0": "image/jpeg",
+                "MediaUrl1": f"{self.base}/v.mp4", "MediaContentType1": "video/mp4"}
+        resp = app.test_client().post('/webhook', data=form)
+        self.assertIn(b"Got 1 photo", resp.data)
+        self.assertIn(b"listing 3f9a1c", resp.data)
+        mock_enqueue.assert_called_once_with("whatsapp:254700000009", "3f9a1c", [f"{self.base}/a.png"])
+        mock_reply.assert_not_called()
+
+
+class TestTraceAnalytics(unittest.TestCase):
+
+    def test_summary_over_rotated_segments_matches_columnar_export(self):
+        """Test that plain, gzipped and active segments are aggregated the same way as the columnar export."""
+        def trace(i):
+            ok = i % 4 != 0
+            return json.dumps({
+                "trace_id": str(i), "ts": 1000 + i, "user_id": f"u{i % 3}", "task": "rent_search_or_portfolio",
+                "goal": {"user_message": "x" * (i % 40)},
+                "steps": [
+                    {"step_no": 1, "step_type": "plan", "content": {}, "success": True},
+                    {"step_no": 3, "step_type": "critique", "success": ok,
+                     "content": {"observation": "Here you go" if ok else "Sorry, I'm having trouble", "meets_goal": ok}},
+                ],
+            }, ensure_ascii=False)
+
+        lines = [trace(i) for i in range(300)]
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'traces-1100.jsonl'), 'w', encoding='utf-8') as f:
+                f.write("\n".join(lines[:100]) + "\n")
+            with gzip.open(os.path.join(tmp, 'traces-1200.jsonl.gz'), 'wt', encoding='utf-8') as f:
+                f.write("\n".join(lines[100:200]) + "\n")
+            with open(os.path.join(tmp, 'traces.jsonl'), 'w', encoding='utf-8') as f:
+                f.write("\n".join(lines[200:]) + '\n{"trace_id": "cut sh')
+
+            stats = trace_analytics.summarize(tmp, chunk_bytes=500)
+            self.assertEqual(stats.traces, 300)
+            self.assertEqual(stats.malformed, 1)
+            self.assertEqual(stats.meets_goal, 225)
+            self.assertEqual(stats.degraded['sorry'], 75)
+            self.assertEqual(stats.steps['critique'], 300)
+
+            flt = trace_analytics.TraceFilter(since=1150, user='u1')
+            streamed = trace_analytics.summarize(tmp, flt, chunk_bytes=500).to_dict()
+            export_path = os.path.join(tmp, 'traces.npz')
+            self.assertEqual(trace_analytics.export_columns(export_path, tmp), 300)
+            self.assertEqual(trace_analytics.summarize_columns(export_path, flt).to_dict(), {**streamed, 'malformed_lines': 0})
+
+
+class TestClients(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.multiple('src.clients', _clients={}, _warmups=[], _redis_failed_at=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_clients_are_built_once_and_dropped_after_fork(self):
+        """Test that a client is built on first use, shared afterwards, and rebuilt after reset()."""
+        factory = MagicMock(side_effect=lambda: object())
+        first = clients._get_or_build('thing', factory)
+        self.assertIs(clients._get_or_build('thing', factory), first)
+        self.assertEqual(factory.call_count, 1)
+
+        clients.reset()  # post_fork in each gunicorn worker
+        self.assertIsNot(clients._get_or_build('thing', factory), first)
+        self.assertEqual(factory.call_count, 2)
+
+    @patch('redis.Redis')
+    def test_unreachable_redis_is_retried_after_a_back_off(self, mock_redis):
+        """Test that a failed Redis connection returns None without reconnecting until REDIS_RETRY_SECONDS pass."""
+        import redis
+        mock_redis.return_value.ping.side_effect = redis.exceptions.ConnectionError("refused")
+        now = time.time()
+        with patch('src.clients.time.time', return_value=now):
+            self.assertIsNone(clients.redis_client())
+            self.assertIsNone(clients.redis_client())
+        self.assertEqual(mock_redis.call_count, 1)
+
+        mock_redis.return_value.ping.side_effect = None
+        with patch('src.clients.time.time', return_value=now + clients.REDIS_RETRY_SECONDS):
+            self.assertIs(clients.redis_client(), mock_redis.return_value)
+            self.assertIs(clients.redis_client(), mock_redis.return_value)
+        self.assertEqual(mock_redis.call_count, 2)
+
+    def test_failing_warm_up_hook_does_not_stop_the_others(self):
+        """Test that warm_up() runs every hook and times each one even when one raises."""
+        ran = []
+        clients.register_warmup('first', lambda: ran.append('first'))
+        clients.register_warmup('broken', MagicMock(side_effect=RuntimeError("no model")))
+        clients.register_warmup('last', lambda: ran.append('last'))
+        timings = clients.warm_up()
+        self.assertEqual(ran, ['first', 'last'])
+        self.assertEqual(list(timings), ['first', 'broken', 'last'])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file